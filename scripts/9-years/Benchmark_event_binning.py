@@ -0,0 +1,107 @@
+""" Benchmark of the event binning (event_binning.py) on a synthetic event list: one pass over the events for several nsides and energy binnings, the cubes are compared with each other and with np.histogram2d """
+
+
+import os
+import time
+import numpy as np
+import healpy
+import event_binning
+import cube_cache
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-N", "--nevents", dest="nevents", default='20000000', help="number of synthetic events")
+parser.add_option("-n", "--nsides", dest="nsides", default='64,128,256', help="comma separated healpix nside parameters")
+parser.add_option("-E", "--nE", dest="nE", default='24,12', help="comma separated numbers of logarithmic energy bins")
+parser.add_option("-d", "--dir", dest="folder", default='fits/', help="folder for the test files")
+parser.add_option("-f", "--format", dest="format", default='fits', help="format of the event list (fits or npy)")
+parser.add_option("-k", "--keep", dest="keep", action="store_true", default=False, help="keep the event list for the next run")
+
+(options, args) = parser.parse_args()
+
+nevents = int(float(options.nevents))
+nsides = [int(nside) for nside in str(options.nsides).split(',')]
+nE_list = [int(nE) for nE in str(options.nE).split(',')]
+events_fn = options.folder + 'benchmark_events_%i.%s' % (nevents, options.format)
+data_class = 'source'
+
+
+###################################################################################################################### Event list
+
+
+if not os.path.isfile(events_fn):
+    event_binning.synthetic_events(events_fn, nevents)
+print 'size (MB): %.1f' % (os.path.getsize(events_fn) / 1.e6)
+
+
+###################################################################################################################### Binning
+
+
+binnings = {}
+for nside in nsides:
+    for nE in nE_list:
+        fn = options.folder + 'benchmark_counts_nside%i_%ibins.fits' % (nside, nE)
+        binnings[(nside, nE)] = event_binning.Binning(fn, nside, event_binning.log_bins(0.1, 1000., nE))
+
+t0 = time.time()
+stats = event_binning.bin_events(events_fn, binnings.values(), data_class=data_class, silent=True)
+t_all = time.time() - t0
+
+timing = {}
+for key in sorted(binnings):
+    single = event_binning.Binning(binnings[key].fn + '.single', key[0], binnings[key].Ebins)
+    t0 = time.time()
+    event_binning.bin_events(events_fn, [single], data_class=data_class, save=False, silent=True)
+    timing[key] = time.time() - t0
+    assert np.array_equal(single.counts, binnings[key].counts)
+
+
+###################################################################################################################### Checks
+
+
+for (nside, nE), binning in sorted(binnings.items()):
+    cube, Es = cube_cache.load(binning.fn)                                         # served by the cube cache
+    assert np.array_equal(cube, binning.counts)
+    assert np.sum(cube, dtype=np.int64) == stats['binned'][binning.fn]
+    if nside != nsides[0]:                                                          # the same counts at lower nside
+        coarse = binnings[(nsides[0], nE)].counts
+        assert np.array_equal(healpy.ud_grade(cube * 1., nsides[0], power=-2), coarse)
+    if nE != nE_list[0] and nE_list[0] % nE == 0:                                   # the same counts in wider bins
+        fine = binnings[(nside, nE_list[0])].counts
+        assert np.array_equal(fine.reshape((nE, -1, fine.shape[1])).sum(axis=1), cube)
+
+# np.histogram2d of the first events as a reference
+chunk = event_binning.read_events(events_fn, chunk_size=10**6).next()
+sel = event_binning.select(chunk, data_class=data_class)
+theta, phi = event_binning.galactic_angles(chunk[sel])
+E = np.asarray(chunk['ENERGY'][sel]) / event_binning.GeV2MeV
+nside = nsides[0]
+pix = healpy.ang2pix(nside, theta, phi)
+partial = event_binning.Binning(options.folder + 'partial.fits', nside, event_binning.log_bins(0.1, 1000., nE_list[0]))
+ref = np.histogram2d(E, pix, bins=[partial.Ebins, np.arange(partial.npix + 1) - 0.5])[0]
+ie = np.searchsorted(partial.Ebins, E, side='right') - 1
+inside = (ie >= 0) & (ie < partial.nE)
+partial.add(ie[inside], pix[inside])
+assert np.array_equal(partial.counts, ref)
+print 'checks passed'
+
+
+###################################################################################################################### Print the table
+
+
+print
+print '%i events (%i selected), %i cubes in one pass: %.1f s (%.2e events/s)' % (stats['read'], stats['selected'],
+                                                                               len(binnings), t_all, stats['read'] / t_all)
+print 'nside    nE   one cube (s)'
+for key in sorted(binnings):
+    print '%-8i %-4i %12.1f' % (key + (timing[key],))
+print 'sum over the single passes: %.1f s' % sum(timing.values())
+
+for binning in binnings.values():
+    os.remove(binning.fn)
+    cube_cache.clear(binning.fn)
+if not options.keep:
+    os.remove(events_fn)
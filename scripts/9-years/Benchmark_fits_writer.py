@@ -0,0 +1,82 @@
+""" Benchmark of the fits writers: the old hmap2skymap (pyfits tables) against skymap_io (direct, compressed and one energy bin at a time) on random cubes """
+
+
+import os
+import time
+import numpy as np
+import healpy
+import pyfits
+import auxil
+import skymap_io
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-n", "--nsides", dest="nsides", default='128,512', help="comma separated healpix nside parameters")
+parser.add_option("-E", "--nE", dest="nE", default='31', help="number of energy bins")
+parser.add_option("-d", "--dir", dest="folder", default='fits/', help="folder for the test files")
+
+(options, args) = parser.parse_args()
+
+nsides = [int(nside) for nside in str(options.nsides).split(',')]
+nE = int(options.nE)
+fn = options.folder + 'benchmark_writer.fits'
+Es = 0.3 * np.exp(0.38 * np.arange(nE))
+
+writers = ['old', 'write_cube', 'energy_major', 'gzip', 'incremental']
+
+###################################################################################################################### Run the writers
+
+
+timing = {}
+for nside in nsides:
+    npix = healpy.nside2npix(nside)
+    print 'nside %i' % nside
+    cube = np.random.poisson(10., (nE, npix)) * 1.                                         # energy-major, as in stream_maps
+    t = {}
+
+    t0 = time.time()
+    auxil.hmap2skymap_old(cube.T.copy(), fn, unit='counts', Es=Es, Eunit='GeV')
+    t['old'] = time.time() - t0
+    reference = pyfits.open(fn)[1].data.field('Spectra')
+
+    t0 = time.time()
+    skymap_io.write_cube(fn, cube.T.copy(), unit='counts', Es=Es, silent=True)
+    t['write_cube'] = time.time() - t0
+
+    t0 = time.time()
+    skymap_io.write_cube(fn, cube, unit='counts', Es=Es, energy_major=True, silent=True)
+    t['energy_major'] = time.time() - t0
+    assert np.array_equal(pyfits.open(fn)[1].data.field('Spectra'), reference)
+
+    t0 = time.time()
+    skymap_io.write_cube(fn + '.gz', cube, unit='counts', Es=Es, energy_major=True, compress=True, silent=True)
+    t['gzip'] = time.time() - t0
+    assert np.array_equal(pyfits.open(fn + '.gz')[1].data.field('Spectra'), reference)
+
+    t0 = time.time()
+    writer = skymap_io.SkymapWriter(fn, nside, nE, unit='counts', Es=Es)
+    for E in xrange(nE):
+        writer.write(E, cube[E])
+    writer.close()
+    t['incremental'] = time.time() - t0
+    assert np.array_equal(pyfits.open(fn)[1].data.field('Spectra'), reference)
+
+    timing[nside] = t
+    print 'size (MB): %.1f, compressed: %.1f' % (os.path.getsize(fn) / 1.e6, os.path.getsize(fn + '.gz') / 1.e6)
+    os.remove(fn)
+    os.remove(fn + '.gz')
+
+
+###################################################################################################################### Print the table
+
+
+print
+print 'time (s) per writer, %i energy bins' % nE
+print 'nside    npix      ' + ''.join(['%14s' % writer for writer in writers]) + '   speed-up'
+for nside in nsides:
+    npix = healpy.nside2npix(nside)
+    print '%-8i %-9i ' % (nside, npix) + ''.join(['%14.3f' % timing[nside][writer] for writer in writers]) \
+        + '%11.1f' % (timing[nside]['old'] / timing[nside]['energy_major'])
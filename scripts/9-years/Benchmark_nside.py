@@ -0,0 +1,99 @@
+""" Benchmark of the map stages (labels, in-painting, lat-lon profiles, fits, model reconstruction) for different healpix resolutions on synthetic maps. The energy bins are processed one at a time, so that the memory use is O(npix) """
+
+
+import time
+import numpy as np
+import healpy
+import healpylib as hlib
+import poisson_fit
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-n", "--nsides", dest="nsides", default='128,256,512,1024', help="comma separated healpix nside parameters")
+parser.add_option("-E", "--nE", dest="nE", default='4', help="number of energy bins")
+
+(options, args) = parser.parse_args()
+
+nsides = [int(nside) for nside in str(options.nsides).split(',')]
+nE = int(options.nE)
+
+dB = 4.
+dL = 20.
+Bbins = np.arange(-90., 90. + 0.001, dB)
+Lbins = np.arange(-180., 180. + 0.001, dL)
+nB = len(Bbins) - 1
+nL = len(Lbins) - 1
+
+nside_mask = 128                                  # the mask is generated at nside 128 and resampled
+npix_mask = healpy.nside2npix(nside_mask)
+np.random.seed(0)
+mask128 = np.ones(npix_mask)
+vecs = healpy.ang2vec(np.arccos(np.random.uniform(-1, 1, 500)), np.random.uniform(0, 2 * np.pi, 500))
+for vec in vecs:
+    mask128[healpy.query_disc(nside_mask, vec, np.deg2rad(1.))] = 0.
+
+stages = ['mask', 'labels', 'inds_dict', 'heal', 'profiles', 'fit', 'model']
+
+###################################################################################################################### Run the stages
+
+
+timing = {}
+for nside in nsides:
+    npix = healpy.nside2npix(nside)
+    print 'nside %i' % nside
+    t = dict((stage, 0.) for stage in stages)
+
+    t0 = time.time()
+    mask = hlib.resample_mask(mask128, nside)
+    t['mask'] += time.time() - t0
+
+    t0 = time.time()
+    ib, il = hlib.lb_labels(nside, Bbins, Lbins, mask=mask, use_cache=False)
+    t['labels'] += time.time() - t0
+
+    t0 = time.time()
+    inds_dict = hlib.LBIndsDict(ib, il, nB, nL)
+    t['inds_dict'] += time.time() - t0
+
+    theta, phi = healpy.pix2ang(nside, np.arange(npix))
+    template = (1. + 10. * np.exp(-(0.5 * np.pi - theta)**2 / 0.1)) * (1. + 0.5 * np.cos(phi))
+    expo = 1.e11 * (1. + 0.1 * np.cos(theta))
+    for E in xrange(nE):                                                                # one energy bin at a time
+        counts = np.random.poisson(0.5 * template * 0.5**E + 1.e-11 * expo) * 1.
+
+        t0 = time.time()
+        healed = hlib.heal(counts, mask)
+        t['heal'] += time.time() - t0
+
+        t0 = time.time()
+        prof = hlib.fpix_lb_profiles(healed, inds_dict, nB, nL)
+        t['profiles'] += time.time() - t0
+
+        t0 = time.time()
+        k, c, k_err, c_err = poisson_fit.fit_kc(counts, template, expo, ib, nlab=nB)
+        t['fit'] += time.time() - t0
+
+        t0 = time.time()
+        model = poisson_fit.region_model([k[:, np.newaxis], c[:, np.newaxis]], [template, expo], ib, E=0)
+        t['model'] += time.time() - t0
+
+    timing[nside] = t
+
+
+###################################################################################################################### Print the table
+
+
+print
+print 'time (s) per stage, %i energy bins' % nE
+print 'nside    npix      ' + ''.join(['%10s' % stage for stage in stages]) + '     total   scaling'
+nside0 = nsides[0]
+total0 = sum(timing[nside0].values())
+for nside in nsides:
+    npix = healpy.nside2npix(nside)
+    total = sum(timing[nside].values())
+    scaling = (total / total0) / (float(npix) / healpy.nside2npix(nside0))         # 1: linear in npix
+    print '%-8i %-9i ' % (nside, npix) + ''.join(['%10.3f' % timing[nside][stage] for stage in stages]) \
+        + '%10.3f%10.2f' % (total, scaling)
@@ -0,0 +1,50 @@
+""" Bins FT1 event files into healpix counts cubes for several nsides and energy binnings in one pass over the events (event_binning.py). The cubes are saved as fits skymaps and put to the cube cache """
+
+
+import glob
+import numpy as np
+import healpy
+import event_binning
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-i", "--input", dest="input", default='../../data/events/*.fits', help="comma separated FT1 files (wildcards allowed)")
+parser.add_option("-c", "--data_class", dest = "data_class", default = "source", help="data class (source, ultraclean) or all")
+parser.add_option("-n", "--nsides", dest="nsides", default='128', help="comma separated healpix nside parameters")
+parser.add_option("-E", "--nE", dest="nE", default='24', help="comma separated numbers of logarithmic energy bins")
+parser.add_option("-e", "--Erange", dest="Erange", default='0.1,1000.', help="minimal and maximal energy in GeV")
+parser.add_option("-o", "--output", dest="output", default='../../data/counts/', help="folder of the counts cubes")
+parser.add_option("-m", "--memmap", dest="memmap", action="store_true", default=False, help="accumulate the cubes on the disk")
+
+(options, args) = parser.parse_args()
+
+fns = sorted(sum([glob.glob(pattern) for pattern in str(options.input).split(',')], []))
+data_class = None if options.data_class == 'all' else options.data_class
+nsides = [int(nside) for nside in str(options.nsides).split(',')]
+nE_list = [int(nE) for nE in str(options.nE).split(',')]
+emin, emax = [float(E) for E in str(options.Erange).split(',')]
+
+
+###################################################################################################################### Binnings
+
+
+binnings = []
+for nside in nsides:
+    for nE in nE_list:
+        fn = options.output + 'counts_%s_healpix_o%i_%ibins.fits' % (options.data_class, int(np.log2(nside)), nE)
+        binnings.append(event_binning.Binning(fn, nside, event_binning.log_bins(emin, emax, nE), memmap=options.memmap))
+
+
+###################################################################################################################### Bin the events
+
+
+print 'bin %i files into %i cubes' % (len(fns), len(binnings))
+stats = event_binning.bin_events(fns, binnings, data_class=data_class)
+
+print 'events: %i, selected: %i, time: %.1f s (%.2e events/s)' % (stats['read'], stats['selected'], stats['time'],
+                                                                  stats['read'] / max(stats['time'], 1.e-6))
+for binning in binnings:
+    print '%s: %i events' % (binning.fn, stats['binned'][binning.fn])
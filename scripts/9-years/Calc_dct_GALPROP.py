@@ -5,6 +5,7 @@ import numpy as np
 import pyfits
 import healpy
 import healpylib as hlib
+import profiles
 import dio
 
 
@@ -27,8 +28,6 @@ Lmax = 10.                                       # maximal longitude (in deg)
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575                       # Logarithmic size of one energy bin, in fits header "Step in energy (log)"
-npix = 196608
-nside = healpy.npix2nside(npix)
 
 ###################################################################################################################### Load data
 
@@ -54,6 +53,8 @@ mask_fn = '../../data/ps_masks/ps_mask_3FGL_OG_nside128.npy'
 
 hdu = pyfits.open(map_fn)
 data = hdu[1].data.field('Spectra')[::,binmin:binmax+1]
+npix = data.shape[0]                                                       # Number of Healpix pixels, read from the input map
+nside = healpy.npix2nside(npix)
 Es = hdu[2].data.field('MeV')[binmin:binmax+1] / GeV2MeV
 
 hdu_expo = pyfits.open(expo_fn)
@@ -66,7 +67,7 @@ deltaE = Es * (np.exp(delta/2) - np.exp(-delta/2))
 
 mask = np.ones(npix)
 if mask_point_sources:
-    mask = np.load(mask_fn)
+    mask = hlib.load_mask(mask_fn, nside)                                     # Resampled if the map is not nside 128
 
 
 ###################################################################################################################### Select the region and group together pixels of the same region in the inds_dict
@@ -76,6 +77,7 @@ diff_dct = {}
 std_dct = {}
 
 Bbins = {}
+binnings = []                                     # (ib, il, nB, nL) of the 'small' and 'large' binnings
 Lbins = np.arange(-Lmax, Lmax + 0.001, dL)
 Lc = (Lbins[:-1] + Lbins[1:])/2
 nL = len(Lbins)-1
@@ -96,33 +98,29 @@ for option in ['small','large']:
     
 
     print 'calculate indices...'
-    inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins[option], Lbins, mask=mask)
+    ib, il = hlib.lb_labels(nside, Bbins[option], Lbins, mask=mask)                      # Lat and lon index of each pixel, -1: masked
+
+    binnings.append((ib, il, nB, nL))
+
 
 ###################################################################################################################### Calculate differential flux in each pixel, sum over pixels in one lat-lon bin, calculate std
 
 
-    diff_dct[option] = np.zeros((nB,nL,nE))
-    std_dct[option] = np.zeros((nB,nL,nE))
-    
-    for b in xrange(nB):
-        for l in xrange(nL):
-
-            N_gamma = 0
-            if Save_counts:
-                diff_dct[option][(b,l)] = np.sum([data[pixel] for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure
-            else:
-                diff_dct[option][(b,l)] = np.sum([(data[pixel] / exposure[pixel]) for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure
-           
-            N_gamma = np.sum([counts[pixel] for pixel in inds_dict[(b,l)]], axis = 0)
-        
-            
-            for i in xrange(len(N_gamma)-1, 0-1, -1): # delete empty lat lon bins
-                if np.sqrt(N_gamma[i]) < 0.1:
-                    N_gamma[i] = 0.1
-            if Save_counts == False:        
-                dOmega = 4. * np.pi * len(inds_dict[(b,l)]) / npix  # calculate solid angle of region
-                diff_dct[option][(b,l)] =  (Es**2 * diff_dct[option][(b,l)]) / (deltaE * dOmega) # spectral energy distribution = (E^2 * N_gamma) / (exposure * dOmega * deltaE)
-            std_dct[option][(b,l)] = diff_dct[option][(b,l)] / np.sqrt(N_gamma) # errors = standard deviation via Gaussian error propagation
+if Save_counts:
+    data_sums, npix_lb = profiles.multi_lb_sums(data, binnings)                           # both binnings in one sparse matrix product
+else:
+    data_sums, npix_lb = profiles.multi_lb_sums(data / exposure, binnings)                # map = N_gamma / exposure
+counts_sums = profiles.multi_lb_sums(counts, binnings)[0]
+
+for i, option in enumerate(['small','large']):
+    diff_dct[option] = data_sums[i]
+    N_gamma = counts_sums[i]
+
+    N_gamma[(N_gamma >= 0) & (N_gamma < 0.01)] = 0.1                                     # delete empty lat lon bins
+    if Save_counts == False:
+        dOmega = 4. * np.pi * npix_lb[i] / npix                                            # calculate solid angle of region
+        diff_dct[option] = (Es**2 * diff_dct[option]) / (deltaE * dOmega[:,:,np.newaxis]) # spectral energy distribution = (E^2 * N_gamma) / (exposure * dOmega * deltaE)
+    std_dct[option] = diff_dct[option] / np.sqrt(N_gamma)                                 # errors = standard deviation via Gaussian error propagation
 
 
         
@@ -0,0 +1,33 @@
+""" Calculates the lat-lon profile dictionaries of data, exposure, GALPROP, lowE and boxes models in one pass (see dct_engine.py). Values are saved in dictionaries """
+
+
+import time
+import dct_engine
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-c", "--data_class", dest = "data_class", default = "source,ultraclean", help="comma separated data classes (source, ultraclean)")
+parser.add_option("-E", "--lowE_range", dest="lowE_range", default='0,1,2,3', help="comma separated low-energy ranges: 0: (3,5), 1: (3,3), 2: (4,5), 3: (6,7)")
+parser.add_option("-k", "--kinds", dest="kinds", default='data,expo,GALPROP,lowE,boxes', help="comma separated products")
+parser.add_option("-p", "--nproc", dest="nproc", default='1', help="number of processes")
+
+(options, args) = parser.parse_args()
+
+data_classes = str(options.data_class).split(',')
+lowE_range_list = [int(r) for r in str(options.lowE_range).split(',')]
+kinds = str(options.kinds).split(',')
+nproc = int(options.nproc)
+
+
+###################################################################################################################### Calculate and save dictionaries
+
+
+t0 = time.time()
+products = dct_engine.default_products(data_classes, lowE_range_list, kinds=kinds)
+fns = dct_engine.run(products, nproc=nproc)
+for fn in fns:
+    print 'save', fn
+print 'saved %i of %i dictionaries in %.1f s' % (len(fns), len(products), time.time() - t0)
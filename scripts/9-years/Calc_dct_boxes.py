@@ -5,6 +5,7 @@ import numpy as np
 import pyfits
 import healpy
 import healpylib as hlib
+import profiles
 import dio
 from optparse import OptionParser
 
@@ -50,8 +51,6 @@ Lmax = 10.                                        # maximal longitude (in deg)
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575                        # Logarithmic size of one energy bin, in fits header "Step in energy (log)"
-npix = 196608
-nside = healpy.npix2nside(npix)
 
 ###################################################################################################################### Load data
 
@@ -90,6 +89,8 @@ nE = binmax - binmin + 1
 hdu = pyfits.open(map_fn)
 #binmax = min(np.size(hdu[2].data.field('GeV')) - binmin, binmax)
 data = hdu[1].data.field('Spectra')[::,:binmax-binmin+1]
+npix = data.shape[0]                                                       # Number of Healpix pixels, read from the input map
+nside = healpy.npix2nside(npix)
 Es = hdu[2].data.field('GeV')[:binmax-binmin+1]
 print data.shape
 
@@ -98,9 +99,7 @@ counts = hdu_counts[1].data.field('Spectra')[::,binmin : binmax+1]
 
 mask = np.ones(npix)
 if mask_point_sources:
-    mask = np.load(mask_fn)
-    if symmetrize_mask:
-        mask *= mask[::-1]
+    mask = hlib.load_mask(mask_fn, nside, symmetrize=symmetrize_mask)         # Resampled if the map is not nside 128
 
 ###################################################################################################################### Select the region and group together pixels of the same region in the inds_dict
 
@@ -109,6 +108,7 @@ diff_dct = {}
 std_dct = {}
 
 Bbins = {}
+binnings = []                                     # (ib, il, nB, nL) of the 'small' and 'large' binnings
 Lbins = np.arange(-Lmax, Lmax + 0.001, dL)
 Lc = (Lbins[:-1] + Lbins[1:])/2
 nL = len(Lbins)-1
@@ -127,29 +127,27 @@ for option in ['small','large']:
     
 
     print 'calculate indices...'
-    inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins[option], Lbins, mask=mask)
+    ib, il = hlib.lb_labels(nside, Bbins[option], Lbins, mask=mask)                      # Lat and lon index of each pixel, -1: masked
+
+    binnings.append((ib, il, nB, nL))
+
 
 ###################################################################################################################### Calculate differential flux in each pixel, sum over pixels in one lat-lon bin, calculate std
 
 
-    diff_dct[option] = np.zeros((nB,nL,nE))
-    std_dct[option] = np.zeros((nB,nL,nE))
-    
-    for b in xrange(nB):
-        for l in xrange(nL):
-
-            N_gamma = 0
-            if Save_counts:
-                diff_dct[option][(b,l)] = np.sum([data[pixel] for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure
-            else:
-                diff_dct[option][(b,l)] = np.mean([data[pixel] for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure
-            N_gamma = np.sum([counts[pixel] for pixel in inds_dict[(b,l)]], axis = 0)           
-            
-            for i in xrange(len(N_gamma)-1, 0-1, -1): # delete empty lat lon bins
-                if np.sqrt(N_gamma[i]) < 0.1:
-                    N_gamma[i] = 0.1
-                    
-            std_dct[option][(b,l)] = diff_dct[option][(b,l)] / np.sqrt(N_gamma) # errors = standard deviation via Gaussian error propagation
+data_sums, npix_lb = profiles.multi_lb_sums(data, binnings)                               # both binnings in one sparse matrix product
+counts_sums = profiles.multi_lb_sums(counts, binnings)[0]
+
+for i, option in enumerate(['small','large']):
+    if Save_counts:
+        diff_dct[option] = data_sums[i]
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            diff_dct[option] = data_sums[i] / npix_lb[i][:,:,np.newaxis]
+    N_gamma = counts_sums[i]
+
+    N_gamma[(N_gamma >= 0) & (N_gamma < 0.01)] = 0.1                                     # delete empty lat lon bins
+    std_dct[option] = diff_dct[option] / np.sqrt(N_gamma)                                 # errors = standard deviation via Gaussian error propagation
 
 
         
@@ -5,6 +5,7 @@ import numpy as np
 import pyfits
 import healpy
 import healpylib as hlib
+import profiles
 import dio
 
 
@@ -32,8 +33,6 @@ if lon180:
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575 # logarithmic distance between two energy bins
-npix = 196608
-nside = healpy.npix2nside(npix)
 
 ###################################################################################################################### Load data and mask
 if lon180:
@@ -75,6 +74,8 @@ mask_fn = '../../data/ps_masks/ps_mask_3FGL_small_nside128.npy'
 
 hdu = pyfits.open(map_fn)
 data = hdu[1].data.field('Spectra')[::,binmin:binmax+1]
+npix = data.shape[0]                                                       # Number of Healpix pixels, read from the input map
+nside = healpy.npix2nside(npix)
 Es = hdu[2].data.field('MeV')[binmin:binmax+1] / GeV2MeV
 hdu_expo = pyfits.open(expo_fn)
 exposure = hdu_expo[1].data.field('Spectra')[::,binmin:binmax+1]
@@ -83,9 +84,7 @@ deltaE = Es * (np.exp(delta/2) - np.exp(-delta/2))
 
 mask = np.ones(npix)
 if mask_point_sources:
-    mask = np.load(mask_fn)
-    if symmetrize_mask:
-        mask *= mask[::-1]
+    mask = hlib.load_mask(mask_fn, nside, symmetrize=symmetrize_mask)         # Resampled if the map is not nside 128
 
     
 ###################################################################################################################### Select the region and group together pixels of the same region in the inds_dict
@@ -94,6 +93,7 @@ diff_dct = {}
 std_dct = {}
 
 Bbins = {}
+binnings = []                                     # (ib, il, nB, nL) of the 'small' and 'large' binnings
 Lbins = np.arange(-Lmax, Lmax + 0.001, dL)
 Lc = (Lbins[:-1] + Lbins[1:])/2
 nL = len(Lbins)-1
@@ -112,32 +112,30 @@ for option in ['small','large']:
     
 
     print 'calculate indices...'
-    inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins[option], Lbins, mask=mask)
+    ib, il = hlib.lb_labels(nside, Bbins[option], Lbins, mask=mask)                      # Lat and lon index of each pixel, -1: masked
+
+    binnings.append((ib, il, nB, nL))
+
 
 ###################################################################################################################### Calculate differential flux in each pixel, sum over pixels in one lat-lon bin, calculate std
 
 
-    diff_dct[option] = np.zeros((nB,nL,nE))
-    std_dct[option] = np.zeros((nB,nL,nE))
-    
-    for b in xrange(nB):
-        for l in xrange(nL):
-
-            N_gamma = 0
-            if Save_counts:
-                diff_dct[option][(b,l)] = np.sum([data[pixel] for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure
-            else:
-                diff_dct[option][(b,l)] = np.sum([(data[pixel] / exposure[pixel]) for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure
-                
-            N_gamma = np.sum([data[pixel] for pixel in inds_dict[(b,l)]], axis = 0)
-                        
-            for i in xrange(len(N_gamma)-1, 0-1, -1): # delete empty lat lon bins
-                if np.sqrt(N_gamma[i]) == 0:
-                    N_gamma[i] = 0.1
-            if Save_counts == False:        
-                dOmega = 4. * np.pi * len(inds_dict[(b,l)]) / npix  # calculate solid angle of region
-                diff_dct[option][(b,l)] =  (Es**2 * diff_dct[option][(b,l)]) / (deltaE * dOmega) # spectral energy distribution = (E^2 * N_gamma) / (exposure * dOmega * deltaE)
-            std_dct[option][(b,l)] = diff_dct[option][(b,l)] / np.sqrt(N_gamma) # errors = standard deviation via Gaussian error propagation
+counts_sums, npix_lb = profiles.multi_lb_sums(data, binnings)                            # both binnings in one sparse matrix product
+if not Save_counts:
+    flux_sums = profiles.multi_lb_sums(data / exposure, binnings)[0]                      # map = N_gamma / exposure
+
+for i, option in enumerate(['small','large']):
+    N_gamma = counts_sums[i]
+    if Save_counts:
+        diff_dct[option] = N_gamma.copy()
+    else:
+        diff_dct[option] = flux_sums[i]
+
+    N_gamma[N_gamma == 0] = 0.1                                                           # delete empty lat lon bins
+    if Save_counts == False:
+        dOmega = 4. * np.pi * npix_lb[i] / npix                                            # calculate solid angle of region
+        diff_dct[option] = (Es**2 * diff_dct[option]) / (deltaE * dOmega[:,:,np.newaxis]) # spectral energy distribution = (E^2 * N_gamma) / (exposure * dOmega * deltaE)
+    std_dct[option] = diff_dct[option] / np.sqrt(N_gamma)                                 # errors = standard deviation via Gaussian error propagation
 
 
         
@@ -5,6 +5,7 @@ import numpy as np
 import pyfits
 import healpy
 import healpylib as hlib
+import profiles
 import dio
 
 
@@ -27,8 +28,6 @@ Lmax = 10. # maximal longitude (in deg)
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575 # logarithmic distance between two energy bins
-npix = 196608
-nside = healpy.npix2nside(npix)
 
 ###################################################################################################################### Load data and mask
 
@@ -45,15 +44,15 @@ mask_fn = '../../data/ps_masks/ps_mask_3FGL_small_nside128.npy'
 
 hdu = pyfits.open(expo_fn)
 exposure = hdu[1].data.field('Spectra')[::,binmin:binmax+1]
+npix = exposure.shape[0]                                                   # Number of Healpix pixels, read from the input map
+nside = healpy.npix2nside(npix)
 Es = hdu[2].data.field('MeV')[binmin:binmax+1] / GeV2MeV
 
 deltaE = Es * (np.exp(delta/2) - np.exp(-delta/2))
 
 mask = np.ones(npix)
 if mask_point_sources:
-    mask = np.load(mask_fn)
-    if symmetrize_mask:
-        mask *= mask[::-1]
+    mask = hlib.load_mask(mask_fn, nside, symmetrize=symmetrize_mask)         # Resampled if the map is not nside 128
 
     
 ###################################################################################################################### Select the region and group together pixels of the same region in the inds_dict
@@ -62,6 +61,7 @@ expo_dct = {}
 dOmega_dct = {}
 
 Bbins = {}
+binnings = []                                     # (ib, il, nB, nL) of the 'small' and 'large' binnings
 Lbins = np.arange(-Lmax, Lmax + 0.001, dL)
 Lc = (Lbins[:-1] + Lbins[1:])/2
 nL = len(Lbins)-1
@@ -80,18 +80,20 @@ for option in ['small','large']:
     
 
     print 'calculate indices...'
-    inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins[option], Lbins, mask=mask)
+    ib, il = hlib.lb_labels(nside, Bbins[option], Lbins, mask=mask)                      # Lat and lon index of each pixel, -1: masked
+
+    binnings.append((ib, il, nB, nL))
+
 
 ###################################################################################################################### Calculate differential flux in each pixel, sum over pixels in one lat-lon bin, calculate std
 
 
-    expo_dct[option], dOmega_dct[option] = np.zeros((nB,nL,nE)), np.zeros((nB,nL))
-    
-    for b in xrange(nB):
-        for l in xrange(nL):
+expo_sums, npix_lb = profiles.multi_lb_sums(exposure, binnings)                          # both binnings in one sparse matrix product
 
-            expo_dct[option][(b,l)] = np.mean([exposure[pixel] for pixel in inds_dict[(b,l)]], axis = 0)# map = N_gamma / exposure     
-            dOmega_dct[option][(b,l)] = 4. * np.pi * len(inds_dict[(b,l)]) / npix  # calculate solid angle of region
+for i, option in enumerate(['small','large']):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expo_dct[option] = expo_sums[i] / npix_lb[i][:,:,np.newaxis]
+    dOmega_dct[option] = 4. * np.pi * npix_lb[i] / npix                                   # calculate solid angle of region
 
         
 ###################################################################################################################### Save dictionary in YAML format
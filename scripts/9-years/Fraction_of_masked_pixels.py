@@ -8,11 +8,16 @@ import healpylib as hlib
 import dio
 from matplotlib import pyplot
 import auxil
+from optparse import OptionParser
 
 
 ####################################################################################################################### Parameters
 
 
+parser = OptionParser()
+parser.add_option("-n", "--nside", dest="nside", default='128', help="healpix nside of the maps which are binned (the mask is resampled)")
+(options, args) = parser.parse_args()
+
 
 ###################################################################################################################### Constants
 
@@ -25,8 +30,8 @@ Lmax = 10. # maximal longitude (in deg)
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575 # logarithmic distance between two energy bins
-npix = 196608
-nside = healpy.npix2nside(npix)
+nside = int(options.nside)
+npix = healpy.nside2npix(nside)
 
 ###################################################################################################################### Load data and mask
 
@@ -35,9 +40,7 @@ mask_fn = '../../data/ps_masks/ps_mask_3FGL_small_nside128.npy'
 
 
 
-mask = np.load(mask_fn)
-if symmetrize_mask:
-    mask *= mask[::-1]
+mask = hlib.load_mask(mask_fn, nside, symmetrize=symmetrize_mask)             # Resampled if nside is not 128
 
     
 ###################################################################################################################### Select the region and group together pixels of the same region in the inds_dict
@@ -62,9 +65,13 @@ for option in ['small','large']:
 
 
     print 'calculate indices...'
-    inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins[option], Lbins, mask=np.ones(len(mask)))
+    index = hlib.pixel_index(nside)
+    inds_dict = {}
+    for b in xrange(nB):
+        for l in xrange(nL):
+            inds_dict[(b,l)] = index.rectangle(Bbins[option][b], Bbins[option][b+1], Lbins[l], Lbins[l+1])
     print "total pixels: ", len(inds_dict[(2,0)]), len(inds_dict[(2,1)])
-    print "unmasked pixels: ", np.sum(mask[pixel] for pixel in inds_dict[(2,0)]), np.sum(mask[pixel] for pixel in inds_dict[(2,1)])
+    print "unmasked pixels: ", np.sum(mask[inds_dict[(2,0)]]), np.sum(mask[inds_dict[(2,1)]])
 
 ###################################################################################################################### Calculate differential flux in each pixel, sum over pixels in one lat-lon bin, calculate std
 
@@ -73,7 +80,7 @@ for option in ['small','large']:
     
     for b in xrange(nB):
         for l in xrange(nL):
-            fraction_dct[option][(b,l)] = 1 - (np.sum(mask[pixel] for pixel in inds_dict[(b,l)]) / len(inds_dict[(b,l)]))
+            fraction_dct[option][(b,l)] = 1 - (np.sum(mask[inds_dict[(b,l)]]) / len(inds_dict[(b,l)]))
 
 
         
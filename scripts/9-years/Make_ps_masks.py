@@ -0,0 +1,85 @@
+""" Makes point source masks from a Fermi-LAT catalog (3FGL, 4FGL) at any nside with healpylib.ps_mask. The radii are either constant, or depend on the flux of the sources (Gaussian PSF), or on the flux and the energy (one mask per energy bin, shape (nE, npix)) """
+
+
+import time
+import numpy as np
+import pyfits
+import healpy
+import healpylib as hlib
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-c", "--catalog", dest="catalog", default='../../data/Fermi_3FGL_catalog/gll_psc_v16.fit', help="fits file of the catalog")
+parser.add_option("-C", "--cat_name", dest="cat_name", default='3FGL', help="name of the catalog in the mask file names")
+parser.add_option("-m", "--mask_name", dest="mask_name", default='r1deg', help="name of the mask in the file names")
+parser.add_option("-n", "--nsides", dest="nsides", default='128', help="comma separated healpix nside parameters")
+parser.add_option("-r", "--radius", dest="radius", default='1.', help="mask radius (deg), minimal radius for flux dependent radii")
+parser.add_option("-R", "--rmax", dest="rmax", default='5.', help="maximal radius for flux dependent radii (deg)")
+parser.add_option("-f", "--flux_min", dest="flux_min", default='0.', help="only sources with Flux1000 > flux_min (ph/(cm^2 s)) are masked")
+parser.add_option("-t", "--flux_thres", dest="flux_thres", default='0.', help="intensity threshold (ph/(cm^2 s sr)) for flux dependent radii, 0: constant radius")
+parser.add_option("-p", "--theta68", dest="theta68", default='0.6', help="68% containment radius of the PSF (deg) for flux dependent radii")
+parser.add_option("-E", "--energy", dest="energy", action="store_true", default=False, help="energy dependent masks in the 24 energy bins, requires flux_thres > 0")
+parser.add_option("-o", "--output", dest="output", default='../../data/ps_masks/', help="folder of the masks")
+
+(options, args) = parser.parse_args()
+
+nsides = [int(nside) for nside in str(options.nsides).split(',')]
+radius = np.deg2rad(float(options.radius))
+rmax = np.deg2rad(float(options.rmax))
+flux_min = float(options.flux_min)
+flux_thres = float(options.flux_thres)
+if options.energy and flux_thres <= 0.:
+    parser.error('--energy needs an intensity threshold for the energy dependent radii, e.g. -t 1.e-7 (with flux_thres = 0 all radii are equal to the minimal radius)')
+
+
+###################################################################################################################### Constants
+
+
+Ebins = 0.1 * np.exp(0.3837641821164575 * np.arange(25))                             # edges of the 24 energy bins (GeV)
+
+# 68% containment radii (deg) of the PSF in the 24 energy bins (PSF_calculator.ipynb)
+theta_68 = np.array([4., 3.2, 2.7, 2.2, 1.2, 1., 0.7, 0.6, 0.4, 0.3, 0.22, 0.2, 0.13, 0.12, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1])
+
+
+###################################################################################################################### Catalog
+
+
+t0 = time.time()
+data = pyfits.open(options.catalog)[1].data
+index_name = 'PowerLaw_Index' if 'PowerLaw_Index' in data.names else 'PL_Index'                 # 3FGL or 4FGL
+flux = np.array(data.field('Flux1000'), dtype=np.float64)                                        # 1 - 100 GeV
+select = np.isfinite(flux) & (flux > flux_min)
+bs = np.deg2rad(np.array(data.field('GLAT'), dtype=np.float64))[select]
+ls = np.deg2rad(np.array(data.field('GLON'), dtype=np.float64))[select]
+flux = flux[select]
+gamma = np.array(data.field(index_name), dtype=np.float64)[select]
+print '%i of %i sources' % (len(flux), len(select))
+
+if options.energy:
+    # flux in the energy bins from the power law normalized to Flux1000
+    norm = flux / (1. - 100.**(1. - gamma))
+    fluxes = norm[:, np.newaxis] * (Ebins[:-1]**(1. - gamma[:, np.newaxis]) - Ebins[1:]**(1. - gamma[:, np.newaxis]))
+    radii = hlib.psf_mask_radius(fluxes, np.deg2rad(theta_68), flux_thres, rmin=radius, rmax=rmax)
+elif flux_thres > 0.:
+    radii = hlib.psf_mask_radius(flux, np.deg2rad(float(options.theta68)), flux_thres, rmin=radius, rmax=rmax)
+else:
+    radii = radius * np.ones(len(flux))
+print 'radii (deg): %.2f - %.2f' % (np.rad2deg(radii.min()), np.rad2deg(radii.max()))
+
+
+###################################################################################################################### Masks
+
+
+for nside in nsides:
+    t1 = time.time()
+    mask = hlib.ps_mask(nside, bs, ls, radii)
+    fn = options.output + 'ps_mask_%s_%s_nside%i.npy' % (options.cat_name, options.mask_name, nside)
+    np.save(fn, mask)
+    print 'save mask to file:'
+    print fn
+    print 'nside %i: masked fraction %.4f, time %.2f s' % (nside, np.mean(mask == 0), time.time() - t1)
+
+print 'total time: %.2f s' % (time.time() - t0)
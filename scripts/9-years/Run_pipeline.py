@@ -0,0 +1,97 @@
+""" Runs the analysis (Save_*_fits -> Calc_dct -> SED fits -> SED plots) for the chosen data classes and low-energy ranges. Only the stages with changed inputs, code or options are executed (see pipeline.py) """
+
+
+import dct_engine
+import pipeline
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-c", "--data_class", dest = "data_class", default = "source,ultraclean", help="comma separated data classes (source, ultraclean)")
+parser.add_option("-E", "--lowE_range", dest="lowE_range", default='0,1,2,3', help="comma separated low-energy ranges: 0: (3,5), 1: (3,3), 2: (4,5), 3: (6,7)")
+parser.add_option("-i", "--input_data", dest="input_data", default='lowE,boxes', help="comma separated models for the SED fits (data, lowE, boxes, GALPROP)")
+parser.add_option("-p", "--nproc", dest="nproc", default='1', help="number of stages which run in parallel")
+parser.add_option("-s", "--stages", dest="stages", default='', help="comma separated name patterns of the stages to run, e.g. 'sed_lowE_*' (the stages upstream are included)")
+parser.add_option("-f", "--force", dest="force", default='', help="comma separated name patterns of the stages which are executed even if they are up to date")
+parser.add_option("-n", "--dry_run", dest="dry_run", action="store_true", default=False, help="only print the stale stages")
+
+(options, args) = parser.parse_args()
+
+data_classes = str(options.data_class).split(',')
+lowE_range_list = [int(r) for r in str(options.lowE_range).split(',')]
+input_data_list = str(options.input_data).split(',')
+nproc = int(options.nproc)
+targets = [pat for pat in str(options.stages).split(',') if pat]
+force = [pat for pat in str(options.force).split(',') if pat]
+
+
+####################################################################################################################### Code dependencies
+
+
+lib_code = ['healpylib.py', 'dio.py']
+map_code = lib_code + ['poisson_fit.py', 'smoothing.py', 'cube_cache.py', 'stream_maps.py', 'skymap_io.py']
+dct_code = lib_code + ['Calc_dct_all.py', 'dct_engine.py', 'profiles.py', 'cube_cache.py']
+sed_code = lib_code + ['gamma_spectra.py', 'auxil.py']
+ISRF_fns = '../../data/ISRF_flux/Standard_0_0_*_Flux.fits.gz'
+
+
+###################################################################################################################### Declare the stages
+
+
+pipe = pipeline.Pipeline('9-years')
+dct_kinds = ['data', 'expo'] + [kind for kind in ['GALPROP', 'lowE', 'boxes'] if kind in input_data_list]
+
+for lowE_range in lowE_range_list:
+    erange = dct_engine.lowE_ranges[lowE_range] + 'GeV'
+    dct_dir = 'dct/Low_energy_range%i/' % lowE_range
+    plot_dct_dir = 'plot_dct/Low_energy_range%i/' % lowE_range
+    plot_dir = '../../plots/Plots_9-year/Low_energy_range%i/' % lowE_range
+    for data_class in data_classes:
+        tag = '_%s_%i' % (data_class, lowE_range)
+        data_inputs = [dct_engine.counts_fns[data_class], dct_engine.expo_fns[data_class], dct_engine.mask_fns['small']]
+
+        # 1) maps of the lowE and the boxes models
+        if 'lowE' in input_data_list:
+            pipe.add('save_lowE' + tag, ['Save_lowE_res_fits.py', '-c', data_class, '-E', str(lowE_range)],
+                     inputs=data_inputs + map_code + ['Save_lowE_res_fits.py'],
+                     outputs=['fits/LowE_%s%s_%s_%s.fits' % (model, erange, fmt, data_class)
+                              for model in ['', 'model_'] for fmt in ['counts', 'flux']]
+                             + ['fits/LowE_%s_%s.yaml' % (erange, data_class)])
+        if 'boxes' in input_data_list:
+            pipe.add('save_boxes' + tag, ['Save_boxes_fits.py', '-c', data_class, '-E', str(lowE_range)],
+                     inputs=data_inputs + map_code + ['Save_boxes_fits.py'],
+                     outputs=['fits/Boxes_%s%s_%s_%s.fits' % (model, erange, fmt, data_class)
+                              for model in ['', 'residual_', 'residual+boxes_', 'model_'] for fmt in ['counts', 'flux']]
+                             + ['fits/Boxes_%s_%s.yaml' % (erange, data_class)])
+
+        # 2) lat-lon profile dictionaries
+        for kind in dct_kinds:
+            prods = dct_engine.default_products([data_class], [lowE_range], kinds=[kind])
+            inputs = set()
+            for prod in prods:
+                inputs.update([fn for fn in [prod['map_fn'], prod['expo_fn'], prod['counts_fn'], prod['mask_fn']] if fn is not None])
+            pipe.add('dct_' + kind + tag, ['Calc_dct_all.py', '-c', data_class, '-E', str(lowE_range), '-k', kind],
+                     inputs=sorted(inputs) + dct_code, outputs=[prod['dct_fn'] for prod in prods])
+
+        # 3) SED fits and 4) SED plots
+        for input_data in input_data_list:
+            dct_inputs = [dct_dir + 'dct_%s_counts_%s.yaml' % (input_data, data_class),
+                          dct_dir + 'dct_expo_%s.yaml' % data_class,
+                          'dct/Low_energy_range0/dct_data_counts_%s.yaml' % data_class]
+            fit_fns = plot_dct_dir + '%s_%s_*.yaml' % (input_data, data_class)
+            pipe.add('sed_' + input_data + tag,
+                     ['Plot_SED_loop_likelihood.py', '-c', data_class, '-E', str(lowE_range), '-i', input_data, '-o', 'True'],
+                     inputs=dct_inputs + [ISRF_fns] + sed_code + ['Plot_SED_loop_likelihood.py'],
+                     outputs=[fit_fns])
+            pipe.add('plot_' + input_data + tag,
+                     ['Read_SED_loop_likelihood.py', '-c', data_class, '-E', str(lowE_range), '-i', input_data, '-o', 'True'],
+                     inputs=dct_inputs[:2] + [fit_fns] + sed_code + ['Read_SED_loop_likelihood.py'],
+                     outputs=[plot_dir + 'SED_%s_%s_*cutoff.pdf' % (input_data, data_class)])
+
+
+###################################################################################################################### Run
+
+
+pipe.run(nproc=nproc, targets=targets, force=force, dry_run=options.dry_run)
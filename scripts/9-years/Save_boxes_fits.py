@@ -8,10 +8,14 @@ Smoothed: High-energy data 0.4 to 1.4 degree Gaussian kernel (depending on low-e
 """
 
 import numpy as np
-import pyfits
 import healpy
 import healpylib as hlib
+import smoothing
+import cube_cache
+import stream_maps
+import skymap_io
 from iminuit import Minuit
+import poisson_fit
 from optparse import OptionParser
 from matplotlib import pyplot
 import dio
@@ -22,10 +26,12 @@ import dio
 parser = OptionParser()
 parser.add_option("-c", "--data_class", dest = "data_class", default = "source", help="data class (source or ultraclean)")
 parser.add_option("-E", "--lowE_range", dest="lowE_range", default='0', help="There are 3 low-energy ranges: (3,5), (3,3), (4,5), (6,7)")
+parser.add_option("-s", "--streaming", dest="streaming", action="store_true", default=False, help="one energy bin at a time, the planes are written to memory maps in fits/")
 (options, args) = parser.parse_args()
 
 data_class = str(options.data_class)
 lowE_range = int(options.lowE_range) # 0: baseline, 4: test
+streaming = options.streaming
 
 ############################################################################################################################ Constants
 
@@ -40,6 +46,7 @@ smooth_sigma = (1., 1.41, 0.65, 0.4, 1.)[lowE_range] #  1.25
 mask_point_sources = True                    # Is used in the calculate_indices function
 smooth_highE_data = True
 symmetrize_mask = True
+vectorized_fit = True                        # False: Minuit fit in each latitude stripe separately (only the two boxes)
 
 dL = 20.
 dB = 4.
@@ -48,8 +55,6 @@ Bmax = 90.
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575          # Logarithmic size of one energy bin, in fits header "Step in energy (log)"
-npix = 196608                       # Numer of Healpix pixels
-nside = healpy.npix2nside(npix)     # Side parameter of Healpy projection
 
 
 ########################################################################################################################### Load data from a fits file
@@ -67,17 +72,14 @@ else:
     
 mask_fn = '../../data/ps_masks/ps_mask_3FGL_small_nside128.npy'                                                                       # Small mask
 
-hdu = pyfits.open(map_fn)
-data = hdu[1].data.field('Spectra').T  # data.T.shape = (nE, npix)
-Es = hdu[2].data.field('MeV') / GeV2MeV
-hdu_expo = pyfits.open(expo_fn)
-expo = hdu_expo[1].data.field('Spectra').T
+data, Es = cube_cache.load(map_fn)                                         # data.shape = (nE, npix), Es in GeV
+expo = cube_cache.load(expo_fn)[0]
+npix = data.shape[-1]                                                      # Number of Healpix pixels, read from the input map
+nside = healpy.npix2nside(npix)                                            # Side parameter of Healpy projection
 
 mask = np.ones(npix)
 if mask_point_sources:
-    mask = np.load(mask_fn)
-    if symmetrize_mask:
-        mask *= mask[::-1]
+    mask = hlib.load_mask(mask_fn, nside, symmetrize=symmetrize_mask)         # Resampled if the map is not nside 128
 
 ########################################################################################################################### Choose the region
 
@@ -107,172 +109,129 @@ class likelihood: # fct = sum over pixel in one lat stripe: k * low + c - high *
         return fct
 
 
-########################################################################################################################### Sum over all energy bins
+########################################################################################################################### Low-energy template
 
 
 Es_high = Es[binmin_high:binmax_high+1]                                                      # energy bins of the high-energy range
-data_high = data[binmin_high:binmax_high+1]
-expo_high = expo[binmin_high:binmax_high+1]
+low_map = np.mean(data[binmin_low:binmax_low + 1]/expo[binmin_low:binmax_low + 1], axis=0)   # low-energy data / exposure, shape: (npix,)
 
-data_low = np.mean(data[binmin_low:binmax_low + 1]/expo[binmin_low:binmax_low + 1], axis=0) * expo_high # shape: (nE, npix)
+emax_low = Es[binmax_low] * np.exp(delta/2)
+emin_low = Es[binmin_low] * np.exp(-delta/2)
 
+dOmega = 4. * np.pi / npix
+deltaE = Es_high * (np.exp(delta/2) - np.exp(-delta/2))
 
-if smooth_highE_data:
-    for E in xrange(nE):
-        data_high[E] = np.array(hlib.heal(data_high[E], mask), dtype = np.float64)
-        data_high[E] = healpy.smoothing(data_high[E], sigma = np.deg2rad(smooth_sigma)) # High-energy data is smoothed to compensate PSF
 
-        
-########################################################################################################################### Fit low to high energy data
+########################################################################################################################### Fit low to high energy data, one energy bin at a time
         
 
 print 'calculate indices...'
 inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins, Lbins, mask=mask)                # generates dictionary of lat-lon bins, masked pixels not included
 
 k = 0.04                                                                                # Initial proportionality factor
-k_array = np.zeros((nB, nE))
 c = 1.e-13                                                                              # initial isotropic-background factor
-c_array = np.zeros((nB, nE))
-
-box_l_map = np.zeros(npix)
-box_r_map = np.zeros(npix)
 
-for b in xrange(nB):
-    for l in xrange(nL):
-        if Lc[l] == -10:
-            for pixel in inds_dict[(b,l)]:
-                box_r_map[pixel] = 1
-        elif Lc[l] == 10:
-            for pixel in inds_dict[(b,l)]:
-                box_l_map[pixel] = 1
-                                
-
-b_l_array = np.zeros((nB, nE)) # b_l: constant box parameter left
-b_r_array = np.zeros((nB, nE)) # b_r: constant box parameter right
+ib_labels, il_labels = hlib.inds_dict2labels(inds_dict, npix)                           # Lat and lon index of each pixel, -1: masked
+box_r_map = 1. * (il_labels == list(Lc).index(-10))
+box_l_map = 1. * (il_labels == list(Lc).index(10))
+
+# Templates fitted in addition to the low-energy model (k) and the isotropic background (c): (name, map, initial value, limits)
+# e.g. a jet: ('jet', hlib.jet_template(nside, 40., 5., 90.), 1., (0., 100.))
+extra_templates = [('b_l', box_l_map, 1., (0., 100.)),                                 # b_l: constant box parameter left
+                   ('b_r', box_r_map, 1., (0., 100.))]                                 # b_r: constant box parameter right
+extra_names = [name for name, tmpl, p0, limits in extra_templates]
+extra_maps = [tmpl for name, tmpl, p0, limits in extra_templates]
+
+store_key = None
+if streaming:                                                              # the key is only needed to resume a streaming run
+    store_key = stream_maps.run_key({'data_class': data_class, 'lowE_range': lowE_range, 'smooth_sigma': smooth_sigma, 'mask_point_sources': mask_point_sources,
+                                     'smooth_highE_data': smooth_highE_data, 'symmetrize_mask': symmetrize_mask, 'vectorized_fit': vectorized_fit},
+                                    [__file__, map_fn, expo_fn, mask_fn, 'healpylib.py', 'smoothing.py', 'poisson_fit.py',
+                                     'stream_maps.py', 'skymap_io.py', 'cube_cache.py'])   # changed runs are not resumed
+store = stream_maps.PlaneStore('fits/Boxes_%.1f' %emin_low + '-%.1fGeV_' %emax_low + data_class + fn_extra,
+                               ['boxes_map', 'boxes_flux', 'resid_counts', 'resid_flux', 'resid_boxes_counts',
+                                'resid_boxes_flux', 'model', 'model_flux'], nE, npix, streaming=streaming, key=store_key)
 
 for E in xrange(nE):
-    for b in xrange(nB):                                                               # Concatenate all pixels of one latitude stripe
-
-        x = np.concatenate([np.asarray([data_high[E][pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        y = np.concatenate([np.asarray([data_low[E][pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        box_l = np.concatenate([np.asarray([box_l_map[pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        box_r = np.concatenate([np.asarray([box_r_map[pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        expo_c = np.concatenate([np.asarray([expo_high[E][pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        
-        fit = likelihood(x,y,box_l,box_r,expo_c)                                               # Fit model = (lowE * k + c) to highE
-        m = Minuit(fit, k = k, c = c,  b_l = 1., b_r = 1., limit_k = (0,1), limit_c = (1e-16,1e-10), limit_b_l = (0., 100.), limit_b_r = (0., 100.), error_k = 0.1, error_c = 0.1, error_b_l = 0.01, error_b_r = 0.01, errordef = 0.1)
-        m.migrad()                                                                     # Limits of parameters k and c are important
-        
-        k_array[b,E] = m.values['k']
-        c_array[b,E] = m.values['c']
-        b_l_array[b,E] = m.values['b_l']
-        b_r_array[b,E] = m.values['b_r']
-        
+    if store.done(E):
+        continue
+    data_high = np.array(data[binmin_high + E], dtype = np.float64)
+    expo_high = np.array(expo[binmin_high + E], dtype = np.float64)
+    data_low = low_map * expo_high
+
+    if smooth_highE_data:
+        data_high = hlib.heal(data_high, mask)
+        data_high = smoothing.smooth_cube(data_high, sigma = np.deg2rad(smooth_sigma)) # High-energy data is smoothed to compensate PSF
+
+    if vectorized_fit:                                                                 # All latitude stripes and templates are fitted at once
+        p, cov = poisson_fit.fit_templates(data_high, [data_low, expo_high] + extra_maps, ib_labels, nlab=nB,
+                                           p0=[k, c] + [p0 for name, tmpl, p0, limits in extra_templates],
+                                           bounds=[(0,1), (1e-16,1e-10)] + [limits for name, tmpl, p0, limits in extra_templates],
+                                           errordef=0.1)
+        pars = dict([(name, p[:,i]) for i, name in enumerate(['k', 'c'] + extra_names)])
         print 'E = ' + str(Es_high[E])
-        print 'b = ' + str(Bc[b])
+    else:
+        pars = dict([(key, np.zeros(nB)) for key in ['k', 'c', 'b_l', 'b_r']])
+        for b in xrange(nB):                                                           # All pixels of one latitude stripe
+            stripe = (ib_labels == b)
+            x = data_high[stripe]
+            y = data_low[stripe]
+            box_l = box_l_map[stripe]
+            box_r = box_r_map[stripe]
+            expo_c = expo_high[stripe]
 
+            fit = likelihood(x,y,box_l,box_r,expo_c)                                           # Fit model = (lowE * k + c) to highE
+            m = Minuit(fit, k = k, c = c,  b_l = 1., b_r = 1., limit_k = (0,1), limit_c = (1e-16,1e-10), limit_b_l = (0., 100.), limit_b_r = (0., 100.), error_k = 0.1, error_c = 0.1, error_b_l = 0.01, error_b_r = 0.01, errordef = 0.1)
+            m.migrad()                                                                 # Limits of parameters k and c are important
 
-############################################################################################################################ Calculate residual
+            for key in pars:
+                pars[key][b] = m.values[key]
 
-model = np.zeros((nE, npix))
-boxes_map = np.zeros((nE, npix))        
-        
-for E in xrange(nE):
-    for b in xrange(nB):
-        for l in xrange(nL):
-            for pixel in inds_dict[(b,l)]:
-                boxes_map[E, pixel] = box_l_map[pixel] * b_l_array[b,E] + box_r_map[pixel] * b_r_array[b,E]  # Boxes
-                model[E,pixel] = k_array[b,E] * data_low[E,pixel] + c_array[b,E] * expo_high[E,pixel]        # Model without boxes
-                                                    
-resid_counts = data_high - model - boxes_map                                                                            # Residual + boxes
-resid_boxes_counts = data_high - model
+            print 'E = ' + str(Es_high[E])
+            print 'b = ' + str(Bc[b])
 
-dOmega = 4. * np.pi / npix
-deltaE = Es_high * (np.exp(delta/2) - np.exp(-delta/2))
+    boxes_map = poisson_fit.region_model([pars[name][:,np.newaxis] for name in extra_names], extra_maps, ib_labels, E=0)  # Boxes (and other extra templates)
+    model = poisson_fit.region_model([pars['k'][:,np.newaxis], pars['c'][:,np.newaxis]], [data_low, expo_high], ib_labels, E=0)            # Model without boxes
 
-boxes_flux = np.zeros((nE, npix))
-resid_flux = np.zeros((nE, npix))
-resid_boxes_flux = np.zeros((nE, npix))
-model_flux = np.zeros((nE, npix))
-for E in xrange(nE):
-    boxes_flux[E] = mask * (Es_high[E]**2 * boxes_map[E]) / (deltaE[E] * expo_high[E] * dOmega)           # Differential flux
-    resid_flux[E] = mask * (Es_high[E]**2 * resid_counts[E]) / (deltaE[E] * expo_high[E] * dOmega)
-    resid_boxes_flux[E] = mask * (Es_high[E]**2 * resid_boxes_counts[E]) / (deltaE[E] * expo_high[E] * dOmega)
-    model_flux[E] = mask * (Es_high[E]**2 * model[E]) / (deltaE[E] * expo_high[E] * dOmega)               
-
-
-############################################################################################################################ Function to save fits files (auxil.py)
-
-def hmap2skymap(values, fn=None, unit=None, kdict=None, comment=None, Es=None, Eunit='GeV'):
-    hdulist = [pyfits.PrimaryHDU()]
-
-    clms = []
-    npix, nval = values.shape
-    fmt = '%iE' % nval
-    clm = pyfits.Column(name='Spectra', array=values,
-                        format=fmt, unit=unit)
-    clms.append(clm)
-    dhdu = pyfits.new_table(clms)
-    dhdu.name = 'SKYMAP'
-    nside = healpy.npix2nside(npix)
-    dhdu.header.update('PIXTYPE', 'HEALPIX')
-    dhdu.header.update('ORDERING', 'RING')
-    dhdu.header.update('NSIDE', nside)
-    dhdu.header.update('FIRSTPIX', 0)
-    dhdu.header.update('LASTPIX', (npix - 1))
-    dhdu.header.update('NBRBINS', nval, 'Number of energy bins')
-    dhdu.header.update('EMIN', Es_high[0], 'Minimum energy')
-    dhdu.header.update('DELTAE', delta, 'Step in energy (log)')
-
-    hdulist.append(dhdu)
-
-    # create energy HDU
-    if Es is not None:       
-        clm = pyfits.Column(name=Eunit, array=Es, format='E', unit=Eunit)
-        ehdu = pyfits.new_table([clm])
-        ehdu.name = 'ENERGIES'
-        hdulist.append(ehdu)
-    
-    hdulist = pyfits.HDUList(hdulist)
+    resid_counts = data_high - model - boxes_map                                                   # Residual
+    resid_boxes_counts = data_high - model                                                         # Residual + boxes
 
-    print 'Save skymap to file:'
-    print fn
-        
-    hdulist.writeto(fn)
+    flux_factor = mask * Es_high[E]**2 / (deltaE[E] * dOmega) / expo_high                         # Differential flux
+    store.write(E, {'boxes_map': boxes_map, 'boxes_flux': flux_factor * boxes_map,
+                    'resid_counts': resid_counts, 'resid_flux': flux_factor * resid_counts,
+                    'resid_boxes_counts': resid_boxes_counts, 'resid_boxes_flux': flux_factor * resid_boxes_counts,
+                    'model': model, 'model_flux': flux_factor * model}, pars=pars)
 
-    return None
+k_array = store.pars('k')                                                                          # shape: (nB, nE)
+c_array = store.pars('c')
+extra_arrays = dict([(name, store.pars(name)) for name in extra_names])                          # e.g. b_l, b_r: constant box parameters
 
 
 ############################################################################################################################ Save residual flux as fits file
 
-emax_low = Es[binmax_low] * np.exp(delta/2)
-emin_low = Es[binmin_low] * np.exp(-delta/2)
-
-
-
 fits_fn = 'fits/Boxes_%.1f' %emin_low + '-%.1fGeV_counts_' %emax_low + data_class + fn_extra  + '.fits'
-skymap = hmap2skymap(boxes_map.T, fits_fn, unit = 'counts_', Es = Es_high)
+skymap_io.write_cube(fits_fn, store.cubes['boxes_map'], unit = 'counts_', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_fn = 'fits/Boxes_%.1f' %emin_low + '-%.1fGeV_flux_' %emax_low + data_class + fn_extra  + '.fits'
-skymap = hmap2skymap(boxes_flux.T, fits_fn, unit = 'GeV/(cm^2 s sr)', Es = Es_high)
+skymap_io.write_cube(fits_fn, store.cubes['boxes_flux'], unit = 'GeV/(cm^2 s sr)', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_resid_counts_fn = 'fits/Boxes_residual_%.1f' %emin_low + '-%.1fGeV_counts_' %emax_low + data_class + fn_extra  + '.fits'
-skymap_resid_counts = hmap2skymap(resid_counts.T, fits_resid_counts_fn, unit = 'counts_', Es = Es_high)
+skymap_io.write_cube(fits_resid_counts_fn, store.cubes['resid_counts'], unit = 'counts_', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_resid_flux_fn = 'fits/Boxes_residual_%.1f' %emin_low + '-%.1fGeV_flux_' %emax_low + data_class + fn_extra  + '.fits'
-skymap_resid_flux = hmap2skymap(resid_flux.T, fits_resid_flux_fn, unit = 'GeV/(cm^2 s sr)', Es = Es_high)
+skymap_io.write_cube(fits_resid_flux_fn, store.cubes['resid_flux'], unit = 'GeV/(cm^2 s sr)', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_resid_boxes_counts_fn = 'fits/Boxes_residual+boxes_%.1f' %emin_low + '-%.1fGeV_counts_' %emax_low + data_class + fn_extra  + '.fits'
-skymap_resid_boxes_counts = hmap2skymap(resid_boxes_counts.T, fits_resid_boxes_counts_fn, unit = 'counts_', Es = Es_high)
+skymap_io.write_cube(fits_resid_boxes_counts_fn, store.cubes['resid_boxes_counts'], unit = 'counts_', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_resid_boxes_flux_fn = 'fits/Boxes_residual+boxes_%.1f' %emin_low + '-%.1fGeV_flux_' %emax_low + data_class + fn_extra  + '.fits'
-skymap_resid_boxes_flux = hmap2skymap(resid_boxes_flux.T, fits_resid_boxes_flux_fn, unit = 'GeV/(cm^2 s sr)', Es = Es_high)
+skymap_io.write_cube(fits_resid_boxes_flux_fn, store.cubes['resid_boxes_flux'], unit = 'GeV/(cm^2 s sr)', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_fn_model = 'fits/Boxes_model_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_counts_' + data_class + fn_extra  + '.fits'
-skymap_model = hmap2skymap(model.T, fits_fn_model, unit = 'counts', Es = Es_high)
+skymap_io.write_cube(fits_fn_model, store.cubes['model'], unit = 'counts', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_fn_modelflux = 'fits/Boxes_model_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_flux_' + data_class + fn_extra  + '.fits'
-skymap_modelflux = hmap2skymap(model_flux.T, fits_fn_modelflux, unit = 'GeV/(cm^2 s sr)', Es = Es_high)
+skymap_io.write_cube(fits_fn_modelflux, store.cubes['model_flux'], unit = 'GeV/(cm^2 s sr)', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 
 ############################################################################################################################ Save parameters in dictionary
@@ -284,8 +243,9 @@ dct['smooth_sigma'] = smooth_sigma
 dct['shape_arrays (nB,nE)'] = c_array.shape
 dct['Bc'] = Bc
 dct['Es_high'] = Es_high
-dct['b_l_array'] = b_l_array
-dct['b_r_array'] = b_r_array
+for name in extra_names:
+    dct[name + '_array'] = extra_arrays[name]
 
 dct_fn = 'fits/Boxes_%.1f' %emin_low + '-%.1fGeV_' %emax_low + data_class + fn_extra + '.yaml'
 dio.saveyaml(dct, dct_fn, expand = True)
+store.cleanup()                                                                                    # delete the memory maps of the streaming mode
@@ -9,10 +9,14 @@ Smoothed: High-energy data 0.4 to 1.4 degree Gaussian kernel (depending on low-e
 """
 
 import numpy as np
-import pyfits
 import healpy
 import healpylib as hlib
+import smoothing
+import cube_cache
+import stream_maps
+import skymap_io
 from iminuit import Minuit
+import poisson_fit
 from optparse import OptionParser
 from matplotlib import pyplot
 import dio
@@ -24,10 +28,15 @@ import dio
 parser = OptionParser()
 parser.add_option("-c", "--data_class", dest = "data_class", default = "source", help="data class (source or ultraclean)")
 parser.add_option("-E", "--lowE_range", dest="lowE_range", default='0', help="There are 3 low-energy ranges: (3,5), (3,3), (4,5), (6,7)")
+parser.add_option("-s", "--streaming", dest="streaming", action="store_true", default=False, help="one energy bin at a time, the planes are written to memory maps in fits/")
+parser.add_option("-g", "--smooth_sigma", dest="smooth_sigma", default='', help="Gaussian smoothing of the high-energy data in deg, default: depends on the low-energy range")
+parser.add_option("-a", "--cache_alms", dest="cache_alms", action="store_true", default=False, help="read and save the alms of the healed high-energy planes in the cache directory (shared by the runs of Sweep_lowE.py)")
 (options, args) = parser.parse_args()
 
 data_class = str(options.data_class)
 lowE_range = int(options.lowE_range) # 0: baseline, 4: test
+streaming = options.streaming
+cache_alms = options.cache_alms
 
 ############################################################################################################################ Constants
 
@@ -39,11 +48,15 @@ if lowE_range ==4:
 binmin_low, binmax_low = ((3,5), (3,3), (4,5), (6,7), (3,5))[lowE_range]
 binmin_high, binmax_high = ((6,23), (6,23), (6,23), (8,23),(10,11))[lowE_range]
 smooth_sigma = (1., 1.41, 0.65, 0.4, 1.)[lowE_range] #  1.25
+if options.smooth_sigma and float(options.smooth_sigma) != smooth_sigma:
+    smooth_sigma = float(options.smooth_sigma)
+    fn_extra += "_sigma%.2f" % smooth_sigma      # the default smoothing keeps the original file names
 
 exclude_bubbles_from_fit = True              # True --> No overcompensation of hard emission --> residual in ROI is larger
 mask_point_sources = True                    # Is used in the calculate_indices function
 smooth_highE_data = True
 symmetrize_mask = True
+vectorized_fit = True                        # False: Minuit fit in each latitude stripe separately
 
 dL = 20.
 dB = 4.
@@ -52,8 +65,6 @@ Bmax = 90.
 
 GeV2MeV = 1000.
 delta = 0.3837641821164575          # Logarithmic size of one energy bin, in fits header "Step in energy (log)"
-npix = 196608                       # Number of Healpix pixels
-nside = healpy.npix2nside(npix)     # Side parameter of Healpy projection
 
 
 ########################################################################################################################### Load data from a fits file
@@ -70,18 +81,15 @@ else:
 
 mask_fn = '../../data/ps_masks/ps_mask_3FGL_small_nside128.npy'                                                                       # Small mask
 
-hdu = pyfits.open(map_fn)
-data = hdu[1].data.field('Spectra').T  # data.T.shape = (nE, npix)
-Es = hdu[2].data.field('MeV') / GeV2MeV
-hdu_expo = pyfits.open(expo_fn)
-expo = hdu_expo[1].data.field('Spectra').T
+data, Es = cube_cache.load(map_fn)                                         # data.shape = (nE, npix), Es in GeV
+expo = cube_cache.load(expo_fn)[0]
+npix = data.shape[-1]                                                      # Number of Healpix pixels, read from the input map
+nside = healpy.npix2nside(npix)                                            # Side parameter of Healpy projection
 
 
 mask = np.ones(npix)
 if mask_point_sources:
-    mask = np.load(mask_fn)
-    if symmetrize_mask:
-        mask *= mask[::-1]
+    mask = hlib.load_mask(mask_fn, nside, symmetrize=symmetrize_mask)         # Resampled if the map is not nside 128
 
 ########################################################################################################################### Choose the region
 
@@ -114,152 +122,99 @@ class likelihood:                                                         # fct
         return fct
 
 
-########################################################################################################################### Sum over all energy bins
+########################################################################################################################### Low-energy template
 
 
 Es_high = Es[binmin_high:binmax_high+1]                                                      # Energy bins of the high-energy range
-data_high = data[binmin_high:binmax_high+1]
-expo_high = expo[binmin_high:binmax_high+1]  
+low_map = np.mean(data[binmin_low:binmax_low + 1]/expo[binmin_low:binmax_low + 1], axis=0)   # Low-energy data / exposure, shape: (npix,)
 
-data_low = np.mean(data[binmin_low:binmax_low + 1]/expo[binmin_low:binmax_low + 1], axis=0) * expo_high # shape: (nE, npix)
- 
-#vmax=500
-#rescaling = np.sum(data_low[0])/np.sum(data_high[0])
-#healpy.mollview(data_high[0], title='no smoothing', min=0, max=vmax)
-
-if smooth_highE_data:
-    for E in xrange(nE):
-        data_high[E] = np.array(hlib.heal(data_high[E], mask), dtype = np.float64)
-        data_high[E] = healpy.smoothing(data_high[E], sigma = np.deg2rad(smooth_sigma))               # High-energy data is smoothed to compensate for the PSF
-
-
-#model = data_low[0]/rescaling
-#healpy.mollview(model, title='model', min=0, max=vmax)
+emax_low = Es[binmax_low] * np.exp(delta/2)
+emin_low = Es[binmin_low] * np.exp(-delta/2)
 
-#healpy.mollview(data_high[0], title='smoothed', min=0, max=vmax)
+dOmega = 4. * np.pi / npix
+deltaE = Es_high * (np.exp(delta/2) - np.exp(-delta/2))
 
-#healpy.mollview((data_high[0] - model), title='residual', min=-100, max=100)
 
-#pyplot.show()
+########################################################################################################################### Fit low to high energy data, one energy bin at a time
 
-        
-########################################################################################################################### Fit low to high energy data
-        
 
 print 'calculate indices...'
 inds_dict = hlib.lb_profiles_hinds_dict(nside, Bbins, Lbins, mask=mask) # Generates dictionary of lat-lon bins, masked pixels not included
+stripes = poisson_fit.stripe_labels(inds_dict, npix, nB, l_range)       # Latitude stripe of each pixel, -1: not in the fit
+ib_labels = hlib.inds_dict2labels(inds_dict, npix)[0]                   # Latitude index of each pixel, -1: masked
 
 k = 0.04                                                                # Initial proportionality factor
-k_array = np.zeros((nB, nE))
 c = 1.e-13                                                              # Initial isotropic-background factor
-c_array = np.zeros((nB, nE))
 
-#expo_mean = np.zeros((nB,nE))
-#for E in range(nE):
-#    for b in range(nB):
-#                expo_mean[b,E] += np.mean(np.mean(expo_high[E,pixel] for pixel in inds_dict[(b,l)]) for l in range(nL)) 
+store_key = None
+if streaming:                                                              # the key is only needed to resume a streaming run
+    store_key = stream_maps.run_key({'data_class': data_class, 'lowE_range': lowE_range, 'smooth_sigma': smooth_sigma, 'mask_point_sources': mask_point_sources,
+                                     'smooth_highE_data': smooth_highE_data, 'symmetrize_mask': symmetrize_mask, 'vectorized_fit': vectorized_fit,
+                                     'exclude_bubbles_from_fit': exclude_bubbles_from_fit},
+                                    [__file__, map_fn, expo_fn, mask_fn, 'healpylib.py', 'smoothing.py', 'poisson_fit.py',
+                                     'stream_maps.py', 'skymap_io.py', 'cube_cache.py'])   # changed runs are not resumed
+store = stream_maps.PlaneStore('fits/LowE_%.1f' %emin_low + '-%.1fGeV_' %emax_low + data_class + fn_extra,
+                               ['resid_counts', 'resid_flux', 'model', 'model_flux'], nE, npix, streaming=streaming, key=store_key)
 
 for E in xrange(nE):
-    for b in xrange(nB):                                                # Concatenate all pixels of one latitude stripe
+    if store.done(E):
+        continue
+    data_high = np.array(data[binmin_high + E], dtype = np.float64)
+    expo_high = np.array(expo[binmin_high + E], dtype = np.float64)
+    data_low = low_map * expo_high
+
+    if smooth_highE_data:
+        data_high = hlib.heal(data_high, mask)
+        alms = smoothing.cube_alms(data_high, use_cache=cache_alms)                                 # Only the alms are cached, they do not depend on smooth_sigma
+        bl = smoothing.sigma2beam(np.deg2rad(smooth_sigma), 3 * nside - 1)
+        data_high = smoothing.smooth_alms(alms, [bl], nside)[0]                                        # High-energy data is smoothed to compensate for the PSF
+
+    if vectorized_fit:                                                                             # All latitude stripes are fitted at once
+        k_E, c_E, k_err_E, c_err_E = poisson_fit.fit_kc(data_high, data_low, expo_high, stripes, nlab=nB, k0=k, c0=c,
+                                                        k_lim=(0,1), c_lim=(1e-16,1e-10), errordef=1.)
+    else:
+        k_E, c_E, k_err_E, c_err_E = np.zeros(nB), np.zeros(nB), np.zeros(nB), np.zeros(nB)
+        for b in xrange(nB):                                                                       # All pixels of one latitude stripe
+            x = data_high[stripes == b]
+            y = data_low[stripes == b]
+            expo_c = expo_high[stripes == b]
+
+            fit = likelihood(x,y, expo_c)                                                          # Fit model = (lowE * k + c) to highE
+            m = Minuit(fit, k = k, c = c, limit_k = (0,1), limit_c = (1e-16,1e-10), error_k = 0.1, error_c = 0.1, errordef = 1.)
+            m.migrad()                                                                             # Limits of parameters k and c are important
+
+            k_E[b], c_E[b] = m.values['k'], m.values['c']
+            k_err_E[b], c_err_E[b] = m.errors['k'], m.errors['c']
+
+    model = poisson_fit.region_model([k_E[:,np.newaxis], c_E[:,np.newaxis]], [data_low, expo_high], ib_labels, E=0)
+    resid_counts = data_high - model
+
+    flux_factor = mask * Es_high[E]**2 / (deltaE[E] * dOmega) / expo_high                         # Differential flux
+    store.write(E, {'resid_counts': resid_counts, 'resid_flux': flux_factor * resid_counts,
+                    'model': model, 'model_flux': flux_factor * model},
+                pars={'k': k_E, 'c': c_E, 'k_err': k_err_E, 'c_err': c_err_E})
+    print 'E = ' + str(Es_high[E])
+
+k_array = store.pars('k')                                                                          # shape: (nB, nE)
+c_array = store.pars('c')
+k_err_array = store.pars('k_err')
+c_err_array = store.pars('c_err')
 
-        x = np.concatenate([np.asarray([data_high[E][pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        y = np.concatenate([np.asarray([data_low[E][pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        expo_c = np.concatenate([np.asarray([expo_high[E][pixel] for pixel in inds_dict[(b,l)]]) for l in l_range])
-        
-        fit = likelihood(x,y, expo_c)                                                  # Fit model = (lowE * k + c) to highE
-        m = Minuit(fit, k = k, c = c, limit_k = (0,1), limit_c = (1e-16,1e-10), error_k = 0.1, error_c = 0.1, errordef = 1.)
-        m.migrad()                                                                     # Limits of parameters k and c are important
-        
-        k_array[b,E] = m.values['k']
-        c_array[b,E] = m.values['c']
-
-        print 'E = ' + str(Es_high[E])
-        print 'b = ' + str(Bc[b])
-
-
-
-############################################################################################################################ Calculate residual flux   
-
-model = np.zeros((nE, npix))        
-        
-for E in xrange(nE):
-    for b in xrange(nB):
-        for l in xrange(nL):
-            for pixel in inds_dict[(b,l)]:
-                model[E, pixel] = k_array[b,E] * data_low[E,pixel] + c_array[b,E] * expo_high[E,pixel]  
-                
-resid_counts = data_high - model                                                                      
-
-
-dOmega = 4. * np.pi / npix
-deltaE = Es_high * (np.exp(delta/2) - np.exp(-delta/2))
-
-resid_flux = np.zeros((nE, npix))
-model_flux = np.zeros((nE, npix))
-for E in xrange(nE):
-    resid_flux[E] = mask * (Es_high[E]**2 * resid_counts[E]) / (deltaE[E] * expo_high[E] * dOmega)           # Differential flux
-    model_flux[E] = mask * (Es_high[E]**2 * model[E]) / (deltaE[E] * expo_high[E] * dOmega)
-
-
-############################################################################################################################ Function to save fits files (auxil.py)
-
-def hmap2skymap(values, fn=None, unit=None, kdict=None, comment=None, Es=None, Eunit='GeV'):
-    hdulist = [pyfits.PrimaryHDU()]
-
-    clms = []
-    npix, nval = values.shape
-    fmt = '%iE' % nval
-    clm = pyfits.Column(name='Spectra', array=values,
-                        format=fmt, unit=unit)
-    clms.append(clm)
-    dhdu = pyfits.new_table(clms)
-    dhdu.name = 'SKYMAP'
-    nside = healpy.npix2nside(npix)
-    dhdu.header.update('PIXTYPE', 'HEALPIX')
-    dhdu.header.update('ORDERING', 'RING')
-    dhdu.header.update('NSIDE', nside)
-    dhdu.header.update('FIRSTPIX', 0)
-    dhdu.header.update('LASTPIX', (npix - 1))
-    dhdu.header.update('NBRBINS', nval, 'Number of energy bins')
-    dhdu.header.update('EMIN', Es_high[0], 'Minimum energy')
-    dhdu.header.update('DELTAE', delta, 'Step in energy (log)')
-
-    hdulist.append(dhdu)
-
-    # create energy HDU
-    if Es is not None:       
-        clm = pyfits.Column(name=Eunit, array=Es, format='E', unit=Eunit)
-        ehdu = pyfits.new_table([clm])
-        ehdu.name = 'ENERGIES'
-        hdulist.append(ehdu)
-    
-    hdulist = pyfits.HDUList(hdulist)
-
-    print 'Save skymap to file:'
-    print fn
-        
-    hdulist.writeto(fn)
-
-    return None
-                
 
 ############################################################################################################################ Save residual flux as fits file
 
-emax_low = Es[binmax_low] * np.exp(delta/2)
-emin_low = Es[binmin_low] * np.exp(-delta/2)
-
 fits_fn_counts = 'fits/LowE_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_counts_' + data_class + fn_extra + '.fits'
-skymap_counts = hmap2skymap(resid_counts.T, fits_fn_counts, unit = 'counts', Es = Es_high)
+skymap_io.write_cube(fits_fn_counts, store.cubes['resid_counts'], unit = 'counts', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_fn_flux = 'fits/LowE_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_flux_' + data_class + fn_extra  + '.fits'
-skymap_flux = hmap2skymap(resid_flux.T, fits_fn_flux, unit = 'GeV/(cm^2 s sr)', Es = Es_high)
+skymap_io.write_cube(fits_fn_flux, store.cubes['resid_flux'], unit = 'GeV/(cm^2 s sr)', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 
 fits_fn_model = 'fits/LowE_model_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_counts_' + data_class + fn_extra  + '.fits'
-skymap_model = hmap2skymap(model.T, fits_fn_model, unit = 'counts', Es = Es_high)
+skymap_io.write_cube(fits_fn_model, store.cubes['model'], unit = 'counts', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 fits_fn_modelflux = 'fits/LowE_model_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_flux_' + data_class + fn_extra  + '.fits'
-skymap_modelflux = hmap2skymap(model_flux.T, fits_fn_modelflux, unit = 'GeV/(cm^2 s sr)', Es = Es_high)
+skymap_io.write_cube(fits_fn_modelflux, store.cubes['model_flux'], unit = 'GeV/(cm^2 s sr)', Es = Es_high, energy_major = True, emin = Es_high[0], deltae = delta)
 
 
 ############################################################################################################################ Save parameters in dictionary
@@ -267,6 +222,8 @@ skymap_modelflux = hmap2skymap(model_flux.T, fits_fn_modelflux, unit = 'GeV/(cm^
 dct = {'Comment' : 'Parameters of low-energy model'}
 dct['c_array'] = c_array
 dct['k_array'] = k_array
+dct['c_err_array'] = c_err_array
+dct['k_err_array'] = k_err_array
 dct['smooth_sigma'] = smooth_sigma
 dct['shape_arrays (nB,nE)'] = c_array.shape
 dct['Bc'] = Bc
@@ -274,3 +231,4 @@ dct['Es_high'] = Es_high
 
 dct_fn = 'fits/LowE_%.1f' %emin_low + '-%.1fGeV' %emax_low + '_' + data_class + fn_extra + '.yaml'
 dio.saveyaml(dct, dct_fn, expand = True)
+store.cleanup()                                                                                    # Delete the memory maps of the streaming mode
@@ -7,6 +7,7 @@ import healpylib as hlib
 import dio
 from yaml import load
 import auxil
+import syst_spectra as syst
 from optparse import OptionParser
 
 ########################################################################################################################## Parameters
@@ -43,9 +44,6 @@ Bc = dct['4) Center_of_lat_bins']
 dL = 10.
 dB = [10., 10., 10., 10., 10., 4., 4., 4., 4., 4., 10., 10., 10., 10., 10.]
 
-def plaw(N_0, gamma, Ecut):  # powerlaw
-    return lambda E: N_0 * E**(-gamma) * np.exp(-E / Ecut)
-
 ########################################################################################################################## Load dictionaries
 
 print "Latitude: ", Bc[latitude]
@@ -54,46 +52,16 @@ b = latitude
 
 
 
-if particles == "electrons": # units: 1/GeVcm^3s
-    dct_boxes = dio.loaddict('plot_dct/Low_energy_range0/boxes_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE = dio.loaddict('plot_dct/Low_energy_range0/lowE_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_GALPROP = dio.loaddict('plot_dct/Low_energy_range0/GALPROP_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE1 = dio.loaddict('plot_dct/Low_energy_range1/lowE_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE2 = dio.loaddict('plot_dct/Low_energy_range2/lowE_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE3 = dio.loaddict('plot_dct/Low_energy_range3/lowE_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_boxes1 = dio.loaddict('plot_dct/Low_energy_range1/boxes_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_boxes2 = dio.loaddict('plot_dct/Low_energy_range2/boxes_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_boxes3 = dio.loaddict('plot_dct/Low_energy_range3/boxes_source_IC_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    #HESS_2017 = np.array([])
-    #Es_HESS_2017 = np.array([])
-
-else: # units: 1/GeVcm^3s
-    
-    dct_boxes = dio.loaddict('plot_dct/Low_energy_range0/boxes_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE = dio.loaddict('plot_dct/Low_energy_range0/lowE_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_GALPROP = dio.loaddict('plot_dct/Low_energy_range0/GALPROP_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE1 = dio.loaddict('plot_dct/Low_energy_range1/lowE_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE2 = dio.loaddict('plot_dct/Low_energy_range2/lowE_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_lowE3 = dio.loaddict('plot_dct/Low_energy_range3/lowE_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_boxes1 = dio.loaddict('plot_dct/Low_energy_range1/boxes_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_boxes2 = dio.loaddict('plot_dct/Low_energy_range2/boxes_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
-    dct_boxes3 = dio.loaddict('plot_dct/Low_energy_range3/boxes_source_pi0_cutoff_l=-5.0_b=' + str(Bc[latitude]) + '.yaml')
+process = "IC" if particles == "electrons" else "pi0"                                         # units: 1/GeVcm^3s
+variants = [(model, 0, "source") for model in ["boxes", "lowE", "GALPROP"]]                    # first variant is the baseline
+#variants += [(model, lowE_range, "source") for model in ["boxes", "lowE"] for lowE_range in [1, 2, 3]]
 
 factor = Es**2 * speed_of_light / 4. / np.pi
+res = syst.calc_envelopes(variants, [(Lc[l], Bc[b])], Es, process=process, factor=factor)
 
-print dct_boxes['N_0']
-print dct_boxes['gamma']
-print dct_boxes['E_cut']
-
-plaw_boxes = factor * plaw(dct_boxes['N_0'], dct_boxes['gamma'], dct_boxes['E_cut'])(Es)
-plaw_lowE = factor * plaw(dct_lowE['N_0'], dct_lowE['2) gamma'], dct_lowE['3) E_cut'])(Es)
-plaw_GALPROP = factor * plaw(dct_GALPROP['N_0'], dct_GALPROP['2) gamma'], dct_GALPROP['3) E_cut'])(Es)
-plaw_boxes1 = factor * plaw(dct_boxes1['N_0'], dct_boxes1['gamma'], dct_boxes1['E_cut'])(Es)
-plaw_boxes2 = factor * plaw(dct_boxes2['N_0'], dct_boxes2['gamma'], dct_boxes2['E_cut'])(Es)
-plaw_boxes3 = factor * plaw(dct_boxes3['N_0'], dct_boxes3['gamma'], dct_boxes3['E_cut'])(Es)
-plaw_lowE1 = factor * plaw(dct_lowE1['N_0'], dct_lowE1['gamma'], dct_lowE1['E_cut'])(Es)
-plaw_lowE2 = factor * plaw(dct_lowE2['N_0'], dct_lowE2['gamma'], dct_lowE2['E_cut'])(Es)
-plaw_lowE3 = factor * plaw(dct_lowE3['N_0'], dct_lowE3['gamma'], dct_lowE3['E_cut'])(Es)
+print res['pars']['N_0'][0, 0]
+print res['pars']['gamma'][0, 0]
+print res['pars']['E_cut'][0, 0]
 
 
 
@@ -104,12 +72,10 @@ auxil.setup_figure_pars(plot_type = 'spectrum')
 fig = pyplot.figure()
 
 
-baseline  = plaw_boxes
+baseline  = res['spectra'][0, 0]
 
-syst_max = np.maximum.reduce([plaw_boxes, plaw_lowE, plaw_GALPROP])
-syst_min = np.minimum.reduce([plaw_boxes, plaw_lowE, plaw_GALPROP])
-#syst_max = np.maximum.reduce([plaw_boxes, plaw_lowE, plaw_GALPROP, plaw_boxes1, plaw_boxes2, plaw_boxes3, plaw_lowE1, plaw_lowE2, plaw_lowE3])
-#syst_min = np.minimum.reduce([plaw_boxes, plaw_lowE, plaw_GALPROP, plaw_boxes1, plaw_boxes2, plaw_boxes3, plaw_lowE1, plaw_lowE2, plaw_lowE3])
+syst_max = res['max'][0]
+syst_min = res['min'][0]
 
 label = "Excess region"
 '''
@@ -0,0 +1,120 @@
+""" Runs Save_lowE_res_fits.py for all combinations of low-energy range, data class and smoothing of the high-energy data in parallel (systematics matrix). The count and exposure cubes are converted once to memory maps (cube_cache.py), which are shared by all processes. The shared caches (lat-lon labels, alms of the healed high-energy planes) are filled before the runs start, so that the parallel runs only read them. Finished combinations are skipped and interrupted ones continue at the last finished energy bin """
+
+
+import time
+import multiprocessing
+import numpy as np
+import healpy
+import cube_cache
+import dct_engine
+import healpylib as hlib
+import smoothing
+import pipeline
+import dio
+from optparse import OptionParser
+
+####################################################################################################################### Parameters
+
+
+parser = OptionParser()
+parser.add_option("-c", "--data_class", dest = "data_class", default = "source,ultraclean", help="comma separated data classes (source, ultraclean)")
+parser.add_option("-E", "--lowE_range", dest="lowE_range", default='0,1,2,3', help="comma separated low-energy ranges: 0: (3,5), 1: (3,3), 2: (4,5), 3: (6,7)")
+parser.add_option("-g", "--smooth_sigma", dest="smooth_sigma", default='1.,1.41,0.65,0.4', help="comma separated Gaussian smoothing of the high-energy data in deg")
+parser.add_option("-p", "--nproc", dest="nproc", default='0', help="number of parallel runs, 0: number of cpus")
+parser.add_option("-f", "--force", dest="force", default='', help="comma separated name patterns of the runs which are repeated")
+parser.add_option("-n", "--dry_run", dest="dry_run", action="store_true", default=False, help="only print the runs which are not done")
+
+(options, args) = parser.parse_args()
+
+data_classes = str(options.data_class).split(',')
+lowE_range_list = [int(r) for r in str(options.lowE_range).split(',')]
+sigmas = [float(sigma) for sigma in str(options.smooth_sigma).split(',')]
+nproc = int(options.nproc) or multiprocessing.cpu_count()
+force = [pat for pat in str(options.force).split(',') if pat]
+
+default_sigma = (1., 1.41, 0.65, 0.4)              # smooth_sigma of the low-energy ranges in Save_lowE_res_fits.py
+low_bins = ((3,5), (3,3), (4,5), (6,7))            # binmin_low, binmax_low in Save_lowE_res_fits.py
+delta = 0.3837641821164575                         # Logarithmic size of one energy bin
+Bbins = np.arange(-90., 90. + 0.001, 4.)           # lat-lon bins of Save_lowE_res_fits.py
+Lbins = np.arange(-180., 180. + 0.001, 20.)
+symmetrize_mask = True
+map_code = ['healpylib.py', 'dio.py', 'poisson_fit.py', 'smoothing.py', 'cube_cache.py', 'stream_maps.py', 'skymap_io.py',
+            'Save_lowE_res_fits.py']
+
+
+####################################################################################################################### Shared inputs
+
+
+t0 = time.time()
+Es = {}
+masks = {}
+for data_class in data_classes:                    # converted once, the processes read the same memory-mapped cubes
+    cube_cache.header(dct_engine.expo_fns[data_class])
+    Es[data_class] = np.array(cube_cache.header(dct_engine.counts_fns[data_class])['energies_GeV'])
+    nside = healpy.npix2nside(cube_cache.load(dct_engine.counts_fns[data_class])[0].shape[-1])
+    masks[data_class] = hlib.load_mask(dct_engine.mask_fns['small'], nside, symmetrize=symmetrize_mask)
+    hlib.lb_labels(nside, Bbins, Lbins)            # saved once in the cache, the processes only read the labels
+    hlib.neighbour_table(nside)
+
+
+def warm_alms(args):
+    '''
+    alms of a healed high-energy plane in the cache directory (same input as in Save_lowE_res_fits.py)
+    '''
+    data_class, E = args
+    data = cube_cache.load(dct_engine.counts_fns[data_class])[0]
+    data_high = hlib.heal(np.array(data[E], dtype=np.float64), masks[data_class])
+    smoothing.cube_alms(data_high, use_cache=True)
+
+
+planes = sorted(set((data_class, E) for data_class in data_classes for lowE_range in lowE_range_list
+                    for E in range(dct_engine.high_bins[lowE_range][0], dct_engine.high_bins[lowE_range][1] + 1)))
+if not options.dry_run:
+    pool = multiprocessing.Pool(min(nproc, len(planes)))
+    pool.map(warm_alms, planes)
+    pool.close()
+    pool.join()
+print 'shared inputs ready in %.1f s' % (time.time() - t0)
+
+
+def energy_range(data_class, lowE_range):
+    '''
+    low-energy range in the file names of Save_lowE_res_fits.py, e.g. '0.3-1.0GeV'
+    '''
+    binmin_low, binmax_low = low_bins[lowE_range]
+    emin_low = Es[data_class][binmin_low] * np.exp(-delta/2)
+    emax_low = Es[data_class][binmax_low] * np.exp(delta/2)
+    return '%.1f-%.1fGeV' % (emin_low, emax_low)
+
+
+###################################################################################################################### Declare the runs
+
+
+pipe = pipeline.Pipeline('sweep_lowE')
+summary = {}
+for lowE_range in lowE_range_list:
+    for data_class in data_classes:
+        erange = energy_range(data_class, lowE_range)
+        for sigma in sigmas:
+            fn_extra = ''
+            if sigma != default_sigma[lowE_range]:
+                fn_extra = '_sigma%.2f' % sigma
+            name = 'lowE_%s_%i_sigma%.2f' % (data_class, lowE_range, sigma)
+            yaml_fn = 'fits/LowE_%s_%s%s.yaml' % (erange, data_class, fn_extra)
+            pipe.add(name, ['Save_lowE_res_fits.py', '-c', data_class, '-E', str(lowE_range), '-g', str(sigma), '-s', '-a'],
+                     inputs=[dct_engine.counts_fns[data_class], dct_engine.expo_fns[data_class], dct_engine.mask_fns['small']] + map_code,
+                     outputs=['fits/LowE_%s%s_%s_%s%s.fits' % (model, erange, fmt, data_class, fn_extra)
+                              for model in ['', 'model_'] for fmt in ['counts', 'flux']] + [yaml_fn])
+            summary[name] = {'data_class': data_class, 'lowE_range': lowE_range, 'smooth_sigma': sigma, 'dct_fn': yaml_fn}
+
+
+###################################################################################################################### Run
+
+
+status = pipe.run(nproc=nproc, force=force, dry_run=options.dry_run)
+
+if not options.dry_run:
+    for name in summary:
+        summary[name]['status'] = status[name]
+    dio.saveyaml(summary, 'fits/Sweep_lowE_summary.yaml', expand=True)
+    print 'sweep of %i runs finished in %.1f s' % (len(summary), time.time() - t0)
@@ -6,6 +6,7 @@ import healpy
 from matplotlib import pyplot
 import healpylib as hlib
 import auxil
+import skymap_io
 from optparse import OptionParser
 
 ##################################################################################################### parameters
@@ -167,46 +168,6 @@ pyplot.savefig(save_fn)
 
 ##################################################################################################### Save generated maps as fits
 
-def hmap2skymap(values, fn=None, unit=None, kdict=None, comment=None, Es=None, Eunit='GeV'):
-    hdulist = [pyfits.PrimaryHDU()]
-
-    clms = []
-    npix, nval = values.shape
-    fmt = '%iE' % nval
-    clm = pyfits.Column(name='Spectra', array=values,
-                        format=fmt, unit=unit)
-    clms.append(clm)
-    dhdu = pyfits.new_table(clms)
-    dhdu.name = 'SKYMAP'
-    nside = healpy.npix2nside(npix)
-    dhdu.header.update('PIXTYPE', 'HEALPIX')
-    dhdu.header.update('ORDERING', 'RING')
-    dhdu.header.update('NSIDE', nside)
-    dhdu.header.update('FIRSTPIX', 0)
-    dhdu.header.update('LASTPIX', (npix - 1))
-    dhdu.header.update('NBRBINS', nval, 'Number of energy bins')
-    dhdu.header.update('EMIN', Es_high[0], 'Minimum energy')
-    dhdu.header.update('DELTAE', delta, 'Step in energy (log)')
-
-    hdulist.append(dhdu)
-
-    # create energy HDU
-    if Es is not None:       
-        clm = pyfits.Column(name=Eunit, array=Es, format='E', unit=Eunit)
-        ehdu = pyfits.new_table([clm])
-        ehdu.name = 'ENERGIES'
-        hdulist.append(ehdu)
-    
-    hdulist = pyfits.HDUList(hdulist)
-
-    print 'Save skymap to file:'
-    print fn
-        
-    hdulist.writeto(fn)
-
-    return None
-
-
 if save_fits:
     if model:
         if source_class:
@@ -218,4 +179,4 @@ if save_fits:
             fits_fn = 'fits/GALPROP_residual_plus_FBs_plus_gNFW_flux_source.fits'
         else:
             fits_fn = 'fits/GALPROP_residual_plus_FBs_plus_gNFW_flux_ultraclean.fits'
-    skymap = hmap2skymap(plot_map, fits_fn, unit = "GeV / s sr cm^2", Es = Es[binmin: binmax+1])
+    skymap_io.hmap2skymap(plot_map, fits_fn, unit = "GeV / s sr cm^2", Es = Es[binmin: binmax+1], deltae = delta)
@@ -10,6 +10,7 @@ import pyfits
 import healpy
 from matplotlib import pyplot
 import healpylib as hlib
+import smoothing
 import auxil
 
 ##################################################################################################### Parameters
@@ -91,7 +92,7 @@ for highE in (0,1,2):
     if smooth_map and smooth_sigmas[highE] > 0.:
         if mask_point_sources:
             plot_map = np.array(hlib.heal(plot_map, mask), dtype = np.float64)
-        plot_map = healpy.smoothing(plot_map, sigma=smooth_sigmas[highE])
+        plot_map = smoothing.smooth_cube(plot_map, sigma=smooth_sigmas[highE])
 
     if mask_point_sources:
         for pixel in xrange(npix):
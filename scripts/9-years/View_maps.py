@@ -5,6 +5,7 @@ import pyfits
 import healpy
 from matplotlib import pyplot
 import healpylib as hlib
+import smoothing
 import auxil
 from optparse import OptionParser
 
@@ -93,7 +94,7 @@ for highE in [0,1,2]:
 
     if smooth_map:
         plot_map = np.array(hlib.heal(plot_map, mask), dtype = np.float64)
-        plot_map = healpy.smoothing(plot_map, sigma=smooth_sigma)
+        plot_map = smoothing.smooth_cube(plot_map, sigma=smooth_sigma)
 
     for pixel in xrange(npix):
         if mask[pixel] == 0:
@@ -25,6 +25,7 @@ import numeric as num
 import dio
 #import constants as const
 import healpylib as hlib
+import skymap_io
 #import wcs_plot as wplot
 
 epsilon = 1.e-30
@@ -280,6 +281,16 @@ def plotLimLog(xs, fs, ferrs, sigma=2.0,
     return errorbars
 
 def hmap2skymap(values, fn=None,
+                unit=None, kdict=None, comment=None, Es=None, Eunit='MeV',
+                emin=42.6776695251465, deltae=0.34657359023613, dtype=np.float32, compress=False):
+    """
+    save a healpix cube, values.shape = (npix, nE), see skymap_io.write_cube
+    if fn is None, the HDUList is returned
+    """
+    return skymap_io.write_cube(fn, values, unit=unit, Es=Es, Eunit=Eunit, dtype=dtype, compress=compress,
+                                emin=emin, deltae=deltae)
+
+def hmap2skymap_old(values, fn=None,
                 unit=None, kdict=None, comment=None, Es=None, Eunit='MeV'):
     hdulist = [pyfits.PrimaryHDU()]
 
@@ -0,0 +1,198 @@
+"""
+Hierarchical lat-lon binning of healpix maps.
+
+The pixels are visited once: the sums of the maps (and of their squares) and the numbers of pixels
+are calculated in fine lat-lon cells (e.g. 1 x 1 deg). Every coarser binning whose edges are on the
+fine grid - uniform or not, e.g. the spliced 'small' and 'large' latitude bins of dct_engine.lat_bins() -
+is derived by summing fine cells (np.add.reduceat), without a new pass over the pixels.
+A coarse binning can itself be the input for a coarser one (nested binnings).
+Arbitrary regions (polygons in (l, b), ellipses as in healpylib.mask_ellipse, boxes)
+are sums over the fine cells with the centers inside the region, the boundaries of
+these regions are resolved with the size of the fine cells.
+
+Usage:
+    import binning
+    grid = binning.FineGrid(nside, dB=1., dL=1., mask=mask)
+    fine = grid.stats(cube)                                                   # one pass over the pixels, cube.shape = (npix, nE)
+    prof = binning.coarsen(fine, grid.Bbins, grid.Lbins, dct_engine.lat_bins(), np.arange(-10., 10.001, 10.))
+    prof['sum'].shape                                                         # (nB, nL, nE)
+    regions = [binning.polygon([(0., 10.), (20., 50.), (-20., 50.)]), binning.ellipse(B0=30., L0=0., dB=20., dL=15.)]
+    reg = grid.region_stats(fine, regions)                                    # reg['sum'].shape = (nregion, nE)
+"""
+
+import numpy as np
+import healpy
+from scipy import sparse
+from matplotlib import path as mpath
+import healpylib as hlib
+import profiles
+
+
+edge_tol = 1.e-6                                  # tolerance (deg) for the coarse edges on the fine grid
+
+
+####################################################################################################################### Fine grid
+
+
+class FineGrid(object):
+    '''
+        fine lat-lon cells of a healpix map
+    INPUT:
+        nside - healpix parameter
+        dB, dL - size of the cells (deg), 180 / dB and 360 / dL should be integers
+        Bmax, Lmax - the cells cover (-Bmax, Bmax) x (-Lmax, Lmax)
+        mask - healpix map or None: masked pixels (mask == 0) are not used
+        nest - healpix ordering
+    '''
+    def __init__(self, nside, dB=1., dL=1., Bmax=90., Lmax=180., mask=None, nest=False):
+        self.nside = nside
+        self.npix = healpy.nside2npix(nside)
+        self.Bbins = np.linspace(-Bmax, Bmax, int(round(2 * Bmax / dB)) + 1)
+        self.Lbins = np.linspace(-Lmax, Lmax, int(round(2 * Lmax / dL)) + 1)
+        self.nB = len(self.Bbins) - 1
+        self.nL = len(self.Lbins) - 1
+        self.Bc = (self.Bbins[1:] + self.Bbins[:-1]) / 2
+        self.Lc = (self.Lbins[1:] + self.Lbins[:-1]) / 2
+        self.ib, self.il = hlib.lb_labels(nside, self.Bbins, self.Lbins, mask=mask, nest=nest)
+        self.matrix = profiles.label_matrix(profiles.box_labels(self.ib, self.il, self.nL), self.nB * self.nL)
+
+    def sums(self, cube):
+        '''
+        sums over the fine cells, shape (nB, nL) or (nB, nL, nE)
+        '''
+        res = profiles.box_sums(cube, self.matrix)
+        return res.reshape((self.nB, self.nL) + res.shape[1:])
+
+    def stats(self, cube):
+        '''
+            fine aggregates of a map or a data cube (npix,) or (npix, nE)
+        OUTPUT:
+            dictionary with 'npix' (nB, nL), 'sum' and 'sum2' (nB, nL, nE)
+        '''
+        cube = np.asarray(cube, dtype=np.float64)
+        res = {'npix': np.asarray(self.matrix.sum(axis=1)).reshape((self.nB, self.nL))}
+        res['sum'] = self.sums(cube)
+        res['sum2'] = self.sums(cube**2)
+        return res
+
+    def cell_matrix(self, regions):
+        '''
+            sparse matrix (nregion, nB * nL): 1 if the center of the cell is inside the region
+        INPUT:
+            regions - list of functions f(B, L) -> bool array (deg), see polygon, ellipse, box
+        '''
+        BB, LL = np.meshgrid(self.Bc, self.Lc, indexing='ij')
+        BB = BB.flatten()
+        LL = LL.flatten()
+        rows = []
+        cols = []
+        for n, region in enumerate(regions):
+            cells = np.nonzero(region(BB, LL))[0]
+            rows.append(np.ones(len(cells), dtype=int) * n)
+            cols.append(cells)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(regions), self.nB * self.nL))
+
+    def region_stats(self, fine, regions):
+        '''
+            sums of the fine aggregates over the regions
+        INPUT:
+            fine - dictionary from stats()
+            regions - list of region functions or a matrix from cell_matrix()
+        OUTPUT:
+            dictionary with 'npix' (nregion,), 'sum' and 'sum2' (nregion, nE) and 'mean', 'var'
+        '''
+        matrix = regions if sparse.issparse(regions) else self.cell_matrix(regions)
+        res = {}
+        for key, value in fine.items():
+            value = np.asarray(value)
+            res[key] = matrix.dot(value.reshape((self.nB * self.nL,) + value.shape[2:]))
+        return _moments(res)
+
+
+####################################################################################################################### Coarse binnings
+
+
+def _edge_inds(fine_bins, bins):
+    '''
+    indices of the coarse edges in the fine edges
+    '''
+    inds = np.searchsorted(fine_bins, np.asarray(bins) - edge_tol)
+    inds = np.minimum(inds, len(fine_bins) - 1)
+    if not np.all(np.abs(fine_bins[inds] - bins) < edge_tol):
+        raise ValueError, 'the edges %s are not on the fine grid' % np.asarray(bins)[np.abs(fine_bins[inds] - bins) >= edge_tol]
+    return inds
+
+
+def _reduce(array, inds, axis):
+    '''
+    sums between the edge indices inds along axis
+    '''
+    array = np.take(array, np.arange(inds[0], inds[-1]), axis=axis)
+    return np.add.reduceat(array, inds[:-1] - inds[0], axis=axis)
+
+
+def _moments(res):
+    n = res['npix']
+    if res['sum'].ndim > n.ndim:
+        n = n[..., np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res['mean'] = res['sum'] / n
+        res['var'] = np.maximum(res['sum2'] / n - res['mean']**2, 0.)       # clipped: rounding errors for near-constant cells
+    return res
+
+
+def coarsen(fine, Bbins_fine, Lbins_fine, Bbins, Lbins):
+    '''
+        aggregates in a coarser lat-lon binning from the aggregates in a finer one
+    INPUT:
+        fine - dictionary with 'npix' (nB, nL), 'sum' and 'sum2' (nB, nL, nE), e.g. from FineGrid.stats
+               or from an earlier coarsen (nested binnings)
+        Bbins_fine, Lbins_fine - edges of the finer binning (deg)
+        Bbins, Lbins - edges of the coarser binning (deg), they have to be edges of the finer binning
+    OUTPUT:
+        dictionary with 'npix', 'sum', 'sum2', 'mean' and 'var' in the coarse binning
+    '''
+    ib = _edge_inds(np.asarray(Bbins_fine), Bbins)
+    il = _edge_inds(np.asarray(Lbins_fine), Lbins)
+    res = {}
+    for key in ['npix', 'sum', 'sum2']:
+        if key in fine:
+            res[key] = _reduce(_reduce(np.asarray(fine[key]), ib, 0), il, 1)
+    return _moments(res)
+
+
+####################################################################################################################### Regions
+
+
+def polygon(vertices):
+    '''
+        region inside a polygon in the (L, B) plane
+    INPUT:
+        vertices - list of (L, B) in deg, L between -180 and 180
+    '''
+    poly = mpath.Path(np.asarray(vertices, dtype=np.float64))
+    return lambda B, L: poly.contains_points(np.array([L, B]).T)
+
+
+def box(Bmin, Bmax, Lmin, Lmax):
+    '''
+    lat-lon box (deg)
+    '''
+    return lambda B, L: (B > Bmin) & (B < Bmax) & (L > Lmin) & (L < Lmax)
+
+
+def ellipse(B0=None, L0=None, dB=None, dL=None, rsInv=None, n0=None):
+    '''
+        elliptical region
+        either in the (L, B) plane: ((B - B0) / dB)^2 + ((L - L0) / dL)^2 < 1 (deg)
+        or on the sphere as in healpylib.mask_ellipse: sum((rsInv * (n - n0))^2) < 1
+    '''
+    if rsInv is not None:
+        n0 = np.asarray(n0)
+        def inside(B, L):
+            n1 = np.array(hlib.BL2xyz(np.deg2rad(B), np.deg2rad(L))).T
+            return np.sum((rsInv * (n1 - n0))**2, axis=1) < 1.
+        return inside
+    return lambda B, L: ((B - B0) / dB)**2 + ((L - L0) / dL)**2 < 1.
@@ -0,0 +1,186 @@
+"""
+Memory-mapped cache of healpix data cubes stored in fits files.
+
+The (npix, nE) table 'Spectra' of a fits file is converted once to an energy-major
+(nE, npix) .npy file in healpylib.cache_dir + 'cubes/', together with a small json header
+(source file, mtime, size, shape, dtype, ordering and the energies in GeV).
+On later calls the header is compared with the mtime and the size of the fits file and
+the cube is served as a read-only memory map, so that only the bytes of the energy bins
+which are used are read from the disk.
+
+Usage:
+    import cube_cache
+    data, Es = cube_cache.load(map_fn)                   # data.shape = (nE, npix), Es in GeV
+    data_high, Es_high = cube_cache.load(map_fn, bins=(6, 23))
+"""
+
+import os
+import zlib
+import numpy as np
+import pyfits
+import healpylib as hlib
+import dio
+
+
+GeV2MeV = 1000.
+chunk_size = 2**16                                # number of pixels converted at once
+
+
+def cache_fns(fits_fn, field='Spectra'):
+    '''
+    names of the cube and the header files in the cache directory
+    '''
+    key = zlib.adler32(os.path.abspath(fits_fn) + ':' + field) & 0xffffffff
+    base = hlib.cache_dir + 'cubes/' + os.path.basename(fits_fn).replace('.fits', '') + '_%08x' % key
+    return base + '.npy', base + '.json'
+
+
+def _stamp(fits_fn):
+    stat = os.stat(fits_fn)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def is_valid(fits_fn, field='Spectra'):
+    '''
+    True if the cached cube exists and the fits file did not change
+    '''
+    npy_fn, header_fn = cache_fns(fits_fn, field=field)
+    if not (os.path.isfile(npy_fn) and os.path.isfile(header_fn)):
+        return False
+    header = dio.loaddict(header_fn)
+    stamp = _stamp(fits_fn)
+    return header.get('mtime') == stamp['mtime'] and header.get('size') == stamp['size']
+
+
+def convert(fits_fn, field='Spectra'):
+    '''
+        write the energy-major cube and the header to the cache directory
+    OUTPUT:
+        header - dictionary
+    '''
+    npy_fn, header_fn = cache_fns(fits_fn, field=field)
+    folder = os.path.dirname(npy_fn)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    print 'convert %s to %s' % (fits_fn, npy_fn)
+
+    hdu = pyfits.open(fits_fn, memmap=True)
+    table = hdu[1].data.field(field)
+    npix = table.shape[0]
+    nE = 1
+    if table.ndim > 1:
+        nE = table.shape[1]
+    table = table.reshape((npix, nE))
+
+    # write to a temporary file and rename, so that an interrupted conversion leaves no broken cube
+    tmp_fn = npy_fn + '.tmp%i' % os.getpid()
+    cube = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=table.dtype.newbyteorder('='), shape=(nE, npix))
+    for i in xrange(0, npix, chunk_size):
+        cube[:, i:i + chunk_size] = table[i:i + chunk_size].T
+    cube.flush()
+    del cube
+
+    header = _stamp(fits_fn)
+    header['fits_fn'] = os.path.abspath(fits_fn)
+    header['field'] = field
+    header['shape'] = [nE, npix]
+    header['dtype'] = str(table.dtype.newbyteorder('='))
+    header['ordering'] = str(hdu[1].header.get('ORDERING', 'RING'))
+    header['energies_GeV'] = None
+    if len(hdu) > 2:
+        names = hdu[2].data.names
+        if 'GeV' in names:
+            header['energies_GeV'] = [float(E) for E in hdu[2].data.field('GeV')]
+        elif 'MeV' in names:
+            header['energies_GeV'] = [float(E) / GeV2MeV for E in hdu[2].data.field('MeV')]
+    hdu.close()
+
+    os.rename(tmp_fn, npy_fn)
+    dio.savedict(header, header_fn, silent=True)
+    return header
+
+
+def store(fits_fn, cube, Es=None, field='Spectra', dtype=None, ordering='RING'):
+    '''
+        put an energy-major cube which was just written to fits_fn (e.g. by skymap_io.write_cube)
+        to the cache directory, so that load(fits_fn) does not convert the fits file
+    INPUT:
+        fits_fn - fits file name
+        cube - array, shape (nE, npix)
+        Es - energies in GeV
+        dtype - dtype of the cached cube, default: cube.dtype (the dtype of the fits column is expected)
+        ordering - healpix ordering
+    OUTPUT:
+        header - dictionary
+    '''
+    npy_fn, header_fn = cache_fns(fits_fn, field=field)
+    folder = os.path.dirname(npy_fn)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    nE, npix = cube.shape
+    dtype = np.dtype(dtype or cube.dtype).newbyteorder('=')
+    tmp_fn = npy_fn + '.tmp%i' % os.getpid()
+    res = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=dtype, shape=(nE, npix))
+    for i in xrange(0, npix, chunk_size):
+        res[:, i:i + chunk_size] = cube[:, i:i + chunk_size]
+    res.flush()
+    del res
+
+    header = _stamp(fits_fn)
+    header['fits_fn'] = os.path.abspath(fits_fn)
+    header['field'] = field
+    header['shape'] = [nE, npix]
+    header['dtype'] = str(dtype)
+    header['ordering'] = ordering
+    header['energies_GeV'] = None if Es is None else [float(E) for E in Es]
+    os.rename(tmp_fn, npy_fn)
+    dio.savedict(header, header_fn, silent=True)
+    return header
+
+
+def header(fits_fn, field='Spectra', use_cache=True):
+    '''
+    header of the cached cube, the cube is converted if necessary
+    '''
+    if not use_cache or not is_valid(fits_fn, field=field):
+        return convert(fits_fn, field=field)
+    return dio.loaddict(cache_fns(fits_fn, field=field)[1])
+
+
+def load(fits_fn, field='Spectra', bins=None, use_cache=True):
+    '''
+        energy-major cube from a healpix fits file
+    INPUT:
+        fits_fn - fits file name
+        field - name of the column in the first extension
+        bins - (binmin, binmax): first and last energy bins (inclusive), None for all bins
+        use_cache - if False, the cube is converted again
+    OUTPUT:
+        cube - read-only memory map, shape (nE, npix)
+        Es - array, shape (nE,): energies in GeV (None if the fits file has no energy extension)
+    '''
+    hdr = header(fits_fn, field=field, use_cache=use_cache)
+    cube = np.load(cache_fns(fits_fn, field=field)[0], mmap_mode='r')
+    Es = hdr['energies_GeV']
+    if Es is not None:
+        Es = np.array(Es)
+    if bins is not None:
+        binmin, binmax = bins
+        cube = cube[binmin:binmax + 1]
+        if Es is not None:
+            Es = Es[binmin:binmax + 1]
+    return cube, Es
+
+
+def clear(fits_fn=None, field='Spectra'):
+    '''
+    delete the cached cube of fits_fn or all cached cubes if fits_fn is None
+    '''
+    if fits_fn is None:
+        folder = hlib.cache_dir + 'cubes/'
+        fns = [folder + fn for fn in os.listdir(folder)] if os.path.isdir(folder) else []
+    else:
+        fns = cache_fns(fits_fn, field=field)
+    for fn in fns:
+        if os.path.isfile(fn):
+            os.remove(fn)
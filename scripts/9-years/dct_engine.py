@@ -0,0 +1,308 @@
+"""
+Single-pass calculation of the lat-lon profile dictionaries (dct/Low_energy_range*/dct_*.yaml).
+
+The products (data, exposure, GALPROP residual, lowE and boxes maps) are described
+by dictionaries, see product(). All input cubes are loaded once, the pixels are labelled once
+per (mask, lon binning) and the profiles of all products are calculated with one sparse
+matrix product per cube (see profiles.py).
+
+The 'small' (4 deg) and 'large' (10 deg) latitude binnings of the Calc_dct_*.py scripts are
+combined in one non-uniform binning Bbins_tot, which gives the same boxes as the
+splicing of the two binnings.
+
+Usage:
+    import dct_engine
+    products = dct_engine.default_products(['source', 'ultraclean'], [0, 1, 2, 3])
+    dct_engine.run(products, nproc=4)
+"""
+
+import os
+import numpy as np
+import healpy
+import healpylib as hlib
+import profiles
+import dio
+import cube_cache
+
+
+delta = 0.3837641821164575                        # Logarithmic size of one energy bin, in fits header "Step in energy (log)"
+
+data_dirs = {'source': '../../data/P8_P302_Source_z100_w009_w478/',
+             'ultraclean': '../../data/P8_P302_UltracleanVeto_z90_w009_w478/'}
+counts_fns = {'source': data_dirs['source'] + 'maps/counts_P8_P302_Source_z100_w009_w478_healpix_o7_24bins.fits',
+              'ultraclean': data_dirs['ultraclean'] + 'maps/counts_P8_P302_UltracleanVeto_z90_w009_w478_healpix_o7_24bins.fits'}
+expo_fns = {'source': data_dirs['source'] + 'irfs/expcube_P8_P302_Source_z100_w009_w478_P8R2_SOURCE_V6_healpix_o7_24bins.fits',
+            'ultraclean': data_dirs['ultraclean'] + 'irfs/expcube_P8_P302_UltracleanVeto_z90_w009_w478_P8R2_ULTRACLEANVETO_V6_healpix_o7_24bins.fits'}
+GALPROP_fns = {'source': data_dirs['source'] + 'residuals/9years_Source_z100_refit_PS_resid_signal_bubbles_counts.fits',
+               'ultraclean': data_dirs['ultraclean'] + 'residuals/9years_UltracleanVeto_z90_refit_PS_resid_signal_bubbles_counts.fits'}
+mask_fns = {'small': '../../data/ps_masks/ps_mask_3FGL_small_nside128.npy',
+            'OG': '../../data/ps_masks/ps_mask_3FGL_OG_nside128.npy'}
+
+lowE_ranges = ["0.3-1.0", "0.3-0.5", "0.5-1.0", "1.0-2.2"]
+high_bins = ((6,23), (6,23), (6,23), (8,23))       # energy bins of the lowE and boxes maps
+all_bins = (6,23)                                   # energy bins of the data, expo and GALPROP dictionaries in all low-energy ranges
+
+dB_dct = {'small': 4., 'large':  10.}             # length of bin in latitude
+Bmax_dct = {'small': 10., 'large': 60.}           # maximal latitude (in deg)
+
+comments = {'data': 'Latitude-longitude profiles of differential flux and corresponding standard deviation with the shape (lat_bin, lon_bin, energy_bin). Point sources are masked with the small map.',
+            'GALPROP': 'Latitude-longitude profiles of residual differential flux derived from GALPROP model and corresponding standard deviation with the shape (lat_bin, lon_bin, energy_bin).',
+            'lowE': 'Latitude-longitude profiles of residual differential flux derived from lowE model and corresponding standard deviation with the shape (lat_bin, lon_bin, energy_bin). Point sources are masked with the small map.',
+            'expo': 'Latitude-longitude profiles of mean exposure (shape: nB, nL, nE), solid angle dOmega (shape: nB, nL) and energy-bin size deltaE (shape: nE). Point sources are masked with the small map in order to calculate the mean exposure.'}
+
+
+def lat_bins():
+    '''
+    the 'large' bins at high latitudes and the 'small' bins at low latitudes
+    '''
+    Bbins = {}
+    for option in ['small', 'large']:
+        Bbins[option] = np.arange(-Bmax_dct[option], Bmax_dct[option] + 0.001, dB_dct[option])
+    return np.append(np.append(Bbins['large'][0:5], Bbins['small']), Bbins['large'][8:13])
+
+
+def product(kind, data_class='source', lowE_range=0, save_counts=False, Lmax=10., dL=10., residual=False):
+    '''
+        description of one profile dictionary
+    INPUT:
+        kind - 'data', 'expo', 'GALPROP', 'lowE' or 'boxes'
+        data_class - 'source' or 'ultraclean'
+        lowE_range - 0, 1, 2, 3
+        save_counts - if True, the profiles are in counts, otherwise in GeV / (cm^2 s sr)
+        Lmax, dL - longitude binning (deg)
+        residual - use the boxes model + residual maps (Boxes_residual+boxes_*.fits), only for kind = 'boxes'
+    OUTPUT:
+        dictionary
+    '''
+    binmin, binmax = high_bins[lowE_range]
+    if kind in ['data', 'expo', 'GALPROP']:                # Plot_SED_loop_likelihood.py drops the first bins of deltaE and exposure in range 3
+        binmin, binmax = all_bins
+    fmt = ('flux', 'counts')[save_counts]
+    dct_dir = 'dct/Low_energy_range%i/' % lowE_range
+    lon_ext = ''
+    if Lmax == 180.:
+        lon_ext = '_lon180'
+    prod = {'kind': kind, 'data_class': data_class, 'binmin': binmin, 'binmax': binmax,
+            'save_counts': save_counts, 'Lmax': Lmax, 'dL': dL,
+            'mask_fn': mask_fns['small'], 'symmetrize_mask': True,
+            'expo_fn': expo_fns[data_class], 'counts_fn': counts_fns[data_class],
+            'comment': comments.get(kind, comments['lowE'])}
+
+    if kind == 'data':
+        prod['map_fn'] = counts_fns[data_class]
+        prod['dct_fn'] = dct_dir + 'dct_data_' + 'counts_' * save_counts + data_class + lon_ext + '.yaml'
+        prod['zero_threshold'] = 0.
+    elif kind == 'expo':
+        prod['map_fn'] = None
+        prod['dct_fn'] = dct_dir + 'dct_expo_' + data_class + lon_ext + '.yaml'
+    elif kind == 'GALPROP':
+        prod['map_fn'] = GALPROP_fns[data_class]
+        prod['dct_fn'] = dct_dir + 'dct_GALPROP_' + 'counts_' * save_counts + data_class + lon_ext + '.yaml'
+        prod['mask_fn'] = mask_fns['OG']
+        prod['symmetrize_mask'] = False
+        prod['zero_threshold'] = 0.01
+    elif kind in ['lowE', 'boxes']:
+        prefix, name = {'lowE': ('LowE_', 'lowE'), 'boxes': ('Boxes_', 'boxes')}[kind]
+        if residual:
+            prefix, name = 'Boxes_residual+boxes_', 'boxes+residual'
+        prod['map_fn'] = 'fits/' + prefix + lowE_ranges[lowE_range] + 'GeV_' + fmt + '_' + data_class + '.fits'
+        prod['dct_fn'] = dct_dir + 'dct_' + name + '_' + 'counts_' * save_counts + data_class + lon_ext + '.yaml'
+        prod['zero_threshold'] = 0.01
+    else:
+        raise ValueError, 'unknown product kind: %s' % kind
+    return prod
+
+
+def default_products(data_classes=('source',), lowE_range_list=(0,), kinds=('data', 'expo', 'GALPROP', 'lowE', 'boxes')):
+    '''
+    all flux and counts dictionaries for the given data classes and low-energy ranges,
+    including the data profiles in the full longitude range (*_lon180, in Low_energy_range0)
+    and the boxes + residual profiles (dct_boxes+residual_*, flux only)
+    '''
+    res = []
+    for lowE_range in lowE_range_list:
+        for data_class in data_classes:
+            for kind in kinds:
+                if kind == 'expo':
+                    res.append(product(kind, data_class, lowE_range))
+                else:
+                    for save_counts in [False, True]:
+                        res.append(product(kind, data_class, lowE_range, save_counts=save_counts))
+                if kind == 'data' and lowE_range == 0:
+                    for save_counts in [False, True]:
+                        res.append(product(kind, data_class, lowE_range, save_counts=save_counts, Lmax=180.))
+                if kind == 'boxes':
+                    res.append(product(kind, data_class, lowE_range, residual=True))
+    return res
+
+
+########################################################################################################################## Loading
+
+
+_cubes = {}
+_masks = {}
+_labels = {}
+
+
+def load_cube(fn):
+    '''
+    (npix, nE) view of the memory-mapped cube and the energies (GeV) of a healpix fits file, see cube_cache.py
+    '''
+    if fn not in _cubes:
+        cube, Es = cube_cache.load(fn)
+        _cubes[fn] = (cube.T, Es)
+    return _cubes[fn]
+
+
+def _energy_slice(prod, fn):
+    '''
+    the data, exposure and GALPROP cubes have all 24 bins, the lowE and boxes maps start at binmin
+    '''
+    if fn == prod['map_fn'] and prod['kind'] in ['lowE', 'boxes']:
+        return slice(0, prod['binmax'] - prod['binmin'] + 1)
+    return slice(prod['binmin'], prod['binmax'] + 1)
+
+
+def load_mask(prod, nside):
+    '''
+    point-source mask at the resolution of the input maps
+    '''
+    key = (prod['mask_fn'], prod['symmetrize_mask'], nside)
+    if key not in _masks:
+        _masks[key] = hlib.load_mask(prod['mask_fn'], nside, symmetrize=prod['symmetrize_mask'])
+    return _masks[key]
+
+
+def get_matrix(prod, nside):
+    '''
+    sparse label matrix for the mask and the lon binning of the product, shared between products
+    '''
+    key = (prod['mask_fn'], prod['symmetrize_mask'], prod['Lmax'], prod['dL'], nside)
+    if key not in _labels:
+        Bbins = lat_bins()
+        Lbins = np.arange(-prod['Lmax'], prod['Lmax'] + 0.001, prod['dL'])
+        nB = len(Bbins) - 1
+        nL = len(Lbins) - 1
+        ib, il = hlib.lb_labels(nside, Bbins, Lbins, mask=load_mask(prod, nside))
+        matrix = profiles.label_matrix(profiles.box_labels(ib, il, nL), nB * nL)
+        _labels[key] = (matrix, Bbins, Lbins)
+    return _labels[key]
+
+
+def input_fns(prod):
+    fns = [prod['expo_fn'], prod['counts_fn']]
+    if prod['map_fn'] is not None:
+        fns.append(prod['map_fn'])
+    return fns
+
+
+########################################################################################################################## Profiles
+
+
+def calc_dct(prod):
+    '''
+    calculate the profile dictionary of one product
+    '''
+    expo_cube, Es_all = load_cube(prod['expo_fn'])
+    npix = expo_cube.shape[0]
+    nside = healpy.npix2nside(npix)
+    matrix, Bbins, Lbins = get_matrix(prod, nside)
+    nB = len(Bbins) - 1
+    nL = len(Lbins) - 1
+    shape = (nB, nL, prod['binmax'] - prod['binmin'] + 1)
+
+    exposure = expo_cube[:, _energy_slice(prod, prod['expo_fn'])]
+    Es = Es_all[_energy_slice(prod, prod['expo_fn'])]
+    deltaE = Es * (np.exp(delta/2) - np.exp(-delta/2))
+    stats = profiles.box_stats(exposure, None, nB * nL, matrix=matrix)
+    npix_box = stats['npix'].reshape((nB, nL))
+    dOmega = 4. * np.pi * npix_box / npix                                              # solid angle of the regions
+
+    dct = {'1) Comment': prod['comment']}
+    dct['3) Center_of_lon_bins'] = (Lbins[:-1] + Lbins[1:])/2
+    dct['4) Center_of_lat_bins'] = (Bbins[1:] + Bbins[:-1])/2
+    dct['5) Energy_bins'] = Es
+
+    if prod['kind'] == 'expo':
+        dct['2) Unit'] = '1 / (cm^2 s), sr, GeV'
+        dct['6) Exposure_profiles'] = stats['mean'].reshape(shape)
+        dct['7) dOmega_profiles'] = dOmega
+        dct['8) deltaE'] = deltaE
+        return dct
+
+    cube, Es_map = load_cube(prod['map_fn'])
+    data = cube[:, _energy_slice(prod, prod['map_fn'])]
+    counts = load_cube(prod['counts_fn'])[0][:, _energy_slice(prod, prod['counts_fn'])]
+    if prod['kind'] in ['lowE', 'boxes']:
+        dct['5) Energy_bins'] = Es_map[_energy_slice(prod, prod['map_fn'])]
+
+    N_gamma = profiles.box_sums(counts, matrix).reshape(shape)
+    if prod['kind'] in ['data', 'GALPROP']:                                              # maps in counts
+        if prod['save_counts']:
+            diff = profiles.box_sums(data, matrix).reshape(shape)
+        else:
+            diff = profiles.box_sums(data / exposure, matrix).reshape(shape)
+            diff = (Es**2 * diff) / (deltaE * dOmega[:,:,np.newaxis])                  # E^2 * N_gamma / (exposure * dOmega * deltaE)
+    else:                                                                               # lowE and boxes maps
+        diff = profiles.box_sums(data, matrix).reshape(shape)
+        if not prod['save_counts']:
+            diff /= npix_box[:,:,np.newaxis]                                            # mean since this is diff flux
+
+    if prod['zero_threshold'] == 0.:
+        N_gamma[N_gamma == 0] = 0.1                                                     # delete empty lat lon bins
+    else:
+        N_gamma[(N_gamma >= 0) & (N_gamma < prod['zero_threshold'])] = 0.1
+
+    dct['2) Unit'] = ('GeV / (cm^2 s sr)', 'counts')[prod['save_counts']]
+    dct['6) Differential_flux_profiles'] = diff
+    dct['7) Standard_deviation_profiles'] = diff / np.sqrt(N_gamma)                   # standard deviation via Gaussian error propagation
+    return dct
+
+
+def _run_one(i):
+    prod = _products[i]
+    dct = calc_dct(prod)
+    dio.saveyaml(dct, prod['dct_fn'], expand=True)
+    return prod['dct_fn']
+
+
+_products = []
+
+
+def run(products, nproc=1):
+    '''
+        calculate and save all dictionaries
+    INPUT:
+        products - list of product dictionaries
+        nproc - number of processes (the cubes are loaded before the fork and shared)
+    OUTPUT:
+        list of saved file names
+    '''
+    del _products[:]
+    missing = []
+    for prod in products:
+        fns = [fn for fn in input_fns(prod) if not os.path.isfile(fn)]
+        if len(fns) > 0:
+            print 'skip %s, missing input:' % prod['dct_fn'], fns
+            missing.append(prod)
+            continue
+        _products.append(prod)
+        for fn in input_fns(prod):
+            load_cube(fn)
+        npix = load_cube(prod['expo_fn'])[0].shape[0]
+        get_matrix(prod, healpy.npix2nside(npix))
+
+    for prod in _products:
+        folder = os.path.dirname(prod['dct_fn'])
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    if nproc > 1 and len(_products) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc)
+        res = pool.map(_run_one, range(len(_products)))
+        pool.close()
+        pool.join()
+    else:
+        res = [_run_one(i) for i in range(len(_products))]
+    return res
@@ -28,6 +28,16 @@ def get_hash(x):
         string = str(x)
     return zlib.adler32(string) & 0xffffffff
 
+def get_file_hash(fn, chunk_size=2**20):
+    # hash of the content of a file, the file is read in chunks
+    value = 1
+    with open(fn, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            value = zlib.adler32(chunk, value)
+            chunk = f.read(chunk_size)
+    return value & 0xffffffff
+
 def sub_dict(indict, key_list):
     return {key: indict.get(key) for key in key_list}
 
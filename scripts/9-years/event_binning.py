@@ -0,0 +1,289 @@
+"""
+Binning of photon event lists (FT1-like tables) into healpix counts cubes.
+
+The events are read in chunks of rows from memory-mapped fits tables (extension EVENTS)
+or from .npy record arrays, so that the memory does not grow with the number of events.
+The events are selected by the data class (EVENT_CLASS bit and zenith angle cut).
+In every chunk the pixels are calculated once per nside and the energy bins once per
+energy binning, the counts are added with np.bincount on the combined index E_bin * npix + pixel.
+In this way several nsides and energy binnings are filled in one pass over the events.
+The cubes are energy-major (nE, npix) as in cube_cache. Cubes with more than max_cells cells are
+filled in blocks of energy bins, with memmap=True the cubes are accumulated on the disk.
+At the end the cubes are saved as fits skymaps (skymap_io) and put to the cube cache
+(cube_cache.store), so that cube_cache.load serves them without a conversion.
+
+Usage:
+    import event_binning
+    binnings = [event_binning.Binning('counts_o7_24bins.fits', 128, event_binning.log_bins(0.1, 1000., 24)),
+                event_binning.Binning('counts_o8_12bins.fits', 256, event_binning.log_bins(0.1, 1000., 12))]
+    event_binning.bin_events(['ft1_00.fits', 'ft1_01.fits'], binnings, data_class='source')
+    cube, Es = cube_cache.load('counts_o7_24bins.fits')
+
+    event_binning.synthetic_events('events.fits', 10**7)                        # random events for tests
+"""
+
+import os
+import time
+import numpy as np
+import healpy
+import pyfits
+import healpylib as hlib
+import cube_cache
+import skymap_io
+
+
+GeV2MeV = 1000.
+chunk_size = 2**21                                # number of events read at once
+max_cells = 2**24                                 # max length of the np.bincount output (energy bins x pixels)
+
+# EVENT_CLASS bits and zenith angle cuts (deg) of the data classes in dct_engine.counts_fns (Pass 8)
+data_classes = {'source': {'evclass': 128, 'zmax': 100.},
+                'ultraclean': {'evclass': 1024, 'zmax': 90.}}                      # UltracleanVeto
+
+event_columns = [('ENERGY', 'E', 'MeV'), ('RA', 'E', 'deg'), ('DEC', 'E', 'deg'), ('L', 'E', 'deg'), ('B', 'E', 'deg'),
+                 ('ZENITH_ANGLE', 'E', 'deg'), ('EVENT_CLASS', 'J', None), ('TIME', 'D', 's')]
+
+
+####################################################################################################################### Binnings
+
+
+def log_bins(emin, emax, nE):
+    '''
+    edges of nE logarithmic energy bins between emin and emax
+    '''
+    return emin * (float(emax) / emin)**(np.arange(nE + 1.) / nE)
+
+
+class Binning(object):
+    '''
+        counts cube of one nside and one energy binning
+    INPUT:
+        fn - fits file of the cube
+        nside - healpix parameter
+        Ebins - edges of the energy bins in GeV, the bins are [Ebins[i], Ebins[i+1])
+        nest - healpix ordering
+        memmap - if True, then the cube is accumulated in a memory-mapped file in the cache directory
+    '''
+    def __init__(self, fn, nside, Ebins, nest=False, memmap=False):
+        self.fn = fn
+        self.nside = nside
+        self.npix = healpy.nside2npix(nside)
+        self.Ebins = np.array(Ebins, dtype=np.float64)
+        self.nE = len(self.Ebins) - 1
+        self.Es = np.sqrt(self.Ebins[1:] * self.Ebins[:-1])
+        self.nest = nest
+        self.tmp_fn = None
+        if memmap:
+            folder = hlib.cache_dir + 'cubes/'
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.tmp_fn = folder + os.path.basename(fn) + '.binning%i.npy' % os.getpid()
+            self.counts = np.lib.format.open_memmap(self.tmp_fn, mode='w+', dtype=np.int32, shape=(self.nE, self.npix))
+        else:
+            self.counts = np.zeros((self.nE, self.npix), dtype=np.int32)
+
+    def __repr__(self):
+        return 'Binning(nside=%i, nE=%i, %s)' % (self.nside, self.nE, self.fn)
+
+    def add(self, ie, pix):
+        '''
+        add the events with energy bins ie (0 <= ie < nE) and pixels pix
+        '''
+        block = max(max_cells // self.npix, 1)
+        if block >= self.nE:
+            counts = np.bincount(ie * self.npix + pix, minlength=self.nE * self.npix)
+            self.counts += counts.reshape((self.nE, self.npix))
+            return
+        order = np.argsort(ie, kind='mergesort')
+        ie = ie[order]
+        pix = pix[order]
+        for E0 in xrange(0, self.nE, block):
+            E1 = min(E0 + block, self.nE)
+            i0, i1 = np.searchsorted(ie, [E0, E1])
+            if i1 > i0:
+                counts = np.bincount((ie[i0:i1] - E0) * self.npix + pix[i0:i1], minlength=(E1 - E0) * self.npix)
+                self.counts[E0:E1] += counts.reshape((E1 - E0, self.npix))
+
+    def save(self, silent=False):
+        '''
+        write the fits skymap and put the cube to the cube cache
+        '''
+        ordering = 'NESTED' if self.nest else 'RING'
+        skymap_io.write_cube(self.fn, self.counts, unit='counts', Es=self.Es, energy_major=True,
+                             ordering=ordering, silent=silent)
+        cube_cache.store(self.fn, self.counts, Es=self.Es, dtype=np.float32, ordering=ordering)
+        if self.tmp_fn is not None:
+            del self.counts
+            os.remove(self.tmp_fn)
+            self.tmp_fn = None
+            self.counts, Es = cube_cache.load(self.fn)
+
+
+####################################################################################################################### Events
+
+
+def read_events(fn, chunk_size=chunk_size):
+    '''
+        generator of the events of an FT1-like file in chunks of rows
+    INPUT:
+        fn - fits file with the extension EVENTS or .npy file with a record array
+        chunk_size - number of rows in a chunk
+    OUTPUT:
+        chunks - record arrays with the columns ENERGY (MeV), L, B or RA, DEC (deg),
+                 EVENT_CLASS and ZENITH_ANGLE (optional)
+    '''
+    hdu = None
+    if fn.endswith('.npy'):
+        table = np.load(fn, mmap_mode='r')
+    else:
+        hdu = pyfits.open(fn, memmap=True)
+        table = hdu['EVENTS'].data
+    for i in xrange(0, len(table), chunk_size):
+        yield table[i:i + chunk_size]
+    if hdu is not None:
+        hdu.close()
+
+
+def _event_class(evclass):
+    '''
+    EVENT_CLASS as integer bit masks (the fits format 32X is read as a bool array, highest bit first)
+    '''
+    evclass = np.asarray(evclass)
+    if evclass.dtype == bool:
+        evclass = np.dot(evclass, 2**np.arange(evclass.shape[1] - 1, -1, -1, dtype=np.int64))
+    return evclass.astype(np.int64)
+
+
+def select(chunk, data_class=None):
+    '''
+    bool array: the events of the data class (all events if data_class is None)
+    '''
+    if data_class is None:
+        return np.ones(len(chunk), dtype=bool)
+    cuts = data_classes[data_class]
+    sel = (_event_class(chunk['EVENT_CLASS']) & cuts['evclass']) != 0
+    if 'ZENITH_ANGLE' in chunk.dtype.names:
+        sel &= np.asarray(chunk['ZENITH_ANGLE']) < cuts['zmax']
+    return sel
+
+
+def galactic_angles(chunk):
+    '''
+    healpix angles (theta, phi) in radians of the events in galactic coordinates
+    '''
+    if 'L' in chunk.dtype.names and 'B' in chunk.dtype.names:
+        theta = np.deg2rad(90. - np.asarray(chunk['B'], dtype=np.float64))
+        phi = np.deg2rad(np.asarray(chunk['L'], dtype=np.float64))
+        return theta, phi
+    theta = np.deg2rad(90. - np.asarray(chunk['DEC'], dtype=np.float64))
+    phi = np.deg2rad(np.asarray(chunk['RA'], dtype=np.float64))
+    theta, phi = healpy.Rotator(coord=['C', 'G'])(theta, phi)
+    return theta, phi % (2 * np.pi)
+
+
+def bin_events(fns, binnings, data_class=None, chunk_size=chunk_size, save=True, silent=False):
+    '''
+        fill the counts cubes of all binnings in one pass over the events
+    INPUT:
+        fns - FT1-like file name or list of file names
+        binnings - list of Binning
+        data_class - key of data_classes or None (all events)
+        chunk_size - number of events read at once
+        save - if True, then the cubes are saved in the fits files and in the cube cache
+    OUTPUT:
+        stats - dictionary: numbers of events ('read', 'selected', 'binned' per fits file of the binnings) and time (s)
+    '''
+    if isinstance(fns, str):
+        fns = [fns]
+    stats = {'read': 0, 'selected': 0, 'binned': dict([(binning.fn, 0) for binning in binnings])}
+    t0 = time.time()
+    for fn in fns:
+        nread = stats['read']
+        for chunk in read_events(fn, chunk_size=chunk_size):
+            sel = select(chunk, data_class=data_class)
+            theta, phi = galactic_angles(chunk)
+            energies = np.asarray(chunk['ENERGY'], dtype=np.float64) / GeV2MeV
+            stats['read'] += len(chunk)
+            if not np.all(sel):
+                theta = theta[sel]
+                phi = phi[sel]
+                energies = energies[sel]
+            stats['selected'] += len(energies)
+
+            pixels = {}                                                          # per (nside, nest)
+            ebins = {}                                                           # per energy binning
+            for binning in binnings:
+                pkey = (binning.nside, binning.nest)
+                if pkey not in pixels:
+                    pixels[pkey] = healpy.ang2pix(binning.nside, theta, phi, nest=binning.nest)
+                ekey = binning.Ebins.tostring()
+                if ekey not in ebins:
+                    ebins[ekey] = np.searchsorted(binning.Ebins, energies, side='right') - 1
+                ie = ebins[ekey]
+                inside = (ie >= 0) & (ie < binning.nE)
+                binning.add(ie[inside], pixels[pkey][inside])
+                stats['binned'][binning.fn] += int(np.sum(inside))
+        if not silent:
+            print '%s: %i events, %.1f s' % (fn, stats['read'] - nread, time.time() - t0)
+    if save:
+        for binning in binnings:
+            binning.save(silent=silent)
+    stats['time'] = time.time() - t0
+    return stats
+
+
+####################################################################################################################### Synthetic events
+
+
+def synthetic_events(fn, nevents, seed=0, chunk_size=chunk_size, index=2.4, emin=0.1, emax=1000.,
+                     gal_fraction=0.7, silent=False):
+    '''
+        FT1-like file with random events for tests and benchmarks
+        isotropic events and events concentrated at the galactic plane and the GC (Laplace distributions
+        in b and l with the widths 5 deg and 40 deg), power-law energies dN/dE ~ E^-index between emin and emax (GeV),
+        hierarchical EVENT_CLASS bits (SOURCE 128, CLEAN 256, ULTRACLEAN 512, ULTRACLEANVETO 1024)
+    INPUT:
+        fn - fits file (extension EVENTS) or .npy file (record array)
+        nevents - number of events
+        seed - random seed
+    '''
+    rnd = np.random.RandomState(seed)
+    rotator = healpy.Rotator(coord=['G', 'C'])
+    dtype = np.dtype([(column, skymap_io.column_dtype(fmt)) for column, fmt, unit in event_columns])
+    if fn.endswith('.npy'):
+        folder = os.path.dirname(fn)                           # the fits files are created in the same way by skymap_io
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        table = np.lib.format.open_memmap(fn, mode='w+', dtype=dtype.newbyteorder('='), shape=(nevents,))
+    else:
+        writer = skymap_io.TableWriter(fn, nevents, event_columns, extname='EVENTS')
+    t0 = time.time()
+    for i in xrange(0, nevents, chunk_size):
+        n = min(chunk_size, nevents - i)
+        gal = rnd.rand(n) < gal_fraction
+        B = np.where(gal, np.clip(rnd.laplace(0., 5., n), -90., 90.), np.rad2deg(np.arcsin(rnd.uniform(-1., 1., n))))
+        L = np.where(gal, rnd.laplace(0., 40., n), rnd.uniform(0., 360., n)) % 360.
+        theta, phi = rotator(np.deg2rad(90. - B), np.deg2rad(L))
+        u = rnd.rand(n)
+        E = emin * (1. - u * (1. - (emax / emin)**(1. - index)))**(1. / (1. - index))
+        evclass = 128 + 256 * (rnd.rand(n) < 0.8)
+        evclass += 512 * ((evclass & 256) > 0) * (rnd.rand(n) < 0.7)
+        evclass += 1024 * ((evclass & 512) > 0) * (rnd.rand(n) < 0.8)
+        chunk = {'ENERGY': E * GeV2MeV, 'RA': np.rad2deg(phi) % 360., 'DEC': 90. - np.rad2deg(theta),
+                 'L': L, 'B': B, 'ZENITH_ANGLE': rnd.uniform(0., 110., n), 'EVENT_CLASS': evclass,
+                 'TIME': 2.4e8 + 10. * (i + np.arange(n))}
+        if fn.endswith('.npy'):
+            for column in dtype.names:
+                table[column][i:i + n] = chunk[column]
+        else:
+            writer.write(chunk)
+    if fn.endswith('.npy'):
+        table.flush()
+        del table
+    else:
+        writer.close()
+    if not silent:
+        print 'save %i events to file:' % nevents
+        print fn
+        print 'time: %.1f s' % (time.time() - t0)
+    return None
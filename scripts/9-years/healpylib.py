@@ -33,7 +33,12 @@ __all__ = ['step', 'pix2BL', 'BL2pix', 'func2fpix', 'data2fpix', 'heal', 'gaussB
 
 import numpy as np
 import math
+import os
+import hashlib
+import collections
 import healpy
+from scipy import sparse
+from scipy.sparse import csgraph
 #import scipy
 #from scipy import optimize
 #import copy
@@ -49,6 +54,9 @@ from matplotlib import pyplot
 epsilon = 1.e-15
 log_eps = np.log(epsilon)
 
+# directory for the cached pixel labels, neighbour tables etc
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/cache/')
+
 #########################################################################
 #                                                                       #
 #           general functions                                           #
@@ -87,12 +95,12 @@ def get_root(nside, p, nside_root=None, nest=False):
     
     ratio = nside / nside_root
     if not nest:
-        p = healpy.ring2nest(nside, p)
+        p = ring2nest(nside, p)
     if isinstance(p, list):
         p = np.array(p)
     res = p / ratio**2
     if not nest:
-        res = healpy.nest2ring(nside_root, res)
+        res = nest2ring(nside_root, res)
     return res
     
 
@@ -104,10 +112,10 @@ def get_daughters(nside, p, nside_new=None, nest=False):
         return p
     ratio = int(nside_new/nside)
     if not nest:
-        p = healpy.ring2nest(nside, p)
+        p = ring2nest(nside, p)
     res = range(p * ratio**2, (p + 1) * ratio**2)
     if not nest:
-        return healpy.nest2ring(nside_new, res)
+        return nest2ring(nside_new, res)
     else:
         return res
 
@@ -124,15 +132,97 @@ def get_daughters_matrix(nside, p, nside_new=None, nest=False):
         return p
     p = np.array(p)
     if not nest:
-        p = healpy.ring2nest(nside, p)
+        p = ring2nest(nside, p)
     nd = int(nside_new/nside)**2
     res = nd * np.outer(np.array(p), np.ones(nd, dtype=int)) + np.arange(nd)
     if not nest:
-        res = np.array(healpy.nest2ring(nside_new, res))
+        res = np.array(nest2ring(nside_new, res))
     return res
 
 
+_orderings = {}
+ordering_max_nside = 1024                         # the permutations are cached up to this nside
+
+
+def ordering_inds(nside, transform='ring2nest', use_cache=True):
+    '''
+        permutation between the RING and the NESTED orderings, calculated once per nside
+    INPUT:
+        nside - healpix parameter
+        transform - 'ring2nest': healpy.ring2nest(nside, range(npix)), the nested indices of the ring pixels,
+                    'nest2ring': healpy.nest2ring(nside, range(npix))
+        use_cache - the permutation is saved in cache_dir and loaded in the next sessions
+    OUTPUT:
+        inds - int array, shape (npix,)
+    USAGE:
+        ring_map = nest_map[ordering_inds(nside, 'ring2nest')]
+        nest_cube = ring_cube[:, ordering_inds(nside, 'nest2ring')]      # cube.shape = (nE, npix)
+    '''
+    key = (nside, transform)
+    if key not in _orderings:
+        fn = cache_dir + 'ordering_%s_nside%i.npy' % (transform, nside)
+        if use_cache and os.path.isfile(fn):
+            _orderings[key] = np.array(np.load(fn), dtype=np.int64)
+        else:
+            func = {'ring2nest': healpy.ring2nest, 'nest2ring': healpy.nest2ring}[transform]
+            _orderings[key] = np.array(func(nside, np.arange(healpy.nside2npix(nside))), dtype=np.int64)
+            if use_cache:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_fn = fn + '.tmp%i.npy' % os.getpid()
+                np.save(tmp_fn, np.array(_orderings[key], dtype=np.int32))
+                os.rename(tmp_fn, fn)
+    return _orderings[key]
+
+
+def ring2nest(nside, p):
+    '''
+    healpy.ring2nest with the cached permutation for nside <= ordering_max_nside
+    '''
+    if nside > ordering_max_nside:
+        return healpy.ring2nest(nside, p)
+    return ordering_inds(nside, 'ring2nest')[p]
+
+
+def nest2ring(nside, p):
+    '''
+    healpy.nest2ring with the cached permutation for nside <= ordering_max_nside
+    '''
+    if nside > ordering_max_nside:
+        return healpy.nest2ring(nside, p)
+    return ordering_inds(nside, 'nest2ring')[p]
+
+
+def reorder(array, r2n=False, n2r=False, axis=0):
+    '''
+        change the ordering of a map or a data cube with one fancy-index operation
+    INPUT:
+        array - array_like, the pixels are along the axis
+        r2n - RING to NESTED
+        n2r - NESTED to RING
+        axis - pixel axis, e.g. 0 for (npix, nE) and -1 for (nE, npix) cubes
+    '''
+    array = np.asarray(array)
+    if r2n == n2r:
+        return array
+    nside = healpy.npix2nside(array.shape[axis])
+    inds = ordering_inds(nside, 'nest2ring' if r2n else 'ring2nest')
+    return np.take(array, inds, axis=axis)
+
+
 def map2map(array, transform):
+    '''
+    res[i] = array[transform(nside, i)], the ring2nest and nest2ring permutations are cached
+    '''
+    npix = len(array)
+    nside = healpy.npix2nside(npix)
+    if transform is healpy.ring2nest or transform is healpy.nest2ring:
+        inds = ordering_inds(nside, transform.__name__)
+    else:
+        inds = transform(nside, np.arange(npix))
+    return np.asarray(array)[inds]
+
+def map2map_old(array, transform):
     npix = len(array)
     nside = healpy.npix2nside(npix)
     inds = transform(nside, range(npix))
@@ -146,6 +236,14 @@ def ring_array2nest_array(array):
 
 
 def get_all_neib(nside, p, depth = 0, nest = False):
+    """
+    get all nearest neighbors with depth = depth (see kring)
+    
+    """
+    return kring(nside, p, k=depth, nest=nest)
+
+
+def get_all_neib_old(nside, p, depth = 0, nest = False):
     """
     get all nearest neighbors with depth = depth
     
@@ -305,6 +403,110 @@ def data2fpix(nside, Bs, Ls, nest=False):
 
 
 
+def _cache_fn(name, nside, *arrays):
+    '''
+    file name in the cache directory keyed by nside and the shapes, dtypes and content of arrays (sha1)
+    '''
+    key = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        key.update('%s %s;' % (array.shape, array.dtype.str))
+        key.update(array.tostring())
+    return cache_dir + '%s_nside%i_%s.npy' % (name, nside, key.hexdigest())
+
+
+def _save_cache(fn, array):
+    '''
+    save array to fn in the cache directory: written to a temporary file and renamed,
+    so that processes reading the cache at the same time never see a partial file
+    '''
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:                                   # created by another process in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+    tmp_fn = fn + '.tmp%i.npy' % os.getpid()
+    np.save(tmp_fn, array)
+    os.rename(tmp_fn, fn)
+
+
+def lb_labels(nside, Bbins, Lbins, mask=None, nest=False, use_cache=True):
+    '''
+        lat and lon bin indices for all healpix pixels
+        the bins are (Bbins[i], Bbins[i+1]], pixels outside of (Bbins[0], Bbins[-1])
+        or (Lbins[0], Lbins[-1]) get the label -1 (same convention as in lb_profiles_hinds_dict)
+    INPUT:
+        nside - healpix parameter
+        Bbins - list, B bins in deg
+        Lbins - list, L bins in deg (between -180 and 180)
+        mask - healpix mask map - if mask[i] == 0, then the labels of pixel "i" are -1
+        nest - healpix ordering
+        use_cache - the labels are saved in cache_dir, keyed by (nside, Bbins, Lbins)
+    OUTPUT:
+        ib, il - int arrays, shape (npix,): lat and lon indices of the pixels
+    '''
+    fn = _cache_fn('lb_labels' + '_nest' * nest, nside, Bbins, Lbins)
+    if use_cache and os.path.isfile(fn):
+        ib, il = np.load(fn)
+    else:
+        npix = healpy.nside2npix(nside)
+        bbins = np.deg2rad(Bbins)
+        lbins = np.deg2rad(Lbins)
+        theta, ll = healpy.pix2ang(nside, np.arange(npix), nest=nest)
+        bb = 0.5 * np.pi - theta
+        ll = np.where(ll > np.pi, ll - 2 * np.pi, ll)
+        inside = (bb > bbins[0]) & (bb < bbins[-1]) & (ll > lbins[0]) & (ll < lbins[-1])
+        ib = np.where(inside, np.searchsorted(bbins, bb) - 1, -1)
+        il = np.where(inside, np.searchsorted(lbins, ll) - 1, -1)
+        if use_cache:
+            _save_cache(fn, np.array([ib, il], dtype=np.int32))
+    ib = np.array(ib, dtype=int)
+    il = np.array(il, dtype=int)
+    if mask is not None:
+        masked = np.asarray(mask) <= 0
+        ib[masked] = -1
+        il[masked] = -1
+    return ib, il
+
+
+class LBIndsDict(collections.Mapping):
+    '''
+    dictionary view {(lat_index, lon_index): healpix_inds} of the pixel labels
+    the lists of indices are calculated at the first access
+    '''
+    def __init__(self, ib, il, nB, nL):
+        self.ib = ib
+        self.il = il
+        self.nB = nB
+        self.nL = nL
+        self._inds = None
+
+    def _build(self):
+        inside = self.ib >= 0
+        code = self.ib[inside] * self.nL + self.il[inside]
+        pixels = np.arange(len(self.ib))[inside]
+        order = np.argsort(code, kind='mergesort')
+        counts = np.bincount(code, minlength=self.nB * self.nL)
+        groups = np.split(pixels[order], np.cumsum(counts)[:-1])
+        self._inds = {}
+        for n, group in enumerate(groups):
+            self._inds[(n // self.nL, n % self.nL)] = group.tolist()
+
+    def __getitem__(self, key):
+        if self._inds is None:
+            self._build()
+        return self._inds[key]
+
+    def __iter__(self):
+        for i in xrange(self.nB):
+            for j in xrange(self.nL):
+                yield (i, j)
+
+    def __len__(self):
+        return self.nB * self.nL
+
+
 # create a dictionary of Healpix indices in L and B bins
 def lb_profiles_hinds_dict(nside, Bbins, Lbins, mask=None):
     '''
@@ -314,12 +516,20 @@ def lb_profiles_hinds_dict(nside, Bbins, Lbins, mask=None):
         Lbins - list, L bins in deg
         mask - healpix mask map - if mask[i] == 0, then the pixel "i" is omitted
         OUTPUT:
-        a dictionary {(lon_index, lat_index): healpix_inds}, where healpix_inds are the indices of healpix pixels inside the lat-lon bin,
+        a dictionary {(lat_index, lon_index): healpix_inds}, where healpix_inds are the indices of healpix pixels inside the lat-lon bin,
         example:
         ind_dict = make_inds(nside, Bbins, Lbins, mask=mask)
         inds = ind_dict[(0, 0)] - gives healpix indices in the first lat-lon bin
-        
+        the labels are calculated with lb_labels, the lists of indices are created at the first access
         '''
+    ib, il = lb_labels(nside, Bbins, Lbins, mask=mask)
+    return LBIndsDict(ib, il, len(Bbins) - 1, len(Lbins) - 1)
+
+
+def lb_profiles_hinds_dict_old(nside, Bbins, Lbins, mask=None):
+    '''
+    pixel by pixel version of lb_profiles_hinds_dict
+    '''
     npix = healpy.nside2npix(nside)
     bbins = np.deg2rad(Bbins)
     lbins = np.deg2rad(Lbins)
@@ -342,7 +552,58 @@ def lb_profiles_hinds_dict(nside, Bbins, Lbins, mask=None):
     return inds
 
 
+def inds_dict2labels(inds_dict, npix):
+    '''
+        integer labels of lat-lon bins for all pixels
+    INPUT:
+        inds_dict - dictionary {(lat_index, lon_index): healpix_inds}, e.g. from lb_profiles_hinds_dict
+        npix - number of healpix pixels
+    OUTPUT:
+        ib, il - int arrays, shape (npix,): lat and lon indices of the pixels,
+            -1 if the pixel is not in any bin (e.g. masked)
+    '''
+    if isinstance(inds_dict, LBIndsDict):
+        return inds_dict.ib.copy(), inds_dict.il.copy()
+    ib = -np.ones(npix, dtype=int)
+    il = -np.ones(npix, dtype=int)
+    for (i, j), inds in inds_dict.items():
+        ib[inds] = i
+        il[inds] = j
+    return ib, il
+
+
 def fpix_lb_profiles(fpix, inds_dict, nB, nL, std=0):
+    '''
+        put fpix in lat-lon bins
+        INPUT:
+        fpix - healpix map or an array with dimensions (nmaps, npix)
+        inds_dict - dictionary of healpix indices in lat-lon bins, {(lat_index, lon_index): healpix_inds}
+        nB - number of lat bins
+        nL - number of lon bins
+        std - if 0, the value is found by averaging over pixels in the bin (intensity average)
+        if 1, then the value is found as sqrt(sum f_i**2)) / n, which is the std of the average
+        OUTPUT:
+        nB by nL array of average values in lat-lon bins
+        the sums over pixels are calculated with np.bincount (see fpix_lb_profiles_old for the loop version)
+        '''
+    npix = fpix.shape[-1]
+    ib, il = inds_dict2labels(inds_dict, npix)
+    inside = (ib >= 0) & (il >= 0)
+    labels = (ib * nL + il)[inside]
+    nn = np.bincount(labels, minlength=nB * nL)
+    nn = np.maximum(nn, 1)
+    if std:
+        power = 2
+    else:
+        power = 1
+    maps = np.reshape(fpix, (-1, npix))[:, inside]
+    res = np.array([np.bincount(labels, weights=fmap**power, minlength=nB * nL) for fmap in maps]) / nn**power
+    if std:
+        res = np.sqrt(res)
+    return res.reshape(np.shape(fpix)[:-1] + (nB, nL))
+
+
+def fpix_lb_profiles_old(fpix, inds_dict, nB, nL, std=0):
     '''
         put fpix in lat-lon bins
         INPUT:
@@ -377,6 +638,156 @@ def fpix_lb_profiles(fpix, inds_dict, nB, nL, std=0):
     return res
 
 
+#########################################################################
+#                                                                       #
+#           pixel index for region queries                              #
+#                                                                       #
+#########################################################################
+
+
+class PixelIndex(object):
+    '''
+        index of the healpix pixels: the rings sorted by latitude (north to south) and the pixels
+        sorted by longitude within the rings (RING ordering). A region query visits only the rings
+        and the pixels of the candidate range, so that it scales with the size of the region.
+        The pixel centers are tested exactly with healpy.pix2ang / pix2vec.
+    INPUT:
+        nside - healpix parameter
+    USAGE:
+        index = healpylib.pixel_index(nside)
+        inds = index.rectangle(-10., 10., -20., 20.)      # (bmin, bmax] x (lmin, lmax] in deg
+        inds = index.disc(0., 0., 10.)                    # distance to (B0, L0) < radius
+        inds = index.annulus(0., 0., 2., 10.)             # rmin <= distance < rmax
+    '''
+    def __init__(self, nside):
+        self.nside = nside
+        self.npix = healpy.nside2npix(nside)
+        rings = np.arange(1, 4 * nside)
+        start, length, costheta, sintheta, shifted = healpy.ringinfo(nside, rings)
+        self.start = np.array(start, dtype=np.int64)
+        self.length = np.array(length, dtype=np.int64)
+        self.B = np.arcsin(costheta)                       # latitude of the rings, decreasing
+        self.dphi = 2 * np.pi / self.length
+        self.phi0 = np.where(shifted, 0.5 * self.dphi, 0.)
+
+    def _ring_range(self, bmin, bmax):
+        '''
+        rings with the latitudes in (bmin, bmax) with a margin of one ring (radians)
+        '''
+        r0 = max(np.searchsorted(-self.B, -bmax) - 1, 0)
+        r1 = min(np.searchsorted(-self.B, -bmin) + 1, len(self.B))
+        return np.arange(r0, r1)
+
+    def _candidates(self, rings, phimin, phimax):
+        '''
+        pixels in the rings with the longitudes in (phimin, phimax) with a margin of one pixel (radians, 0 <= phi <= 2 pi)
+        '''
+        jmin = np.floor((phimin - self.phi0[rings]) / self.dphi[rings]).astype(np.int64)
+        jmax = np.ceil((phimax - self.phi0[rings]) / self.dphi[rings]).astype(np.int64)
+        jmin = np.maximum(jmin, 0)
+        jmax = np.minimum(jmax, self.length[rings] - 1)
+        counts = np.maximum(jmax - jmin + 1, 0)
+        first = self.start[rings] + jmin
+        shift = np.repeat(first - np.cumsum(counts) + counts, counts)
+        return shift + np.arange(np.sum(counts))
+
+    def _output(self, inds, nest):
+        if nest:
+            return np.sort(ring2nest(self.nside, inds))
+        return inds
+
+    def rectangle(self, bmin, bmax, lmin=-180., lmax=180., nest=False, rad=False):
+        '''
+            pixels with the centers in the lat-lon rectangle (bmin, bmax] x (lmin, lmax]
+            (the bins of lb_labels), adjacent rectangles do not overlap
+            the pixels on the l = 180 deg meridian are excluded for lmax = 180 (as in lb_labels,
+            where the last bin edges are open), so that the lon bins between -180 and 180 contain
+            the same pixels as the bins of lb_labels
+        INPUT:
+            bmin, bmax - latitude range
+            lmin, lmax - longitude range, -180 <= lmin < lmax <= 180 (deg)
+            nest - if True, then the output pixels are in nested format
+            rad - if True, then the angles are in radians, otherwise in deg
+        OUTPUT:
+            inds - sorted int array of pixels
+        '''
+        if not rad:
+            bmin, bmax, lmin, lmax = np.deg2rad([bmin, bmax, lmin, lmax])
+        rings = self._ring_range(bmin, bmax)
+        if lmin >= 0.:
+            segments = [(lmin, lmax)]
+        elif lmax < 0.:
+            segments = [(lmin + 2 * np.pi, lmax + 2 * np.pi)]
+        else:
+            segments = [(lmin + 2 * np.pi, 2 * np.pi), (0., lmax)]
+        inds = np.unique(np.concatenate([self._candidates(rings, phimin, phimax) for phimin, phimax in segments]))
+        theta, ll = healpy.pix2ang(self.nside, inds)
+        bb = 0.5 * np.pi - theta
+        ll = np.where(ll > np.pi, ll - 2 * np.pi, ll)
+        inside = (bb > bmin) & (bb <= bmax) & (ll > lmin) & (ll <= lmax)
+        if lmax >= np.pi:
+            inside &= ll < np.pi
+        return self._output(inds[inside], nest)
+
+    def _disc_candidates(self, B0, L0, radius):
+        vec0 = np.array(BL2xyz(B0, L0))
+        inds = np.sort(healpy.query_disc(self.nside, vec0, radius, inclusive=True))
+        return inds, vec0
+
+    def disc(self, B0, L0, radius, nest=False, rad=False):
+        '''
+            pixels with the centers at a distance < radius from (B0, L0) (same test as in mask_circle)
+        INPUT:
+            B0, L0 - center of the disc
+            radius - radius of the disc
+            nest - if True, then the output pixels are in nested format
+            rad - if True, then the angles are in radians, otherwise in deg
+        OUTPUT:
+            inds - sorted int array of pixels
+        '''
+        return self.annulus(B0, L0, 0., radius, nest=nest, rad=rad)
+
+    def annulus(self, B0, L0, rmin, rmax, nest=False, rad=False):
+        '''
+            pixels with the centers at a distance rmin <= r < rmax from (B0, L0)
+        INPUT:
+            B0, L0 - center of the annulus
+            rmin, rmax - inner and outer radii
+            nest - if True, then the output pixels are in nested format
+            rad - if True, then the angles are in radians, otherwise in deg
+        OUTPUT:
+            inds - sorted int array of pixels
+        '''
+        if not rad:
+            B0, L0, rmin, rmax = np.deg2rad([B0, L0, rmin, rmax])
+        inds, vec0 = self._disc_candidates(B0, L0, rmax)
+        n1 = np.array(healpy.pix2vec(self.nside, inds)).T
+        inside = np.sum((1 / (2 * np.sin(rmax / 2)) * (n1 - vec0))**2, axis=1) < 1.
+        if rmin > 0.:
+            inside &= np.sum((1 / (2 * np.sin(rmin / 2)) * (n1 - vec0))**2, axis=1) >= 1.
+        return self._output(inds[inside], nest)
+
+    def to_mask(self, inds):
+        '''
+        healpix map: 1 in the pixels inds, 0 otherwise
+        '''
+        res = np.zeros(self.npix)
+        res[inds] = 1.
+        return res
+
+
+_pixel_indices = {}
+
+
+def pixel_index(nside):
+    '''
+    PixelIndex of nside, calculated once per nside
+    '''
+    if nside not in _pixel_indices:
+        _pixel_indices[nside] = PixelIndex(nside)
+    return _pixel_indices[nside]
+
+
 #########################################################################
 #                                                                       #
 #           working with masked data                                    #
@@ -384,7 +795,215 @@ def fpix_lb_profiles(fpix, inds_dict, nB, nL, std=0):
 #########################################################################
 
 
+def resample_mask(mask, nside_out, nest=False, threshold=1.):
+    """
+        change the resolution of a mask
+    INPUT:
+        mask - array_like, shape (npix,): mask, 0 = masked, 1 = unmasked
+        nside_out - healpix nside of the output mask
+        nest - if True, then the mask is in nested format
+        threshold - a pixel of a coarser mask is unmasked if the unmasked fraction
+            of its subpixels is >= threshold, for the default value 1 a pixel is masked
+            if any of its subpixels is masked
+    OUTPUT:
+        mask - array, shape (12 * nside_out**2,): resampled mask
+    """
+    order = ('RING', 'NESTED')[nest]
+    mask = np.asarray(mask, dtype=np.float64)
+    if healpy.npix2nside(len(mask)) == nside_out:
+        return mask
+    frac = healpy.ud_grade(mask, nside_out, order_in=order, order_out=order)
+    return 1. * (frac >= threshold - 1.e-6)
+
+
+def load_mask(mask_fn, nside=None, symmetrize=False, threshold=1.):
+    """
+        load a mask from a .npy file and resample it to nside
+        if the file name contains the nside (e.g. ps_mask_3FGL_small_nside128.npy)
+        and a file with the requested nside exists, then that file is used
+    INPUT:
+        mask_fn - file name of the mask (RING ordering)
+        nside - healpix nside of the output mask, if None the mask is not resampled
+        symmetrize - if True, the mask is multiplied by mask[::-1]
+        threshold - see resample_mask
+    OUTPUT:
+        mask - array, shape (npix,)
+    """
+    if nside is not None:
+        for nside0 in [64, 128, 256, 512, 1024, 2048]:
+            tag = 'nside%i' % nside0
+            if tag in mask_fn and os.path.isfile(mask_fn.replace(tag, 'nside%i' % nside)):
+                mask_fn = mask_fn.replace(tag, 'nside%i' % nside)
+                break
+    mask = np.load(mask_fn)
+    if nside is not None:
+        mask = resample_mask(mask, nside, threshold=threshold)
+    if symmetrize:
+        mask = mask * mask[::-1]
+    return mask
+
+
+_neighbours = {}
+
+
+def neighbour_table(nside, nest=False, use_cache=True):
+    """
+    table of the nearest neighbours of all pixels, calculated once per nside
+    INPUT:
+        nside - healpix nside parameter
+        nest - if True, then the pixels are in nested format
+        use_cache - the table is saved in cache_dir and loaded in the next sessions
+    OUTPUT:
+        neib - int array, shape (8, npix): neighbours (SW, W, NW, N, NE, E, SE, S),
+            -1 if the neighbour does not exist
+    """
+    key = (nside, nest)
+    if key not in _neighbours:
+        fn = cache_dir + 'neighbours%s_nside%i.npy' % ('_nest' * nest, nside)
+        if use_cache and os.path.isfile(fn):
+            _neighbours[key] = np.array(np.load(fn), dtype=np.int64)
+        else:
+            npix = healpy.nside2npix(nside)
+            _neighbours[key] = np.array(healpy.get_all_neighbours(nside, np.arange(npix), nest=nest), dtype=np.int64)
+            if use_cache:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_fn = fn + '.tmp%i.npy' % os.getpid()
+                np.save(tmp_fn, np.array(_neighbours[key], dtype=np.int32))
+                os.rename(tmp_fn, fn)
+    return _neighbours[key]
+
+
+def kring(nside, pixels, k=1, nest=False):
+    """
+    all pixels within k steps through the nearest neighbours (up to 8 pixels on sides and diagonals)
+    from the pixels, including the pixels themselves
+    INPUT:
+        nside - healpix nside parameter
+        pixels - int or array of pixel indices
+        k - number of steps
+        nest - if True, then the pixels are in nested format
+    OUTPUT:
+        inds - sorted int array of pixels
+    """
+    neib = neighbour_table(nside, nest=nest)
+    selected = np.zeros(neib.shape[1], dtype=bool)
+    front = np.unique(pixels)
+    selected[front] = True
+    for step in xrange(int(np.ceil(k))):
+        nb = neib[:, front].flatten()
+        nb = nb[nb >= 0]
+        front = np.unique(nb[~selected[nb]])
+        if len(front) == 0:
+            break
+        selected[front] = True
+    return np.nonzero(selected)[0]
+
+
+def connected_components(selected, nest=False):
+    """
+    labels of the connected regions of selected pixels (neighbours on sides and diagonals)
+    INPUT:
+        selected - array_like, shape (npix,): the pixels with selected > 0 (or True) are labelled
+        nest - if True, then the map is in nested format
+    OUTPUT:
+        labels - int array, shape (npix,): number of the region of every pixel, -1 for not selected pixels,
+            the regions are numbered in the order of their first pixel
+        nlabels - number of regions
+    """
+    selected = np.asarray(selected) > 0
+    npix = len(selected)
+    neib = neighbour_table(healpy.npix2nside(npix), nest=nest)
+    inds = np.nonzero(selected)[0]
+    nb = neib[:, inds]
+    link = (nb >= 0) & selected[np.where(nb >= 0, nb, 0)]
+    # graph of the selected pixels with the links to the selected neighbours
+    pos = np.cumsum(selected) - 1
+    rows = np.repeat(np.arange(len(inds))[np.newaxis], neib.shape[0], axis=0)[link]
+    graph = sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, pos[nb[link]])), shape=(len(inds), len(inds)))
+    nlabels, comp = csgraph.connected_components(graph, directed=False)
+    labels = -np.ones(npix, dtype=int)
+    labels[inds] = comp
+    return labels, nlabels
+
+
+def flood_fill(selected, seeds, nest=False):
+    """
+    the selected pixels which are connected to the seed pixels
+    INPUT:
+        selected - array_like, shape (npix,): the region where the fill can propagate (> 0 or True)
+        seeds - int or array of pixel indices where the fill starts
+        nest - if True, then the map is in nested format
+    OUTPUT:
+        filled - bool array, shape (npix,)
+    """
+    labels, nlabels = connected_components(selected, nest=nest)
+    seed_labels = labels[np.atleast_1d(seeds)]
+    seed_labels = seed_labels[seed_labels >= 0]
+    found = np.zeros(nlabels + 1, dtype=bool)                    # the last entry is for the label -1
+    found[seed_labels] = True
+    return found[labels]
+
+
 def heal(fpix, mask, nest=False, outsteps=False):
+    """
+        fill masked pixels with an average over nearest neighbour pixels
+        (up to 8 pixels on sides and diagonals)
+        at each step only the masked pixels at the border of the filled region are updated
+    INPUT:
+        fpix - array_like, shape (npix,) or (nE, npix): input map or data cube
+        mask - array_like, shape (npix,): mask, 0 = masked, 1 = unmasked
+        nest - boolean optional:
+            if True, then the healpix map is in nested format
+            DEFAULT: False
+        outsteps - boolean optional:
+            if True, then output the steps of filling in the mask
+            DEFAULT: False
+
+    OUTPUT:
+        fpix - array_like, shape (npix,) or (nE, npix): the map with filled in masked pixels
+    HISTORY:
+        Sept 13, 2012 - Written - D.Malyshev (KIPAC, Stanford)
+        Vectorized version with a precalculated table of neighbours (see heal_old)
+    """
+    if not isinstance(mask, np.ndarray) and mask == 1.:
+        return fpix
+
+    fpix_new = np.array(fpix * mask, dtype=np.float64)
+    npix = fpix_new.shape[-1]
+    nside = healpy.npix2nside(npix)
+    neib = neighbour_table(nside, nest=nest)
+    exists = neib >= 0
+    neib = np.where(exists, neib, 0)
+
+    filled = np.asarray(mask) > 0
+    masked = np.nonzero(~filled)[0]
+    # first frontier: masked pixels with at least one unmasked neighbour
+    front = masked[np.any(exists[:, masked] & filled[neib[:, masked]], axis=0)]
+
+    run = 0
+    while len(front) > 0:
+        run += 1
+        if outsteps:
+            print 'number of zeros in the mask: ', npix - np.sum(filled)
+            print 'fill step ', run
+
+        nb = neib[:, front]
+        use = exists[:, front] & filled[nb]
+        n = np.sum(use, axis=0)
+        fpix_new[..., front] = np.sum(fpix_new[..., nb] * use, axis=-2) / n
+        filled[front] = True
+
+        # next frontier: masked neighbours of the pixels filled at this step
+        nb = nb[exists[:, front]]
+        front = np.unique(nb[~filled[nb]])
+
+    if not np.all(filled):
+        print 'heal: %i pixels are not connected to unmasked pixels' % (npix - np.sum(filled))
+    return fpix_new
+
+
+def heal_old(fpix, mask, nest=False, outsteps=False):
     """
         fill masked pixels with an average over nearest neighbour pixels
         (up to 8 pixels on sides and diagonals)
@@ -439,7 +1058,96 @@ def heal(fpix, mask, nest=False, outsteps=False):
     return np.array(fpix_new.T, dtype=np.float64)
 
 
+ps_batch_size = 1000                              # number of sources per batch in ps_mask
+
+
+def ps_mask(nside, bs, ls, radii, nest=False, batch_size=ps_batch_size):
+    """
+    mask all the pixels that either contain a source (bs[i], ls[i])
+    or the distance from the source to the center of the pixel is less than radii[i]
+    the sources are processed in batches: the candidate pixels of all sources in a batch
+    are found with healpy.query_disc and tested together (the same test as in mask_circle)
+    INPUT:
+        nside - healpix nside parameter
+        bs - array of Gal latitudes (rad)
+        ls - array of Gal longitudes (rad)
+        radii - distances (rad): a number, an array of shape (nsrc,) or (nsrc, nE)
+            for energy dependent radii (see psf_mask_radius)
+        nest - output map is in nested format
+        batch_size - number of sources per batch
+    OUTPUT:
+        mask - array, shape (npix,) or (nE, npix) for radii of shape (nsrc, nE): mask map (0 if masked)
+    """
+    bs = np.atleast_1d(np.asarray(bs, dtype=np.float64))
+    ls = np.atleast_1d(np.asarray(ls, dtype=np.float64))
+    nsrc = len(bs)
+    radii = np.asarray(radii, dtype=np.float64)
+    energy_dependent = radii.ndim == 2
+    radii = (radii * np.ones(nsrc)).reshape((nsrc, -1)) if not energy_dependent else radii
+    nE = radii.shape[1]
+    npix = healpy.nside2npix(nside)
+    mask = np.ones((nE, npix))
+    if nsrc == 0:
+        return mask if energy_dependent else mask[0]
+
+    vecs = np.array(BL2xyz(bs, ls)).T
+    mask[:, healpy.vec2pix(nside, vecs[:, 0], vecs[:, 1], vecs[:, 2], nest=nest)] = 0.
+    rmax = np.max(radii, axis=1)
+    with np.errstate(divide='ignore'):
+        rsInv = 1 / (2 * np.sin(radii / 2))
+    for i0 in xrange(0, nsrc, batch_size):
+        srcs = [i for i in xrange(i0, min(i0 + batch_size, nsrc)) if rmax[i] > 0]
+        if not srcs:
+            continue
+        cands = [healpy.query_disc(nside, vecs[i], rmax[i], inclusive=True, nest=nest) for i in srcs]
+        labels = np.repeat(srcs, [len(cand) for cand in cands])
+        pixels = np.concatenate(cands)
+        n1 = np.array(healpy.pix2vec(nside, pixels, nest=nest)).T
+        dist2 = np.sum((n1 - vecs[labels])**2, axis=1)
+        for E in xrange(nE):
+            inside = dist2 * rsInv[labels, E]**2 < 1.
+            mask[E, pixels[inside]] = 0.
+    return mask if energy_dependent else mask[0]
+
+
+def psf_mask_radius(flux, theta68, flux_thres, rmin=0., rmax=np.inf):
+    """
+    radius where the intensity of a point source drops below a threshold
+    the PSF is approximated by a Gaussian with the 68% containment radius theta68:
+    flux * psf(r) = flux_thres with psf(r) = exp(-r^2 / (2 sigma^2)) / (2 pi sigma^2)
+    INPUT:
+        flux - array of fluxes (e.g. ph / (cm^2 s)), shape (nsrc,) or (nsrc, nE)
+        theta68 - 68% containment radius (rad), a number or an array of shape (nE,)
+        flux_thres - threshold intensity (units of flux / sr), a number or an array of shape (nE,)
+        rmin, rmax - the radii are clipped to (rmin, rmax) (rad)
+    OUTPUT:
+        radii - array of radii (rad), the same shape as flux
+    """
+    sigma = theta68 / np.sqrt(-2 * np.log(1 - 0.68))
+    ratio = np.asarray(flux, dtype=np.float64) / (2 * np.pi * sigma**2 * flux_thres)
+    ratio = np.where(np.isfinite(ratio) & (ratio > 1.), ratio, 1.)
+    return np.clip(sigma * np.sqrt(2 * np.log(ratio)), rmin, rmax)
+
+
 def ps2maskpix(nside, bs, ls, dist, nest=False):
+    """
+    mask all the pixels that either contain (bs[i], ls[i])
+    or the distance from the point to the center
+    of the pixel is less than dist (see ps_mask)
+    INPUT:
+        nside - healpix nside parameter
+        bs - array of Gal latitudes (rad)
+        ls - array of Gal longitudes (rad)
+        dist - array of distances (rad)
+        nest - output map is in nested format
+            DEFAULT: False
+    OUTPUT:
+        fpix - array_like, shape (npix,): mask map (0 if masked)
+    """
+    return ps_mask(nside, bs, ls, dist, nest=nest)
+
+
+def ps2maskpix_old(nside, bs, ls, dist, nest=False):
     """
     mask all the pixels that either contain (bs[i], ls[i])
     or the distance from the point to the center
@@ -566,7 +1274,80 @@ def gaussBL(BL0, BLsigma, Bs, Ls):
     return pre_exp * np.exp(-arg)
 
 
-def smoothing_neff(nside, sigma, n_rnd=10):
+neff_eps = 1.e-10                                 # multipoles with |b_l| < neff_eps * b_0 are neglected in smoothing_neff
+
+
+def _neff_beams(nside, sigma, beam, lmax, pixwin):
+    '''
+    window functions b_l, shape (nE, lmax + 1), optionally times the pixel window
+    '''
+    if beam is None:
+        sigmas = np.atleast_1d(np.asarray(sigma, dtype=np.float64))
+        beam = np.array([healpy.gauss_beam(sgm * np.sqrt(8. * np.log(2.)), lmax=lmax) for sgm in sigmas])
+    beam = np.atleast_2d(np.asarray(beam, dtype=np.float64))[:, :lmax + 1]
+    if pixwin:
+        beam = beam * healpy.pixwin(nside)[:beam.shape[1]]
+    return beam
+
+
+def smoothing_neff(nside, sigma=None, beam=None, mask=None, pixwin=False, lmax=None, local=False):
+    '''
+        analytic effective number of pixels covered by a smoothing kernel:
+        a white noise map with unit variance in pixels has C_l = 4 pi / npix,
+        after smoothing with b_l the variance is sum_l (2l + 1) b_l^2 / npix
+    INPUT:
+        nside - integer: healpix parameter
+        sigma - float or array (nE,): gaussian kernel sigma (rad)
+        beam - window function b_l, array (lmax + 1,) or (nE, lmax + 1), e.g. smoothing.psf2beam (used if sigma is None)
+        mask - healpix map or None: weights of the pixels before smoothing,
+            pseudo-Cl approximation: the masked noise has C_l = 4 pi / npix * <mask^2>,
+            the variance is distributed over the pixels with mask > 0
+        pixwin - multiply the beam by the healpix pixel window
+        lmax - maximal multipole, default: 3 * nside - 1 (as in healpy.smoothing)
+        local - return the variance of the smoothed noise in every pixel instead
+            (the squared kernel convolved with mask^2, includes the edges of the mask)
+    OUTPUT:
+        n_eff - float or array (nE,): effective number of pixels, n_eff = (std_0 / std_smooth)**2
+            if local: array (npix,) or (nE, npix) of (std_smooth / std_0)**2
+    '''
+    if sigma is None and beam is None:
+        raise ValueError, 'either sigma or beam has to be given'
+    single = np.ndim(sigma) == 0 if sigma is not None else np.ndim(beam) == 1
+    npix = healpy.nside2npix(nside)
+    if lmax is None:
+        lmax = 3 * nside - 1
+    beam = _neff_beams(nside, sigma, beam, lmax, pixwin)
+    ls = np.arange(beam.shape[1])
+
+    if not local:
+        var = np.sum((2 * ls + 1) * beam**2, axis=1) / npix
+        if mask is not None:
+            mask = np.asarray(mask, dtype=np.float64)
+            var *= np.mean(mask**2) / np.mean(mask > 0)
+        res = 1. / var
+        return res[0] if single else res
+
+    # Legendre coefficients of the squared kernel by Gauss-Legendre quadrature in cos(theta)
+    big = np.nonzero(np.max(np.abs(beam), axis=0) > neff_eps * np.max(np.abs(beam[:, 0])))[0]
+    lcut = big[-1] if len(big) else 0
+    beam = beam[:, :lcut + 1]
+    ls = ls[:lcut + 1]
+    mus, wts = np.polynomial.legendre.leggauss(3 * lcut / 2 + 2)
+    pls = np.polynomial.legendre.legvander(mus, lcut)                      # (nmu, lcut + 1)
+    kernel = np.dot(pls, ((2 * ls + 1) / (4 * np.pi) * beam).T)            # (nmu, nE)
+    kernel2_l = 2 * np.pi * np.dot(pls.T, wts[:, np.newaxis] * kernel**2).T
+
+    if mask is None:
+        fpix = np.ones(npix)
+    else:
+        fpix = np.asarray(mask, dtype=np.float64)**2
+    alm = healpy.map2alm(fpix, lmax=lcut)
+    res = np.array([healpy.alm2map(healpy.almxfl(alm, k2l), nside, lmax=lcut, verbose=False)
+                    for k2l in kernel2_l]) * 4 * np.pi / npix
+    return res[0] if single else res
+
+
+def smoothing_neff_old(nside, sigma, n_rnd=10):
     '''
         Monte Carlo calculation of effective number of pixels covered
         by a Gaussian kernel
@@ -631,7 +1412,123 @@ def uind2hind(lmax, uind):
     return lk2hind(lmax, ll, kk)
     
 
-def sph_basis(nside, lmax=None, mmax=None, lks=None, output_inds=False):
+def _default_lks(lmax, mmax=None):
+    '''
+    (l, k) of the basis functions with l <= lmax and m <= mmax, in the order of sph_basis
+    '''
+    ll, kk = uind2lk(np.arange((lmax + 1)**2))
+    keep = np.ones(len(ll), dtype=bool) if mmax is None else k2m(ll, kk) <= mmax
+    return np.array([ll[keep], kk[keep]]).T
+
+
+def legendre_rings(zs, lmax):
+    '''
+        normalized associated Legendre functions N_lm P_lm(z) (with the Condon-Shortley phase),
+        Y_lm = N_lm P_lm(cos(theta)) exp(i m phi), calculated by the recurrence in l at fixed m
+    INPUT:
+        zs - array of cos(theta), e.g. of the healpix rings
+        lmax - maximal l
+    OUTPUT:
+        lam - array, shape (len(zs), nalm): in the healpix order of (l, m), see lm2hind
+    '''
+    zs = np.asarray(zs, dtype=np.float64)
+    sins = np.sqrt(np.maximum(1. - zs**2, 0.))
+    lam = np.zeros((len(zs), (lmax + 1) * (lmax + 2) / 2))
+    lam_mm = np.ones(len(zs)) * np.sqrt(1. / (4 * np.pi))
+    for m in xrange(lmax + 1):
+        if m > 0:
+            lam_mm = -np.sqrt((2. * m + 1) / (2. * m)) * sins * lam_mm
+        lam[:, lm2hind(lmax, m, m)] = lam_mm
+        if m == lmax:
+            break
+        lam_prev = lam_mm
+        lam_l = np.sqrt(2. * m + 3) * zs * lam_mm
+        lam[:, lm2hind(lmax, m + 1, m)] = lam_l
+        for l in xrange(m + 2, lmax + 1):
+            a = np.sqrt((4. * l**2 - 1) / (l**2 - m**2))
+            b = np.sqrt(((l - 1.)**2 - m**2) / (4. * (l - 1.)**2 - 1))
+            lam_prev, lam_l = lam_l, a * (zs * lam_l - b * lam_prev)
+            lam[:, lm2hind(lmax, l, m)] = lam_l
+    return lam
+
+
+def sph_basis(nside, lmax=None, mmax=None, lks=None, output_inds=False, mask=None, nest=False,
+              dtype=np.float64, use_cache=False):
+    '''
+        Basis of real spherical harmonics functions (same basis as in sph_basis_old)
+        The Legendre functions are calculated once per ring latitude (legendre_rings),
+        the maps are filled for one m at a time.
+        With use_cache=True the basis is saved in cache_dir as a .npy file keyed by (nside, lks, mask)
+        and returned as a read-only memory map. The files are not evicted
+        (e.g. 4 GB for lmax = 50 at nside 128 in float64), so the cache is opt-in.
+    INPUT:
+        nside - integer: healpix parameter
+        lmax - integer: maximal degree of spherical functions
+        mmax - integer: maximal angular number of spherical harmonics
+        lks - array of (l, k), alternative to lmax and mmax
+        output_inds - if True, then the indices l**2 + k are returned as well
+        mask - healpix map or None: only the pixels with mask > 0 are calculated
+        nest - healpix ordering
+        dtype - dtype of the basis
+        use_cache - if True, then the basis is read from (or saved in) cache_dir
+            DEFAULT: False, the basis is calculated in memory
+    OUTPUT:
+        Ylm maps with l <= lmax, m <= l, shape (nsph, npix) or (nsph, number of pixels with mask > 0)
+            writable array, or read-only memory map if use_cache is True (copy it with np.array before changing it)
+            ordering of the maps: l = 0, 1, ..., lmax, k = 0, ..., mmax, l, ..., l + mmax
+            k <= l: sqrt(2) Re(Y_lm) (Y_l0 for m = 0), k > l: -sqrt(2) Im(Y_lm), m = k - l
+        The normalization is such that the integral of f_i^2
+        over the sphere is 1.
+    '''
+    if lks is None:
+        if lmax is None:
+            raise ValueError, 'either lks or lmax should be defined'
+        lks = _default_lks(lmax, mmax=mmax)
+    else:
+        lks = np.array(lks, dtype=int)
+        if lks.ndim == 1:
+            lks = np.array([lks])
+        lmax = max(lks[:, 0])
+    npix = healpy.nside2npix(nside)
+    inds = np.arange(npix) if mask is None else np.nonzero(np.asarray(mask) > 0)[0]
+    uinds = lk2uind(lks[:, 0], lks[:, 1])
+
+    fn = _cache_fn('sph_basis_%s%s' % (np.dtype(dtype).name, '_nest' * nest), nside, lks, inds)
+    if use_cache and os.path.isfile(fn):
+        res = np.load(fn, mmap_mode='r')
+    else:
+        theta, phi = healpy.pix2ang(nside, inds, nest=nest)
+        zs, ring = np.unique(np.cos(theta), return_inverse=True)
+        lam = legendre_rings(zs, lmax)
+        if use_cache:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_fn = fn + '.tmp%i.npy' % os.getpid()
+            res = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=dtype, shape=(len(lks), len(inds)))
+        else:
+            res = np.zeros((len(lks), len(inds)), dtype=dtype)
+        ms = k2m(lks[:, 0], lks[:, 1])
+        for m in np.unique(ms):
+            if m == 0:
+                trig = {False: np.ones(len(inds))}
+            else:
+                trig = {False: np.sqrt(2.) * np.cos(m * phi), True: -np.sqrt(2.) * np.sin(m * phi)}
+            for i in np.nonzero(ms == m)[0]:
+                ll, kk = lks[i]
+                res[i] = lam[ring, lm2hind(lmax, ll, m)] * trig[kk > ll]
+        if use_cache:
+            res.flush()
+            del res
+            os.rename(tmp_fn, fn)
+            res = np.load(fn, mmap_mode='r')
+
+    if output_inds:
+        return res, uinds
+    else:
+        return res
+
+
+def sph_basis_old(nside, lmax=None, mmax=None, lks=None, output_inds=False):
     '''
         Basis of spherical harmonics functions
     INPUT:
@@ -757,7 +1654,7 @@ def vec2ang(v):
 
 
 def pix2vec(nside, inds=None, nest=False):
-    if inds == None:
+    if inds is None:
         inds = range(healpy.nside2npix(nside))
     return np.array(healpy.pix2vec(nside, inds, nest=nest))
 
@@ -831,6 +1728,9 @@ def mask_circle(nside, phi_max, BL0, nest=False, inds=None, vecs=None):
     rsInv = 1/rs
 
     B0, L0 = BL0
+    if inds is None and vecs is None:
+        index = pixel_index(nside)
+        return index.to_mask(index.disc(B0, L0, phi_max, nest=nest, rad=True))
     n0 = np.array(BL2xyz(B0, L0))
     if inds is None:
         npix = healpy.nside2npix(nside)
@@ -863,6 +1763,31 @@ def mask_tanh(nside, BL0=np.deg2rad([0.,0.]), theta=np.deg2rad(10.), dtheta=np.d
     OUTPUT:
         healpix map
         
+    """
+    B0, L0 = BL0
+    return tanh_regions(nside, B0, L0, theta, dtheta, theta_max=theta_max, nest=nest, output='dense')[0]
+
+
+def mask_tanh_old(nside, BL0=np.deg2rad([0.,0.]), theta=np.deg2rad(10.), dtheta=np.deg2rad(3.),
+                  theta_max=None, nest=False):
+    """
+    create a circlular mask (window function) with smooth boundaries
+    INPUT:
+        nside - healpix parameter
+        BL0 - [B0, L0] - the center of the mask (radians), default: [0., 0.]
+        theta - radius of the mask (radians), default: np.deg2rad(10.)
+        dtheta - half width of the boundary (radians), default: np.deg2rad(3.)
+        theta_max - max radius behind which the mask is set to zero,
+                    default: None (in this case theta_mas = theta + 3 * dtheta
+        nest - healpix pixelation type, default: False
+    USAGE:
+        import numpy as np
+        import healpylib
+        hmap = healpylib.mask_tanh(nside, BL0=np.deg2rad([0., 0.]), theta=np.deg2rad(10.),
+                                   dtheta=np.deg2rad(3.), theta_max=None, nest=False)
+    OUTPUT:
+        healpix map
+        
     """
     if theta_max is None:
         theta_max = theta + 3 * dtheta
@@ -870,7 +1795,7 @@ def mask_tanh(nside, BL0=np.deg2rad([0.,0.]), theta=np.deg2rad(10.), dtheta=np.d
 
     # get the pixels
     mask = mask_circle(nside, theta_max, BL0, nest=nest)
-    inds = [i for i in range(npix) if mask[i] > 0]
+    inds = np.nonzero(mask > 0)[0]
 
     v = pix2vec(nside, inds, nest=nest)
     B, L = BL0
@@ -883,7 +1808,6 @@ def mask_tanh(nside, BL0=np.deg2rad([0.,0.]), theta=np.deg2rad(10.), dtheta=np.d
 
 
 
-    
 def mask_lat_stripe(nside, bmin=-10, bmax=10, lmin=None, lmax=None, rad=False,
                     nest=False):
     '''
@@ -970,6 +1894,16 @@ def jet_template(nside, length, width, angle):
     
 
 def mask_ellipse(nside, rsInv, n0, mask=None):
+    '''
+    mask = 0 outside the ellipse sum((rsInv * (n1 - n0))^2) < 1 (see ellipse_regions)
+    '''
+    res = ellipse_regions(nside, rsInv, n0, output='dense')[0]
+    if mask is not None:
+        res *= mask
+    return res
+
+
+def mask_ellipse_old(nside, rsInv, n0, mask=None):
     npix = healpy.nside2npix(nside)
     if mask is None:
         rmask = np.ones(npix)
@@ -982,6 +1916,166 @@ def mask_ellipse(nside, rsInv, n0, mask=None):
     return rmask
 
 
+#########################################################################
+#                                                                       #
+#           region mask generators                                      #
+#                                                                       #
+#########################################################################
+
+
+region_batch_size = 1000                          # number of shapes per batch in the region mask generators
+
+
+def _region_batches(nside, vecs, radii, nest=False, batch_size=region_batch_size):
+    '''
+        candidate pixels of many shapes: the pixels touching the bounding discs (healpy.query_disc)
+    INPUT:
+        vecs - array (nshape, 3): centers of the bounding discs
+        radii - array (nshape,): radii of the bounding discs (rad)
+    OUTPUT:
+        iterator over the batches of shapes: (labels, pixels, n1) - index of the shape,
+        candidate pixel and the unit vector of the pixel center
+    '''
+    for i0 in xrange(0, len(vecs), batch_size):
+        shapes = [i for i in xrange(i0, min(i0 + batch_size, len(vecs))) if radii[i] > 0]
+        if not shapes:
+            continue
+        cands = [healpy.query_disc(nside, vecs[i], min(radii[i], np.pi), inclusive=True, nest=nest) for i in shapes]
+        labels = np.repeat(shapes, [len(cand) for cand in cands])
+        pixels = np.concatenate(cands)
+        yield labels, pixels, np.array(healpy.pix2vec(nside, pixels, nest=nest)).T
+
+
+def _region_output(nside, nshape, batches, output):
+    '''
+        collect the weights of the shapes
+    INPUT:
+        batches - iterator over (labels, pixels, weights), only nonzero weights
+        output - 'pairs': (labels, pixels, weights) arrays
+                 'sparse': scipy.sparse.csr_matrix (nshape, npix)
+                 'dense': array (nshape, npix)
+                 'max': array (npix,), maximal weight of all shapes in the pixels (union of the regions)
+    '''
+    npix = healpy.nside2npix(nside)
+    if output == 'dense':
+        res = np.zeros((nshape, npix))
+        for labels, pixels, weights in batches:
+            res[labels, pixels] = weights
+        return res
+    if output == 'max':
+        res = np.zeros(npix)
+        for labels, pixels, weights in batches:
+            np.maximum.at(res, pixels, weights)
+        return res
+    if output not in ['pairs', 'sparse']:
+        raise ValueError, 'unknown output %s' % output
+    parts = list(batches)
+    labels = np.concatenate([np.zeros(0, dtype=int)] + [part[0] for part in parts])
+    pixels = np.concatenate([np.zeros(0, dtype=int)] + [part[1] for part in parts])
+    weights = np.concatenate([np.zeros(0)] + [part[2] for part in parts])
+    if output == 'pairs':
+        return labels, pixels, weights
+    return sparse.csr_matrix((weights, (labels, pixels)), shape=(nshape, npix))
+
+
+def circle_regions(nside, Bs, Ls, radii, nest=False, output='pairs', batch_size=region_batch_size):
+    '''
+        pixels with the centers at a distance < radius from the centers of many circles
+        (same test as in mask_circle), only the pixels in the bounding discs are visited
+    INPUT:
+        nside - healpix parameter
+        Bs, Ls - arrays (nshape,): centers of the circles (rad)
+        radii - float or array (nshape,): radii of the circles (rad)
+        nest - healpix ordering
+        output - 'pairs', 'sparse', 'dense' or 'max' (see _region_output)
+        batch_size - number of circles per batch
+    OUTPUT:
+        weights of the pixels, 1 inside the circles
+    USAGE:
+        labels, pixels, weights = healpylib.circle_regions(nside, Bs, Ls, np.deg2rad(1.))
+        mask = 1. - healpylib.circle_regions(nside, Bs, Ls, np.deg2rad(1.), output='max')
+    '''
+    Bs = np.atleast_1d(np.asarray(Bs, dtype=np.float64))
+    Ls = np.atleast_1d(np.asarray(Ls, dtype=np.float64))
+    radii = np.asarray(radii, dtype=np.float64) * np.ones(len(Bs))
+    vecs = np.array(BL2xyz(Bs, Ls)).T.reshape((-1, 3))
+    rs2Inv = 1 / (2 * np.sin(radii / 2))**2
+
+    def batches():
+        for labels, pixels, n1 in _region_batches(nside, vecs, radii, nest=nest, batch_size=batch_size):
+            inside = np.sum((n1 - vecs[labels])**2, axis=1) * rs2Inv[labels] < 1.
+            yield labels[inside], pixels[inside], np.ones(np.sum(inside))
+    return _region_output(nside, len(vecs), batches(), output)
+
+
+def tanh_regions(nside, Bs, Ls, theta, dtheta, theta_max=None, nest=False, output='pairs',
+                 batch_size=region_batch_size):
+    '''
+        circular windows with smooth boundaries (as in mask_tanh) around many centers:
+        (1 - tanh((dist - theta) / dtheta)) / 2 for dist < theta_max, 0 otherwise
+    INPUT:
+        nside - healpix parameter
+        Bs, Ls - arrays (nshape,): centers of the windows (rad)
+        theta - float or array (nshape,): radii of the windows (rad)
+        dtheta - float or array (nshape,): half widths of the boundaries (rad)
+        theta_max - float or array (nshape,): max radii, default: theta + 3 * dtheta
+        nest - healpix ordering
+        output - 'pairs', 'sparse', 'dense' or 'max' (see _region_output)
+        batch_size - number of windows per batch
+    OUTPUT:
+        weights of the pixels
+    '''
+    Bs = np.atleast_1d(np.asarray(Bs, dtype=np.float64))
+    Ls = np.atleast_1d(np.asarray(Ls, dtype=np.float64))
+    theta = np.asarray(theta, dtype=np.float64) * np.ones(len(Bs))
+    dtheta = np.asarray(dtheta, dtype=np.float64) * np.ones(len(Bs))
+    if theta_max is None:
+        theta_max = theta + 3 * dtheta
+    theta_max = np.asarray(theta_max, dtype=np.float64) * np.ones(len(Bs))
+    vecs = np.array(BL2xyz(Bs, Ls)).T.reshape((-1, 3))
+    rs2Inv = 1 / (2 * np.sin(theta_max / 2))**2
+
+    def batches():
+        for labels, pixels, n1 in _region_batches(nside, vecs, theta_max, nest=nest, batch_size=batch_size):
+            v0 = vecs[labels]
+            inside = np.sum((n1 - v0)**2, axis=1) * rs2Inv[labels] < 1.
+            labels = labels[inside]
+            thetas = np.arccos(np.clip(np.sum(n1[inside] * v0[inside], axis=1), -1., 1.))
+            window = (1. - np.tanh((thetas - theta[labels]) / dtheta[labels])) / 2.
+            yield labels, pixels[inside], window
+    return _region_output(nside, len(vecs), batches(), output)
+
+
+def ellipse_regions(nside, rsInv, n0, nest=False, output='pairs', batch_size=region_batch_size):
+    '''
+        pixels inside many ellipses (as in mask_ellipse): sum((rsInv * (n1 - n0))^2) < 1,
+        the bounding disc around n0 has the chord 1 / min(rsInv) + | |n0| - 1 |
+    INPUT:
+        nside - healpix parameter
+        rsInv - float, array (3,) or (nshape, 3): inverse half axes in x, y, z
+        n0 - array (3,) or (nshape, 3): centers of the ellipses
+        nest - healpix ordering
+        output - 'pairs', 'sparse', 'dense' or 'max' (see _region_output)
+        batch_size - number of ellipses per batch
+    OUTPUT:
+        weights of the pixels, 1 inside the ellipses
+    '''
+    n0 = np.atleast_2d(np.asarray(n0, dtype=np.float64))
+    nshape = len(n0)
+    rsInv = np.asarray(rsInv, dtype=np.float64) * np.ones((nshape, 3))
+    norm = np.sqrt(np.sum(n0**2, axis=1))
+    with np.errstate(divide='ignore'):
+        chord = 1. / np.min(np.abs(rsInv), axis=1) + np.abs(norm - 1.)
+    radii = 2 * np.arcsin(np.minimum(chord / 2, 1.))
+    vecs = n0 / norm[:, np.newaxis]
+
+    def batches():
+        for labels, pixels, n1 in _region_batches(nside, vecs, radii, nest=nest, batch_size=batch_size):
+            inside = np.sum((rsInv[labels] * (n1 - n0[labels]))**2, axis=1) < 1.
+            yield labels[inside], pixels[inside], np.ones(np.sum(inside))
+    return _region_output(nside, nshape, batches(), output)
+
+
 if __name__ == '__main__':
     import time
     #from matplotlib import pyplot
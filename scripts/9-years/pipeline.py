@@ -0,0 +1,276 @@
+"""
+Incremental runner of the analysis stages (Save_*_fits -> Calc_dct -> SED fits -> plots).
+
+Every stage is a script with command line options, a list of input files (data, code and the
+outputs of other stages) and a list of output files. File names may contain wildcards,
+e.g. 'plot_dct/Low_energy_range0/lowE_source_*.yaml'. A stage depends on the stages which
+produce its inputs, these dependencies define a directed acyclic graph.
+
+The key of a stage is the hash of the command, the parameters and the content hashes of all inputs
+(dio.get_hash, dio.get_file_hash). A stage is executed only if its key changed since the last
+successful run or if one of its outputs is missing. If an executed stage produces the same
+outputs as before, the stages downstream are not executed, so that a change in one script
+rebuilds only the affected branch of the graph. Independent stages run in parallel.
+The keys, the content hashes and the timings are saved in healpylib.cache_dir + 'pipeline/'.
+
+Usage:
+    import pipeline
+    pipe = pipeline.Pipeline()
+    pipe.add('lowE_source_0', ['Save_lowE_res_fits.py', '-c', 'source', '-E', '0'],
+             inputs=[counts_fn, expo_fn, mask_fn, 'Save_lowE_res_fits.py'],
+             outputs=['fits/LowE_0.3-1.0GeV_counts_source.fits'])
+    pipe.run(nproc=4)
+"""
+
+import os
+import sys
+import glob
+import time
+import fnmatch
+import subprocess
+import healpylib as hlib
+import dio
+
+
+state_dir = hlib.cache_dir + 'pipeline/'
+
+
+class Stage(object):
+    '''
+        one step of the pipeline
+    INPUT:
+        name - unique name of the stage
+        cmd - list: script and command line options, the script is executed with the current python
+        inputs - list of input files (wildcards allowed)
+        outputs - list of output files (wildcards allowed)
+        params - dictionary of parameters which are not in the files (included in the key)
+    '''
+    def __init__(self, name, cmd, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.cmd = list(cmd)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+    def __repr__(self):
+        return 'Stage(%s)' % self.name
+
+
+def _expand(pattern):
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    if os.path.isfile(pattern):
+        return [pattern]
+    return []
+
+
+def _match(fn, pattern):
+    return fn == pattern or fnmatch.fnmatch(fn, pattern) or fnmatch.fnmatch(pattern, fn)
+
+
+class Pipeline(object):
+    '''
+        directed acyclic graph of stages
+    INPUT:
+        name - name of the state file in state_dir
+    '''
+    def __init__(self, name='pipeline'):
+        self.stages = []
+        self.state_fn = state_dir + name + '_state.json'
+        self.log_dir = state_dir + name + '_logs/'
+        self.state = {'stages': {}, 'files': {}}
+        if os.path.isfile(self.state_fn):
+            self.state = dio.loaddict(self.state_fn)
+
+    def add(self, name, cmd, inputs=(), outputs=(), params=None):
+        if name in [stage.name for stage in self.stages]:
+            raise ValueError, 'stage %s already exists' % name
+        stage = Stage(name, cmd, inputs=inputs, outputs=outputs, params=params)
+        self.stages.append(stage)
+        return stage
+
+    def stage(self, name):
+        return [stage for stage in self.stages if stage.name == name][0]
+
+    def upstream(self, stage):
+        '''
+        stages which produce the inputs of stage
+        '''
+        return [other for other in self.stages if other is not stage and
+                any([_match(fn, out) for fn in stage.inputs for out in other.outputs])]
+
+    def select(self, patterns):
+        '''
+        stages with names matching one of the patterns together with all stages upstream
+        '''
+        selected = set()
+        todo = [stage for stage in self.stages if any([fnmatch.fnmatch(stage.name, pat) for pat in patterns])]
+        while todo:
+            stage = todo.pop()
+            if stage.name not in selected:
+                selected.add(stage.name)
+                todo.extend(self.upstream(stage))
+        return [stage for stage in self.stages if stage.name in selected]
+
+    def order(self, stages=None):
+        '''
+        stages sorted such that every stage comes after its upstream stages
+        '''
+        if stages is None:
+            stages = self.stages
+        names = set([stage.name for stage in stages])
+        deps = dict([(stage.name, [up.name for up in self.upstream(stage) if up.name in names]) for stage in stages])
+        res = []
+        done = set()
+        while len(res) < len(stages):
+            ready = [stage for stage in stages if stage.name not in done and all([dep in done for dep in deps[stage.name]])]
+            if not ready:
+                raise ValueError, 'the stages have a cyclic dependency: %s' % sorted(names - done)
+            res.extend(ready)
+            done.update([stage.name for stage in ready])
+        return res
+
+    ################################################################################################################## Hashes
+
+    def file_hash(self, fn):
+        '''
+        content hash of a file, recalculated only if the mtime or the size of the file changed
+        '''
+        stat = os.stat(fn)
+        entry = self.state['files'].get(fn)
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return entry['hash']
+        value = dio.get_file_hash(fn)
+        self.state['files'][fn] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': value}
+        return value
+
+    def key(self, stage):
+        '''
+            hash of the command, the parameters and the content of the inputs
+        OUTPUT:
+            key - int, None if an input is missing
+            missing - list of missing inputs
+        '''
+        hashes = {}
+        missing = []
+        for pattern in stage.inputs:
+            fns = _expand(pattern)
+            if not fns:
+                missing.append(pattern)
+            for fn in fns:
+                hashes[fn] = self.file_hash(fn)
+        if missing:
+            return None, missing
+        return dio.get_hash({'cmd': ' '.join(stage.cmd), 'params': stage.params, 'inputs': hashes}), missing
+
+    def is_stale(self, stage):
+        key, missing = self.key(stage)
+        if missing:
+            return True
+        entry = self.state['stages'].get(stage.name, {})
+        if entry.get('key') != key:
+            return True
+        return not all([_expand(pattern) for pattern in stage.outputs])
+
+    def save_state(self):
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_fn = self.state_fn + '.tmp'
+        dio.savedict(self.state, tmp_fn, silent=True)
+        os.rename(tmp_fn, self.state_fn)
+
+    ################################################################################################################## Execution
+
+    def _launch(self, stage):
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        for pattern in stage.outputs:
+            folder = os.path.dirname(pattern)
+            if folder and not glob.has_magic(folder) and not os.path.isdir(folder):
+                os.makedirs(folder)
+        log = open(self.log_dir + stage.name + '.log', 'w')
+        proc = subprocess.Popen([sys.executable] + stage.cmd, stdout=log, stderr=subprocess.STDOUT)
+        return proc, log
+
+    def run(self, nproc=1, targets=None, force=(), dry_run=False):
+        '''
+            execute the stale stages
+        INPUT:
+            nproc - max number of stages which run in parallel
+            targets - list of name patterns, only these stages and the stages upstream are considered
+            force - list of name patterns of stages which are executed in any case
+            dry_run - only print the stages which are stale or downstream of a stale stage
+        OUTPUT:
+            status - dictionary {name: 'done', 'up to date', 'failed', 'missing input' or 'blocked'}
+        '''
+        stages = self.order(self.select(targets) if targets else self.stages)
+        forced = set([stage.name for stage in stages if any([fnmatch.fnmatch(stage.name, pat) for pat in force])])
+        deps = dict([(stage.name, [up.name for up in self.upstream(stage)]) for stage in stages])
+        status = {}
+        running = {}
+        t_start = time.time()
+
+        if dry_run:
+            for stage in stages:
+                changed = any([status.get(dep) == 'stale' for dep in deps[stage.name]])
+                stale = changed or stage.name in forced or self.is_stale(stage)
+                status[stage.name] = 'stale' if stale else 'up to date'
+                print '%-40s %s' % (stage.name, status[stage.name])
+            return status
+
+        while len(status) < len(stages):
+            for stage in stages:
+                if stage.name in status or stage.name in running:
+                    continue
+                dep_status = [status.get(dep) for dep in deps[stage.name]]
+                if any([st in ['failed', 'missing input', 'blocked'] for st in dep_status]):
+                    status[stage.name] = 'blocked'
+                    continue
+                if not all([st in ['done', 'up to date'] for st in dep_status]):
+                    continue
+                key, missing = self.key(stage)                                 # the upstream outputs are final
+                if missing:
+                    print '%s: missing input %s' % (stage.name, ', '.join(missing))
+                    status[stage.name] = 'missing input'
+                    continue
+                if stage.name not in forced and not self.is_stale(stage):
+                    status[stage.name] = 'up to date'
+                    continue
+                if len(running) >= nproc:
+                    continue
+                print 'run %s: %s' % (stage.name, ' '.join(stage.cmd))
+                proc, log = self._launch(stage)
+                running[stage.name] = (proc, log, key, time.time())
+
+            for name, (proc, log, key, t0) in running.items():
+                if proc.poll() is None:
+                    continue
+                log.close()
+                del running[name]
+                dt = time.time() - t0
+                stage = self.stage(name)
+                if proc.returncode == 0 and all([_expand(pattern) for pattern in stage.outputs]):
+                    status[name] = 'done'
+                    self.state['stages'][name] = {'key': key, 'time': dt, 'finished': time.ctime()}
+                else:
+                    status[name] = 'failed'
+                    reason = 'exit code %i' % proc.returncode if proc.returncode != 0 else 'outputs missing'
+                    print '%s failed (%s), see %s' % (name, reason, self.log_dir + name + '.log')
+                self.state['stages'].setdefault(name, {})['last_time'] = dt
+                self.save_state()
+                print '%s %s in %.1f s' % (name, status[name], dt)
+            if running:
+                time.sleep(0.1)
+
+        self.save_state()
+        self.report(stages, status, time.time() - t_start)
+        return status
+
+    def report(self, stages, status, total):
+        print
+        print '%-40s %-14s %10s' % ('stage', 'status', 'time (s)')
+        for stage in stages:
+            dt = self.state['stages'].get(stage.name, {}).get('last_time')
+            dt = '%10.1f' % dt if status[stage.name] in ['done', 'failed'] and dt is not None else '%10s' % '-'
+            print '%-40s %-14s %s' % (stage.name, status[stage.name], dt)
+        print 'total: %.1f s' % total
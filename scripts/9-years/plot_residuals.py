@@ -684,8 +684,7 @@ elif unit == 'signif':
         print 'stds:'
         print sigmas
 
-    n_rnd = 5
-    n_eff = hlib.smoothing_neff(nside, smooth_sigma, n_rnd=n_rnd)
+    n_eff = hlib.smoothing_neff(nside, smooth_sigma)
     corr_fr = np.sqrt(n_eff)
     for i in plot_bins:
         if np.mean(mask) > 0.7:
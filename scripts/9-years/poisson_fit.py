@@ -0,0 +1,285 @@
+"""
+Vectorized Poisson likelihood fits of templates to count maps.
+
+The pixels are grouped in regions (e.g. latitude stripes) by an integer label per pixel,
+label < 0 means that the pixel is not used in the fit.
+The fits in all regions are done simultaneously with a projected Newton method
+(parameters at their limits are fixed while the gradient points outside),
+the sums over pixels in each region are calculated with np.bincount.
+Any number of templates can be fitted (fit_templates, fit_cube), fit_kc is the
+special case of the low-energy template and the isotropic (exposure) template.
+
+The minimized function is the same as in the Minuit fits of Save_lowE_res_fits.py:
+    -logL = sum over pixels: mu - x * log(mu)
+
+History:
+    Written as a replacement for the per-stripe Minuit fits in Save_lowE_res_fits.py
+"""
+
+import numpy as np
+
+
+def region_sums(values, labels, nlab):
+    '''
+    sum of values over pixels in each region
+    '''
+    return np.bincount(labels, weights=values, minlength=nlab)
+
+
+def stripe_labels(inds_dict, npix, nB, l_range):
+    '''
+        labels of latitude stripes from the dictionary of lat-lon bins
+    INPUT:
+        inds_dict - dictionary {(b, l): healpix_inds}, as given by healpylib.lb_profiles_hinds_dict
+        npix - number of pixels
+        nB - number of latitude bins
+        l_range - longitude bins used in the fit
+    OUTPUT:
+        labels - int array, shape (npix,): latitude index of the pixel, -1 if the pixel is not used
+    '''
+    labels = -np.ones(npix, dtype=int)
+    for b in xrange(nB):
+        for l in l_range:
+            labels[inds_dict[(b, l)]] = b
+    return labels
+
+
+def fit_kc(x, y, expo, labels, nlab=None, k0=0.04, c0=1.e-13, k_lim=(0., 1.), c_lim=(1.e-16, 1.e-10),
+           errordef=1., niter=100, tol=1.e-8, nhalf=30):
+    '''
+        fit the model k * y + c * expo to the data x in all regions at once (see fit_templates)
+    INPUT:
+        x - array, shape (npix,): data (high-energy counts)
+        y - array, shape (npix,): template (low-energy model)
+        expo - array, shape (npix,): exposure (isotropic template)
+        labels - int array, shape (npix,): region index, if < 0 the pixel is not used
+        nlab - number of regions, default: max(labels) + 1
+        k0, c0 - initial values
+        k_lim, c_lim - limits of the parameters
+        errordef - same convention as in Minuit: err = sqrt(2 * errordef * H^-1),
+                   where H is the Hessian of -logL
+        niter - max number of Newton steps
+        tol - relative tolerance on the change of the parameters
+        nhalf - max number of step halvings if -logL increases
+    OUTPUT:
+        k, c, k_err, c_err - arrays, shape (nlab,)
+    '''
+    p, cov = fit_templates(x, [y, expo], labels, nlab=nlab, p0=[k0, c0], bounds=[k_lim, c_lim],
+                           errordef=errordef, niter=niter, tol=tol, nhalf=nhalf)
+    return p[:, 0], p[:, 1], np.sqrt(cov[:, 0, 0]), np.sqrt(cov[:, 1, 1])
+
+
+def _nlogL_terms(mu, x):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = mu - x * np.log(mu)
+    # a zero model is allowed only in pixels without counts
+    return np.where(mu > 0, terms, np.where((mu == 0) & (x == 0), 0., np.inf))
+
+
+def _bounds_array(values, default, nlab, ntmpl):
+    res = default * np.ones((nlab, ntmpl))
+    if values is not None:
+        for i, val in enumerate(values):
+            if val is not None:
+                res[:, i] = val
+    return res
+
+
+def fit_templates(x, templates, labels=None, nlab=None, mask=None, p0=None, bounds=None,
+                  errordef=1., niter=100, tol=1.e-8, nhalf=30):
+    '''
+        fit the model sum_i p_i * templates[i] to the data x in all regions at once
+    INPUT:
+        x - array, shape (npix,): counts
+        templates - list of arrays with the shape (npix,)
+        labels - int array, shape (npix,): region index, if < 0 the pixel is not used,
+                 if None, all pixels are in one region (global fit)
+        nlab - number of regions, default: max(labels) + 1
+        mask - array, shape (npix,) or None: pixels with mask == 0 are not used
+        p0 - list of initial values (floats or arrays with the shape (nlab,)), None for the default:
+             the mean counts in the region are shared equally between the templates
+        bounds - list of (lower, upper) for each template, None for no limits,
+                 e.g. [(0, 1), (1.e-16, 1.e-10), (0, None)]
+        errordef - same convention as in Minuit: cov = 2 * errordef * H^-1
+        niter - max number of Newton steps
+        tol - relative tolerance on the change of the parameters
+        nhalf - max number of step halvings if -logL increases
+    OUTPUT:
+        p - array, shape (nlab, ntmpl): best-fit coefficients,
+            the initial values (or 0) for the templates which are zero in the region
+        cov - array, shape (nlab, ntmpl, ntmpl): covariance matrices,
+              nan for the templates which are zero in the region
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    npix = len(x)
+    if labels is None:
+        labels = np.zeros(npix, dtype=int)
+    sel = np.asarray(labels) >= 0
+    if mask is not None:
+        sel &= np.asarray(mask) > 0
+    lab = np.asarray(labels)[sel]
+    if nlab is None:
+        nlab = lab.max() + 1
+    x = x[sel]
+    T = np.array([np.asarray(tmpl, dtype=np.float64)[sel] for tmpl in templates])
+    ntmpl = len(T)
+
+    # rescale the templates to a mean of one in each region
+    npix_lab = np.maximum(np.bincount(lab, minlength=nlab), 1)
+    scale = np.array([region_sums(np.abs(tmpl), lab, nlab) for tmpl in T]).T / npix_lab[:, np.newaxis]
+    free = scale > 0                                                  # templates which are not zero in the region
+    scale[~free] = 1.
+    T = T / scale.T[:, lab]
+
+    lower = _bounds_array(None if bounds is None else [bnd[0] if bnd is not None else None for bnd in bounds],
+                          -np.inf, nlab, ntmpl) * scale
+    upper = _bounds_array(None if bounds is None else [bnd[1] if bnd is not None else None for bnd in bounds],
+                          np.inf, nlab, ntmpl) * scale
+    if p0 is None:
+        nfree = np.maximum(np.sum(free, axis=1), 1)
+        q = (region_sums(x, lab, nlab) / npix_lab / nfree)[:, np.newaxis] * np.ones((nlab, ntmpl))
+    else:
+        q = _bounds_array(p0, 0., nlab, ntmpl) * scale
+    q_fixed = np.zeros((nlab, ntmpl)) if p0 is None else q / scale   # reported for the templates which are zero in the region
+    q = np.where(free, q, 0.)
+    q = np.clip(q, lower, upper)
+
+    def model(q):
+        return np.sum(q.T[:, lab] * T, axis=0)
+
+    def nlogL(q):
+        return region_sums(_nlogL_terms(model(q), x), lab, nlab)
+
+    def hessian(w):
+        H = np.zeros((nlab, ntmpl, ntmpl))
+        for i in xrange(ntmpl):
+            for j in xrange(i, ntmpl):
+                H[:, i, j] = H[:, j, i] = region_sums(w * T[i] * T[j], lab, nlab)
+        return H
+
+    F = nlogL(q)
+    eye = np.eye(ntmpl)[np.newaxis]
+    for it in xrange(niter):
+        mu = model(q)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.where(mu > 0, x / mu, 0.)
+            w = np.where(mu > 0, r / mu, 0.)
+        g = np.array([region_sums(tmpl * (1. - r), lab, nlab) for tmpl in T]).T
+        H = hessian(w)
+
+        # parameters at the limits with the gradient pointing outside are fixed (active set)
+        fixed = ~free | ((q <= lower) & (g > 0)) | ((q >= upper) & (g < 0))
+        fix2 = fixed[:, :, np.newaxis] | fixed[:, np.newaxis, :]
+        H = np.where(fix2, 0., H) + eye * fixed[:, :, np.newaxis]
+        g = np.where(fixed, 0., g)
+        try:
+            d = np.linalg.solve(H, g[:, :, np.newaxis])[:, :, 0]
+        except np.linalg.LinAlgError:
+            d = np.einsum('rij,rj->ri', np.linalg.pinv(H), g)
+
+        # step halving in the regions where -logL increases
+        t = np.ones(nlab)
+        for i in xrange(nhalf):
+            q_new = np.clip(q - t[:, np.newaxis] * d, lower, upper)
+            F_new = nlogL(q_new)
+            worse = ~(F_new <= F + 1.e-12 * np.abs(F))
+            if not np.any(worse):
+                break
+            t[worse] /= 2.
+        else:
+            q_new = np.where(worse[:, np.newaxis], q, q_new)
+            F_new = np.where(worse, F, F_new)
+
+        change = np.max(np.abs(q_new - q) / np.maximum(np.abs(q), 1.e-10), axis=1)
+        q, F = q_new, F_new
+        if np.all(change < tol):
+            break
+
+    # covariance from the inverse Hessian at the minimum
+    mu = model(q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(mu > 0, x / mu**2, 0.)
+    H = hessian(w)
+    fix2 = ~free[:, :, np.newaxis] | ~free[:, np.newaxis, :]
+    H = np.where(fix2, 0., H) + eye * ~free[:, :, np.newaxis]
+    cov = 2. * errordef * np.linalg.pinv(H)
+    cov = np.where(fix2, np.nan, cov) / (scale[:, :, np.newaxis] * scale[:, np.newaxis, :])
+
+    return np.where(free, q / scale, q_fixed), cov
+
+
+def fit_cube(data, templates, labels=None, nlab=None, mask=None, p0=None, bounds=None, errordef=1.,
+             output_model=True, **kwargs):
+    '''
+        fit_templates in every energy bin of a data cube
+    INPUT:
+        data - array, shape (nE, npix): counts
+        templates - list of arrays with the shape (nE, npix) or (npix,) for energy independent templates
+        labels, nlab, mask, p0, bounds, errordef - see fit_templates
+        output_model - if True, the model and the residual cubes are calculated
+    OUTPUT:
+        dictionary with
+            'coefs', 'errors' - lists (one entry per template) of arrays with the shape (nlab, nE),
+                                as required by region_model
+            'cov' - array, shape (nE, nlab, ntmpl, ntmpl)
+            'model', 'resid' - arrays, shape (nE, npix): model and data - model (if output_model)
+    '''
+    nE = len(data)
+    if labels is None:
+        labels = np.zeros(data.shape[-1], dtype=int)
+    if mask is not None:
+        labels = np.where(np.asarray(mask) > 0, labels, -1)
+    if nlab is None:
+        nlab = np.max(labels) + 1
+    ntmpl = len(templates)
+    coefs = np.zeros((ntmpl, nlab, nE))
+    errors = np.zeros((ntmpl, nlab, nE))
+    cov = np.zeros((nE, nlab, ntmpl, ntmpl))
+    for E in xrange(nE):
+        tmpls = [tmpl[E] if np.ndim(tmpl) == 2 else tmpl for tmpl in templates]
+        p, cov[E] = fit_templates(data[E], tmpls, labels, nlab=nlab, p0=p0, bounds=bounds,
+                                  errordef=errordef, **kwargs)
+        coefs[:, :, E] = p.T
+        errors[:, :, E] = np.sqrt(np.diagonal(cov[E], axis1=1, axis2=2)).T
+    res = {'coefs': list(coefs), 'errors': list(errors), 'cov': cov}
+    if output_model:
+        res['model'] = region_model(res['coefs'], templates, labels)
+        res['resid'] = data - res['model']
+    return res
+
+
+def region_model(coefs, templates, labels, E=None):
+    '''
+        reconstruct the model sum_i coefs[i][label, E] * templates[i][E] in all pixels
+    INPUT:
+        coefs - list of arrays, shape (nlab, nE): best-fit coefficients in each region
+        templates - list of arrays, shape (nE, npix) or (npix,) for energy independent templates
+        labels - int array, shape (npix,): region index, if < 0 the model is zero
+        E - energy index, if None the full cube is calculated
+    OUTPUT:
+        model - array, shape (nE, npix) or (npix,) if E is not None
+    '''
+    inside = labels >= 0
+    lab = np.where(inside, labels, 0)
+    model = 0.
+    for coef, tmpl in zip(coefs, templates):
+        tmpl = np.asarray(tmpl)
+        if E is None:
+            if tmpl.ndim == 2:
+                model = model + coef.T[:, lab] * tmpl
+            else:
+                model = model + coef.T[:, lab] * tmpl[np.newaxis]
+        else:
+            if tmpl.ndim == 2:
+                tmpl = tmpl[E]
+            model = model + coef[lab, E] * tmpl
+    return model * inside
+
+
+def iter_region_model(coefs, templates, labels):
+    '''
+    generator of the model planes (E, model[E]), one energy bin at a time
+    '''
+    nE = coefs[0].shape[1]
+    for E in xrange(nE):
+        yield E, region_model(coefs, templates, labels, E=E)
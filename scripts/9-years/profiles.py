@@ -0,0 +1,135 @@
+"""
+Aggregation of healpix maps in lat-lon boxes.
+
+Every pixel has an integer box label (e.g. ib * nL + il from healpylib.lb_labels),
+label < 0 means that the pixel is not used (outside of the region or masked).
+The sums over the pixels in all boxes and for all energy bins are calculated at once
+as a product of a sparse (nbox, npix) matrix with the (npix, nE) data cube.
+Several binnings (e.g. 'small' and 'large' latitude bins) can be stacked in one matrix.
+
+Usage:
+    ib, il = healpylib.lb_labels(nside, Bbins, Lbins, mask=mask)
+    stats = profiles.lb_stats(data, ib, il, nB, nL)
+    stats['sum'], stats['mean'] - arrays with the shape (nB, nL, nE)
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def box_labels(ib, il, nL):
+    '''
+    combine lat and lon indices into one box label, -1 if either of them is -1
+    '''
+    return np.where((ib >= 0) & (il >= 0), ib * nL + il, -1)
+
+
+def label_matrix(labels, nbox, weights=None, mask=None):
+    '''
+        sparse matrix M with shape (nbox, npix): M[label[p], p] = weights[p] * mask[p]
+    INPUT:
+        labels - int array, shape (npix,): box labels, negative labels are omitted
+        nbox - number of boxes
+        weights - array, shape (npix,) or None
+        mask - array, shape (npix,) or None: pixels with mask == 0 are omitted
+    '''
+    labels = np.asarray(labels)
+    npix = len(labels)
+    use = labels >= 0
+    if mask is not None:
+        use &= np.asarray(mask) > 0
+    pixels = np.arange(npix)[use]
+    if weights is None:
+        values = np.ones(len(pixels))
+    else:
+        values = np.asarray(weights, dtype=np.float64)[use]
+    return sparse.csr_matrix((values, (labels[use], pixels)), shape=(nbox, npix))
+
+
+def box_sums(cube, matrix):
+    '''
+        sums of a map or a data cube over the boxes
+    INPUT:
+        cube - array, shape (npix,) or (npix, nE)
+        matrix - label matrix, shape (nbox, npix)
+    OUTPUT:
+        array, shape (nbox,) or (nbox, nE)
+    '''
+    return matrix.dot(np.asarray(cube, dtype=np.float64))
+
+
+def box_stats(cube, labels, nbox, mask=None, weights=None, matrix=None):
+    '''
+        sums, pixel counts, means, weighted means and variances in all boxes
+    INPUT:
+        cube - array, shape (npix,) or (npix, nE)
+        labels - int array, shape (npix,): box labels
+        nbox - number of boxes
+        mask - array, shape (npix,) or None: masked pixels (mask == 0) are omitted
+        weights - array, shape (npix,) or None: weights for the weighted mean
+        matrix - precalculated label_matrix(labels, nbox, mask=mask) (optional)
+    OUTPUT:
+        dictionary with
+            'npix' - number of unmasked pixels in the box, shape (nbox,)
+            'sum', 'mean', 'var' - shape (nbox, nE)
+            'wmean' - weighted mean (if weights is not None)
+        the means and variances are nan for empty boxes
+    '''
+    cube = np.asarray(cube, dtype=np.float64)
+    if matrix is None:
+        matrix = label_matrix(labels, nbox, mask=mask)
+    res = {}
+    res['npix'] = np.asarray(matrix.sum(axis=1)).flatten()
+    n = res['npix']
+    if cube.ndim == 2:
+        n = n[:, np.newaxis]
+    res['sum'] = box_sums(cube, matrix)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res['mean'] = res['sum'] / n
+        res['var'] = np.maximum(box_sums(cube**2, matrix) / n - res['mean']**2, 0.)        # clipped: rounding errors for near-constant boxes
+        if weights is not None:
+            wmatrix = label_matrix(labels, nbox, weights=weights, mask=mask)
+            wsum = np.asarray(wmatrix.sum(axis=1)).flatten()
+            if cube.ndim == 2:
+                wsum = wsum[:, np.newaxis]
+            res['wmean'] = box_sums(cube, wmatrix) / wsum
+    return res
+
+
+def lb_stats(cube, ib, il, nB, nL, mask=None, weights=None):
+    '''
+        box_stats in lat-lon boxes, the outputs are reshaped to (nB, nL, nE) and (nB, nL)
+    INPUT:
+        cube - array, shape (npix,) or (npix, nE)
+        ib, il - int arrays, shape (npix,): lat and lon indices (e.g. from healpylib.lb_labels)
+        nB, nL - number of lat and lon bins
+    '''
+    res = box_stats(cube, box_labels(ib, il, nL), nB * nL, mask=mask, weights=weights)
+    for key in res:
+        res[key] = res[key].reshape((nB, nL) + res[key].shape[1:])
+    return res
+
+
+def multi_lb_sums(cube, binnings, weights=None, mask=None):
+    '''
+        sums over lat-lon boxes for several binnings in one sparse matrix product
+    INPUT:
+        cube - array, shape (npix,) or (npix, nE)
+        binnings - list of (ib, il, nB, nL)
+    OUTPUT:
+        list of arrays with the shapes (nB, nL, nE) and list of pixel numbers with the shapes (nB, nL)
+    '''
+    matrices = [label_matrix(box_labels(ib, il, nL), nB * nL, weights=weights, mask=mask)
+                for ib, il, nB, nL in binnings]
+    matrix = sparse.vstack(matrices).tocsr()
+    sums = box_sums(cube, matrix)
+    npixs = np.asarray(sparse.vstack([(m != 0) for m in matrices]).sum(axis=1)).flatten()
+    res_sums = []
+    res_npix = []
+    i0 = 0
+    for ib, il, nB, nL in binnings:
+        i1 = i0 + nB * nL
+        res_sums.append(sums[i0:i1].reshape((nB, nL) + sums.shape[1:]))
+        res_npix.append(npixs[i0:i1].reshape((nB, nL)))
+        i0 = i1
+    return res_sums, res_npix
@@ -0,0 +1,325 @@
+"""
+Writer of healpix energy cubes in the fits format of the Fermi-LAT skymaps
+(PrimaryHDU, SKYMAP table with the column 'Spectra', ENERGIES table).
+
+The headers are written directly and the cube is streamed to the disk in chunks of pixels
+as big-endian rows, so that no column definitions or intermediate tables are created.
+The file is written to a temporary file which is renamed at the end,
+an interrupted run never leaves a broken fits file.
+
+Usage:
+    import skymap_io
+    skymap_io.write_cube(fn, cube, unit='counts', Es=Es_high)                  # cube.shape = (npix, nE)
+    skymap_io.write_cube(fn, cube, unit='counts', Es=Es_high, energy_major=True) # cube.shape = (nE, npix)
+    skymap_io.write_cube(fn + '.gz', cube, compress=True)                        # gzip compressed
+
+    writer = skymap_io.SkymapWriter(fn, nside, nE, unit='counts', Es=Es_high)  # one energy bin at a time
+    for E in xrange(nE):
+        writer.write(E, plane)
+    writer.close()
+
+    writer = skymap_io.TableWriter(fn, nrows, [('ENERGY', 'E', 'MeV'), ('L', 'E', 'deg')])  # binary table in chunks of rows
+    writer.write({'ENERGY': Es_chunk, 'L': Ls_chunk})
+    writer.close()
+"""
+
+import os
+import io
+import gzip
+import shutil
+import numpy as np
+import healpy
+
+
+block_size = 2880                                 # size of the fits blocks in bytes
+card_size = 80
+chunk_size = 2**16                                # number of pixels written at once
+gzip_level = 1                                    # compression level for compress=True (fast)
+
+fits_formats = {np.dtype(np.float32): 'E', np.dtype(np.float64): 'D'}
+column_dtypes = {'E': '>f4', 'D': '>f8', 'I': '>i2', 'J': '>i4', 'K': '>i8', 'B': 'u1'}
+
+
+####################################################################################################################### Headers
+
+
+def _value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return '%20s' % ('T' if value else 'F')
+    if isinstance(value, (int, long, np.integer)):
+        return '%20i' % value
+    if isinstance(value, (float, np.floating)):
+        return '%20s' % repr(float(value)).upper()
+    return "%-20s" % ("'%-8s'" % str(value).replace("'", "''"))
+
+
+def _card(key, value=None, comment=None):
+    '''
+    one 80 characters header card
+    '''
+    if value is None:
+        card = '%-8s' % key
+    else:
+        card = '%-8s= ' % key + _value(value)
+        if comment is not None:
+            card += ' / ' + comment
+    return card[:card_size].ljust(card_size)
+
+
+def _pad(nbytes):
+    return (-nbytes) % block_size
+
+
+def _header(cards):
+    '''
+    header string padded to a multiple of the fits block size
+    '''
+    text = ''.join([_card(*card) for card in cards]) + _card('END')
+    return text + ' ' * _pad(len(text))
+
+
+def _table_cards(name, nrows, column, fmt, unit, extra=()):
+    return _columns_cards(name, nrows, [(column, fmt, unit)], extra=extra)
+
+
+def _columns_cards(name, nrows, columns, extra=()):
+    '''
+    header cards of a binary table, columns - list of (name, fits format, unit)
+    '''
+    nbytes = sum([column_dtype(fmt).itemsize for column, fmt, unit in columns])
+    cards = [('XTENSION', 'BINTABLE', 'binary table extension'),
+             ('BITPIX', 8, 'array data type'),
+             ('NAXIS', 2, 'number of array dimensions'),
+             ('NAXIS1', nbytes, 'length of dimension 1'),
+             ('NAXIS2', nrows, 'length of dimension 2'),
+             ('PCOUNT', 0, 'number of group parameters'),
+             ('GCOUNT', 1, 'number of groups'),
+             ('TFIELDS', len(columns), 'number of table fields')]
+    for i, (column, fmt, unit) in enumerate(columns):
+        cards.append(('TTYPE%i' % (i + 1), column))
+        cards.append(('TFORM%i' % (i + 1), fmt))
+        if unit is not None:
+            cards.append(('TUNIT%i' % (i + 1), unit))
+    cards.append(('EXTNAME', name, 'extension name'))
+    return cards + list(extra)
+
+
+def column_dtype(fmt):
+    '''
+    big-endian numpy dtype of a fits column format, e.g. '24E' -> ('>f4', (24,))
+    '''
+    nval = int(fmt[:-1]) if len(fmt) > 1 else 1
+    base = np.dtype(column_dtypes[fmt[-1]])
+    return base if nval == 1 else np.dtype((base, (nval,)))
+
+
+def skymap_cards(npix, nE, unit=None, dtype=np.float32, emin=None, deltae=None, ordering='RING'):
+    '''
+    header cards of the SKYMAP extension
+    '''
+    extra = [('PIXTYPE', 'HEALPIX'),
+             ('ORDERING', ordering),
+             ('NSIDE', healpy.npix2nside(npix)),
+             ('FIRSTPIX', 0),
+             ('LASTPIX', npix - 1),
+             ('NBRBINS', nE, 'Number of energy bins')]
+    if emin is not None:
+        extra.append(('EMIN', float(emin), 'Minimum energy'))
+    if deltae is not None:
+        extra.append(('DELTAE', float(deltae), 'Step in energy (log)'))
+    fmt = '%i%s' % (nE, fits_formats[np.dtype(dtype)])
+    return _table_cards('SKYMAP', npix, 'Spectra', fmt, unit, extra=extra)
+
+
+def _deltae(Es):
+    if Es is None or len(Es) < 2:
+        return None
+    return np.log(Es[1] / Es[0])
+
+
+####################################################################################################################### Writers
+
+
+def _open(fn, compress):
+    folder = os.path.dirname(fn)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp_fn = fn + '.tmp%i' % os.getpid()
+    if compress:
+        return tmp_fn, gzip.open(tmp_fn, 'wb', compresslevel=compress if compress is not True else gzip_level)
+    return tmp_fn, open(tmp_fn, 'wb')
+
+
+def _write_energies(f, Es, Eunit):
+    Es = np.asarray(Es, dtype='>f4')
+    f.write(_header(_table_cards('ENERGIES', len(Es), Eunit, 'E', Eunit)))
+    f.write(Es.tostring())
+    f.write('\0' * _pad(Es.nbytes))
+
+
+def write_cube(fn, cube, unit=None, Es=None, Eunit='GeV', energy_major=False, dtype=np.float32,
+               compress=False, emin=None, deltae=None, ordering='RING', silent=False):
+    '''
+        save a healpix energy cube as a fits skymap
+    INPUT:
+        fn - fits file name, None: the HDUList is returned (the pyfits module is needed)
+        cube - array, shape (npix, nE) or (nE, npix) if energy_major (e.g. the memory-mapped cubes of stream_maps)
+        unit - unit of the data
+        Es - energies, if not None, the ENERGIES extension is written
+        Eunit - name and unit of the energy column
+        dtype - np.float32 (format 'E', as in the old hmap2skymap) or np.float64 (format 'D')
+        compress - False, True or gzip compression level 1 - 9
+        emin, deltae - EMIN and DELTAE in the header, default: Es[0] and log(Es[1] / Es[0])
+        ordering - healpix ordering
+    '''
+    cube = np.asarray(cube) if not isinstance(cube, np.memmap) else cube
+    if cube.ndim == 1:
+        cube = cube[:, np.newaxis]
+    elif not energy_major:
+        cube = cube.T                                                        # a view, the rows are made in chunks
+    nE, npix = cube.shape
+    if emin is None and Es is not None:
+        emin = Es[0]
+    if deltae is None:
+        deltae = _deltae(Es)
+    be_dtype = np.dtype(dtype).newbyteorder('>')
+
+    if fn is None:
+        import pyfits
+        f = io.BytesIO()
+    else:
+        tmp_fn, f = _open(fn, compress)
+        if not silent:
+            print 'save skymap to file:'
+            print fn
+    try:
+        f.write(_header([('SIMPLE', True, 'conforms to FITS standard'), ('BITPIX', 8, 'array data type'),
+                         ('NAXIS', 0, 'number of array dimensions'), ('EXTEND', True)]))
+        f.write(_header(skymap_cards(npix, nE, unit=unit, dtype=dtype, emin=emin, deltae=deltae, ordering=ordering)))
+        for i in xrange(0, npix, chunk_size):
+            chunk = cube[:, i:i + chunk_size].astype(be_dtype)                  # convert before the transposition
+            f.write(chunk.T.tostring())
+        f.write('\0' * _pad(npix * nE * be_dtype.itemsize))
+        if Es is not None:
+            _write_energies(f, Es, Eunit)
+    except:
+        f.close()
+        if fn is not None:
+            os.remove(tmp_fn)
+        raise
+
+    if fn is None:
+        f.seek(0)
+        return pyfits.open(f)
+    f.close()
+    os.rename(tmp_fn, fn)
+    return None
+
+
+class SkymapWriter(object):
+    '''
+        fits skymap which is filled one energy bin at a time
+        the data part of the file is memory-mapped and every plane is written to the disk directly,
+        the file is renamed to fn in close()
+    INPUT:
+        fn - fits file name
+        nside, nE - shape of the cube
+        unit, Es, Eunit, dtype, emin, deltae, ordering - see write_cube
+        compress - if True, the file is gzip compressed in close()
+    '''
+    def __init__(self, fn, nside, nE, unit=None, Es=None, Eunit='GeV', dtype=np.float32,
+                 compress=False, emin=None, deltae=None, ordering='RING'):
+        self.fn = fn
+        self.npix = healpy.nside2npix(nside)
+        self.nE = nE
+        self.compress = compress
+        if emin is None and Es is not None:
+            emin = Es[0]
+        if deltae is None:
+            deltae = _deltae(Es)
+        self.tmp_fn, f = _open(fn, False)
+        head = _header([('SIMPLE', True, 'conforms to FITS standard'), ('BITPIX', 8, 'array data type'),
+                        ('NAXIS', 0, 'number of array dimensions'), ('EXTEND', True)])
+        head += _header(skymap_cards(self.npix, nE, unit=unit, dtype=dtype, emin=emin, deltae=deltae, ordering=ordering))
+        f.write(head)
+        be_dtype = np.dtype(dtype).newbyteorder('>')
+        nbytes = self.npix * nE * be_dtype.itemsize
+        f.seek(nbytes + _pad(nbytes) - 1, 1)                                  # sparse zero-filled data part
+        f.write('\0')
+        if Es is not None:
+            _write_energies(f, Es, Eunit)
+        f.close()
+        self.data = np.memmap(self.tmp_fn, dtype=be_dtype, mode='r+', offset=len(head), shape=(self.npix, nE))
+
+    def write(self, E, plane):
+        '''
+        write the healpix map of energy bin E
+        '''
+        self.data[:, E] = plane
+
+    def close(self):
+        self.data.flush()
+        del self.data
+        print 'save skymap to file:'
+        print self.fn
+        if self.compress:
+            level = self.compress if self.compress is not True else gzip_level
+            with open(self.tmp_fn, 'rb') as f_in:
+                f_out = gzip.open(self.tmp_fn + '.gz', 'wb', compresslevel=level)
+                shutil.copyfileobj(f_in, f_out, 2**20)
+                f_out.close()
+            os.remove(self.tmp_fn)
+            self.tmp_fn += '.gz'
+        os.rename(self.tmp_fn, self.fn)
+
+
+def hmap2skymap(values, fn=None, unit=None, kdict=None, comment=None, Es=None, Eunit='GeV', emin=None, deltae=None,
+                dtype=np.float32, compress=False):
+    '''
+    same interface as auxil.hmap2skymap: values.shape = (npix, nE)
+    '''
+    return write_cube(fn, values, unit=unit, Es=Es, Eunit=Eunit, dtype=dtype, compress=compress,
+                      emin=emin, deltae=deltae)
+
+
+class TableWriter(object):
+    '''
+        fits binary table (e.g. an FT1-like EVENTS table) which is written in chunks of rows
+        the number of rows has to be known in advance, the file is renamed to fn in close()
+    INPUT:
+        fn - fits file name
+        nrows - number of rows
+        columns - list of (name, fits format, unit), e.g. ('ENERGY', 'E', 'MeV')
+        extname - name of the extension
+    '''
+    def __init__(self, fn, nrows, columns, extname='EVENTS'):
+        self.fn = fn
+        self.nrows = nrows
+        self.rows = 0
+        self.dtype = np.dtype([(column, column_dtype(fmt)) for column, fmt, unit in columns])
+        self.tmp_fn, self.f = _open(fn, False)
+        self.f.write(_header([('SIMPLE', True, 'conforms to FITS standard'), ('BITPIX', 8, 'array data type'),
+                              ('NAXIS', 0, 'number of array dimensions'), ('EXTEND', True)]))
+        self.f.write(_header(_columns_cards(extname, nrows, columns)))
+
+    def write(self, chunk):
+        '''
+        write the rows in chunk - dictionary {column: array}
+        '''
+        n = len(chunk[self.dtype.names[0]])
+        if self.rows + n > self.nrows:
+            raise ValueError, 'more than %i rows' % self.nrows
+        rows = np.empty(n, dtype=self.dtype)
+        for column in self.dtype.names:
+            rows[column] = chunk[column]
+        self.f.write(rows.tostring())
+        self.rows += n
+
+    def close(self):
+        if self.rows != self.nrows:
+            self.f.close()
+            os.remove(self.tmp_fn)
+            raise ValueError, '%i rows are written instead of %i' % (self.rows, self.nrows)
+        self.f.write('\0' * _pad(self.nrows * self.dtype.itemsize))
+        self.f.close()
+        os.rename(self.tmp_fn, self.fn)
@@ -0,0 +1,209 @@
+"""
+Smoothing of healpix maps and energy cubes in harmonic space.
+
+The alms of all energy bins of a cube are calculated once. Any number of beams
+(Gaussian widths or tabulated PSF window functions b_l) are applied to the same alms.
+With use_cache=True the alms and the smoothed cubes are saved in the cache directory
+(healpylib.cache_dir), keyed by a sha1 of the cube, lmax and the beam, so that trying a new
+smoothing width in a later run does not require a new map2alm transformation. The cache files
+are written atomically (parallel runs may share them) and the oldest files are deleted when
+the smoothing cache exceeds cache_max_size.
+
+The result is the same as healpy.smoothing(cube[E], sigma=sigma) for every energy bin
+(iter = 3, lmax = 3 * nside - 1, no pixel window).
+
+Usage:
+    import smoothing
+    data_smooth = smoothing.smooth_cube(data, sigma=np.deg2rad(1.))
+    cubes = smoothing.smooth_cube(data, sigma=np.deg2rad([0.4, 0.65, 1., 1.41]))
+"""
+
+import os
+import numpy as np
+import healpy
+import healpylib as hlib
+
+
+niter = 3                                         # number of iterations in map2alm, same as in healpy.smoothing
+cache_max_size = 2 * 1024**3                      # max total size (bytes) of the cached alms and smoothed cubes
+cache_prefixes = ('alms_', 'smooth_')
+
+
+def sigma2beam(sigma, lmax):
+    '''
+    Gaussian window function b_l, l = 0 ... lmax, sigma in rad
+    '''
+    return healpy.gauss_beam(sigma * np.sqrt(8. * np.log(2.)), lmax=lmax)
+
+
+def psf2beam(theta, psf, lmax):
+    '''
+        window function of an azimuthally symmetric PSF
+    INPUT:
+        theta - array: angular distance (rad)
+        psf - array: PSF at theta (arbitrary normalization)
+        lmax - maximal multipole
+    OUTPUT:
+        b_l - array, shape (lmax + 1,): normalized to b_0 = 1
+    '''
+    bl = healpy.beam2bl(psf, theta, lmax)
+    return bl / bl[0]
+
+
+def _map2alm(args):
+    fpix, lmax = args
+    return healpy.map2alm(fpix, lmax=lmax, iter=niter)
+
+
+def _alm2map(args):
+    alm, beam, nside, lmax = args
+    return healpy.alm2map(healpy.almxfl(alm, beam), nside, lmax=lmax, verbose=False)
+
+
+def _pmap(func, args, nproc):
+    if nproc > 1 and len(args) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc)
+        res = pool.map(func, args)
+        pool.close()
+        pool.join()
+        return res
+    return [func(arg) for arg in args]
+
+
+def _cache_files():
+    if not os.path.isdir(hlib.cache_dir):
+        return []
+    return [hlib.cache_dir + fn for fn in os.listdir(hlib.cache_dir)
+            if fn.startswith(cache_prefixes) and fn.endswith('.npy') and '.tmp' not in fn]
+
+
+def _evict(max_size=None):
+    '''
+    delete the least recently used smoothing cache files until the total size is below max_size
+    '''
+    if max_size is None:
+        max_size = cache_max_size
+    files = []
+    for fn in _cache_files():
+        try:
+            stat = os.stat(fn)
+        except OSError:                                   # deleted by another process
+            continue
+        files.append((stat.st_mtime, stat.st_size, fn))
+    files.sort()
+    total = sum([size for mtime, size, fn in files])
+    for mtime, size, fn in files:
+        if total <= max_size:
+            break
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+        total -= size
+
+
+def _load(fn):
+    '''
+    load a cache file and mark it as recently used
+    '''
+    res = np.load(fn)
+    try:
+        os.utime(fn, None)
+    except OSError:
+        pass
+    return res
+
+
+def _save(fn, array):
+    hlib._save_cache(fn, array)
+    _evict()
+
+
+def cube_alms(cube, lmax=None, use_cache=False, nproc=1):
+    '''
+        alms of all maps of a cube
+    INPUT:
+        cube - array, shape (nE, npix) or (npix,)
+        lmax - maximal multipole, default: 3 * nside - 1
+        use_cache - read and save the alms in the cache directory
+        nproc - number of processes (parallel over energy bins)
+    OUTPUT:
+        alms - complex array, shape (nE, nalm) or (nalm,)
+    '''
+    cube = np.asarray(cube, dtype=np.float64)
+    nside = healpy.npix2nside(cube.shape[-1])
+    if lmax is None:
+        lmax = 3 * nside - 1
+    fn = hlib._cache_fn('alms_lmax%i' % lmax, nside, cube)
+    if use_cache and os.path.isfile(fn):
+        return _load(fn)
+    maps = cube.reshape((-1, cube.shape[-1]))
+    alms = np.array(_pmap(_map2alm, [(fpix, lmax) for fpix in maps], nproc))
+    alms = alms.reshape(cube.shape[:-1] + alms.shape[-1:])
+    if use_cache:
+        _save(fn, alms)
+    return alms
+
+
+def smooth_alms(alms, beams, nside, lmax=None, use_cache=False, nproc=1):
+    '''
+        maps from the alms multiplied by the beams
+    INPUT:
+        alms - complex array, shape (nE, nalm) or (nalm,)
+        beams - list of window functions b_l (arrays with at least lmax + 1 elements)
+        nside - healpix nside of the output maps
+    OUTPUT:
+        list of cubes, shape (nE, npix) or (npix,), one for each beam
+    '''
+    alms = np.asarray(alms)
+    if lmax is None:
+        lmax = healpy.Alm.getlmax(alms.shape[-1])
+    flat = alms.reshape((-1, alms.shape[-1]))
+    res = []
+    for beam in beams:
+        beam = np.asarray(beam, dtype=np.float64)[:lmax + 1]
+        fn = hlib._cache_fn('smooth_lmax%i' % lmax, nside, alms, beam)
+        if use_cache and os.path.isfile(fn):
+            res.append(_load(fn))
+            continue
+        maps = np.array(_pmap(_alm2map, [(alm, beam, nside, lmax) for alm in flat], nproc))
+        maps = maps.reshape(alms.shape[:-1] + maps.shape[-1:])
+        if use_cache:
+            _save(fn, maps)
+        res.append(maps)
+    return res
+
+
+def smooth_cube(cube, sigma=None, beams=None, lmax=None, use_cache=False, nproc=1):
+    '''
+        smooth all maps of a cube with one or several beams
+    INPUT:
+        cube - array, shape (nE, npix) or (npix,)
+        sigma - Gaussian width (rad), float or list of floats
+        beams - window function b_l or list of window functions (e.g. from psf2beam)
+        lmax - maximal multipole, default: 3 * nside - 1
+        use_cache - cache the alms and the smoothed cubes in healpylib.cache_dir (opt-in, bounded by cache_max_size)
+        nproc - number of processes (parallel over energy bins)
+    OUTPUT:
+        smoothed cube if sigma is a float (or a single beam is given), otherwise a list of cubes
+    '''
+    cube = np.asarray(cube, dtype=np.float64)
+    nside = healpy.npix2nside(cube.shape[-1])
+    if lmax is None:
+        lmax = 3 * nside - 1
+    single = False
+    bls = []
+    if sigma is not None:
+        single = np.ndim(sigma) == 0
+        bls += [sigma2beam(sgm, lmax) for sgm in np.atleast_1d(sigma)]
+    if beams is not None:
+        if np.ndim(beams[0]) == 0:
+            single = sigma is None
+            beams = [beams]
+        bls += list(beams)
+    alms = cube_alms(cube, lmax=lmax, use_cache=use_cache, nproc=nproc)
+    res = smooth_alms(alms, bls, nside, lmax=lmax, use_cache=use_cache, nproc=nproc)
+    if single:
+        return res[0]
+    return res
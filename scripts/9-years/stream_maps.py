@@ -0,0 +1,166 @@
+"""
+Output cubes of the map-stage scripts which are filled one energy bin at a time.
+
+The cubes are preallocated energy-major (nE, npix) arrays, either in memory or as
+memory-mapped .npy files next to the output fits files. In the memory-mapped (streaming) mode
+every plane is flushed to the disk as soon as it is written and the finished bins together with
+their fit parameters are recorded in a json file. If the script crashes at bin 20,
+a rerun continues at bin 20 and the bins 0 - 19 are not recalculated.
+The progress file also stores the key of the run (run_key: hash of the parameters, the code and
+the input files). If the key changed, e.g. a different smoothing or new input cubes,
+the stored bins are discarded and the run starts from the first bin.
+
+Usage:
+    key = stream_maps.run_key({'smooth_sigma': smooth_sigma}, ['Save_lowE_res_fits.py', counts_fn, expo_fn])
+    store = stream_maps.PlaneStore('fits/LowE_0.3-1.0GeV_source', ['model', 'resid_counts'], nE, npix, streaming=True, key=key)
+    for E in xrange(nE):
+        if store.done(E):
+            continue
+        ...
+        store.write(E, {'model': model, 'resid_counts': resid}, pars={'k': k, 'c': c})
+    k_array = store.pars('k')                     # shape (nB, nE)
+"""
+
+import os
+import numpy as np
+import healpylib as hlib
+import dio
+
+
+hashes_fn = hlib.cache_dir + 'file_hashes.json'          # content hashes of the files, keyed by the mtime and the size
+
+
+def file_hashes(fns):
+    '''
+        content hashes of the files, recalculated only if the mtime or the size of a file changed
+        (same as pipeline.Pipeline.file_hash), the table is shared by all runs
+    INPUT:
+        fns - list of files
+    OUTPUT:
+        dictionary {fn: hash}
+    '''
+    table = {}
+    if os.path.isfile(hashes_fn):
+        table = dio.loaddict(hashes_fn)
+    res = {}
+    changed = False
+    for fn in fns:
+        stat = os.stat(fn)
+        path = os.path.abspath(fn)
+        entry = table.get(path)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': dio.get_file_hash(fn)}
+            table[path] = entry
+            changed = True
+        res[fn] = entry['hash']
+    if changed:
+        folder = os.path.dirname(hashes_fn)
+        if folder and not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:                                                            # created by a parallel run
+                pass
+        tmp_fn = hashes_fn + '.tmp%i' % os.getpid()
+        dio.savedict(table, tmp_fn, silent=True)
+        os.rename(tmp_fn, hashes_fn)
+    return res
+
+
+def run_key(params, fns):
+    '''
+        key of a run: hash of the parameters and of the content of the files (scripts, input cubes, masks),
+        the large input cubes are only read again if they changed (see file_hashes)
+    INPUT:
+        params - dictionary of parameters
+        fns - list of files
+    '''
+    return dio.get_hash({'params': params, 'files': file_hashes(fns)})
+
+
+class PlaneStore(object):
+    '''
+        preallocated output cubes with the shape (nE, npix)
+    INPUT:
+        fn - base name of the memory-mapped files
+        names - names of the cubes
+        nE, npix - shape of the cubes
+        streaming - if True, the cubes are memory-mapped .npy files, otherwise arrays in memory
+        dtype - data type of the cubes
+        resume - continue an interrupted run with the same names, shape and key
+        key - key of the run (see run_key), the progress of a run with a different key is discarded
+    '''
+    def __init__(self, fn, names, nE, npix, streaming=True, dtype=np.float64, resume=True, key=None):
+        self.fn = fn
+        self.names = list(names)
+        self.nE = nE
+        self.npix = npix
+        self.streaming = streaming
+        self.progress_fn = fn + '_progress.json'
+        shape = (nE, npix)
+
+        self.progress = {'names': self.names, 'shape': list(shape), 'key': key, 'done': [], 'pars': {}}
+        if streaming and resume and os.path.isfile(self.progress_fn):
+            progress = dio.loaddict(self.progress_fn)
+            if progress.get('key') != key:
+                print 'discard the progress of %s: the parameters, the code or the inputs changed' % fn
+            elif progress.get('names') == self.names and progress.get('shape') == list(shape) \
+                    and all([os.path.isfile(self.cube_fn(name)) for name in self.names]):
+                self.progress = progress
+                print 'resume %s: %i of %i energy bins are done' % (fn, len(progress['done']), nE)
+
+        self.cubes = {}
+        for name in self.names:
+            if not streaming:
+                self.cubes[name] = np.zeros(shape, dtype=dtype)
+            elif len(self.progress['done']) > 0:
+                self.cubes[name] = np.load(self.cube_fn(name), mmap_mode='r+')
+            else:
+                folder = os.path.dirname(self.cube_fn(name))
+                if folder and not os.path.isdir(folder):
+                    os.makedirs(folder)
+                self.cubes[name] = np.lib.format.open_memmap(self.cube_fn(name), mode='w+', dtype=dtype, shape=shape)
+
+    def cube_fn(self, name):
+        return self.fn + '_' + name + '.npy'
+
+    def done(self, E):
+        return E in self.progress['done']
+
+    def write(self, E, planes, pars=None):
+        '''
+            save the planes of energy bin E and the fit parameters
+        INPUT:
+            planes - dictionary {name: array with shape (npix,)}
+            pars - dictionary {name: array or float}
+        '''
+        for name, plane in planes.items():
+            self.cubes[name][E] = plane
+            if self.streaming:
+                self.cubes[name].flush()
+        if pars is not None:
+            self.progress['pars'][str(E)] = dict([(key, np.asarray(val).tolist()) for key, val in pars.items()])
+        self.progress['done'].append(E)
+        if self.streaming:
+            tmp_fn = self.progress_fn + '.tmp'
+            dio.savedict(self.progress, tmp_fn, silent=True)
+            os.rename(tmp_fn, self.progress_fn)                                        # the progress file is always complete
+
+    def pars(self, key):
+        '''
+        fit parameter of all energy bins, the energy is the last axis
+        '''
+        return np.array([self.progress['pars'][str(E)][key] for E in xrange(self.nE)]).T
+
+    def complete(self):
+        return len(set(self.progress['done'])) == self.nE
+
+    def cleanup(self):
+        '''
+        delete the memory-mapped files after the fits files are written
+        '''
+        if not self.streaming:
+            return None
+        self.cubes = {}
+        for fn in [self.progress_fn] + [self.cube_fn(name) for name in self.names]:
+            if os.path.isfile(fn):
+                os.remove(fn)
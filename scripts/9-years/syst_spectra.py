@@ -0,0 +1,223 @@
+"""
+Systematic envelopes of the best-fit particle and gamma-ray spectra.
+
+The best-fit parameters (N_0, gamma, E_cut) of the Fermi bubbles spectra
+are stored in plot_dct/Low_energy_range*/ for every model (boxes, lowE, GALPROP),
+data class and lat-lon cell. Here the parameters of all systematic variants
+and cells are collected in arrays with the shape (nvar, ncell), the spectra are
+evaluated at once with the shape (nvar, ncell, nE) and the envelopes, quantiles
+and stat + syst bands are calculated along the variants axis.
+
+The parameters of each yaml file are cached together with the file modification time
+in plot_dct/syst_cache.json, so that a new variant only reads its own files.
+
+Usage:
+    import syst_spectra as syst
+    variants = [('boxes', 0, 'source'), ('lowE', 0, 'source'), ('GALPROP', 0, 'source')]
+    cells = [(-5.0, 0.0), (-5.0, 4.0)]
+    res = syst.calc_envelopes(variants, cells, Es, process='IC')
+    res['min'], res['max'] - arrays with the shape (ncell, nE)
+"""
+
+import os
+import numpy as np
+import dio
+
+
+plot_dct_dir = 'plot_dct/'
+cache_fn = plot_dct_dir + 'syst_cache.json'
+
+par_keys = ['N_0', 'gamma', 'E_cut', 'sgm_N_0', 'sgm_gamma', 'sgm_E_cut']
+speed_of_light = 2.998e+10
+
+_results = {}          # evaluated envelopes, key: hash of the input parameters
+
+
+def plot_dct_fn(model, lowE_range, data_class, process, l, b):
+    '''
+    file name of the best-fit spectrum for one variant and one lat-lon cell
+    '''
+    return plot_dct_dir + 'Low_energy_range%i/' % lowE_range + model + '_' + data_class + '_' + process \
+        + '_cutoff_l=' + str(float(l)) + '_b=' + str(float(b)) + '.yaml'
+
+
+def _get_par(dct, key):
+    '''
+    some of the older dictionaries have numbered keys, e.g. '2) gamma'
+    '''
+    if key in dct:
+        return dct[key]
+    for dkey in dct.keys():
+        if dkey.endswith(') ' + key):
+            return dct[dkey]
+    return np.nan
+
+
+def _load_row(fn, cache):
+    '''
+    read the parameters of one yaml file, use the cached values if the file did not change
+    OUTPUT:
+        row - dictionary of the parameters, None if the file does not exist
+        changed - True if the row was added to the cache or updated
+    '''
+    if not os.path.isfile(fn):
+        print 'Dictionary with filename %s not found' % fn
+        return None, False
+    mtime = os.path.getmtime(fn)
+    if fn in cache and cache[fn]['mtime'] == mtime:
+        return cache[fn], False
+    dct = dio.loaddict(fn)
+    row = {'mtime': mtime}
+    for key in par_keys:
+        row[key] = float(_get_par(dct, key))
+    row['x'] = list(dct.get('x', []))
+    row['y'] = list(dct.get('y', []))
+    cache[fn] = row
+    return row, True
+
+
+def load_pars(variants, cells, process='IC', use_cache=True):
+    '''
+        collect best-fit parameters of all variants and cells
+    INPUT:
+        variants - list of (model, lowE_range, data_class), e.g. ('boxes', 0, 'source')
+        cells - list of (l, b) centers of lat-lon cells (deg)
+        process - 'IC' (electrons) or 'pi0' (protons)
+        use_cache - read and update the cache of the parameters
+    OUTPUT:
+        dictionary with the parameters, shape (nvar, ncell),
+        and the gamma-ray SEDs 'x' and 'y', shape (nvar, ncell, nEg), padded with nan
+    '''
+    cache = {}
+    if use_cache and os.path.isfile(cache_fn):
+        cache = dio.loaddict(cache_fn)
+    changed = False                                          # new rows and rows of files with a new mtime are saved
+
+    nvar = len(variants)
+    ncell = len(cells)
+    res = {}
+    for key in par_keys:
+        res[key] = np.nan * np.ones((nvar, ncell))
+    rows = {}
+    nEg = 0
+    for i, (model, lowE_range, data_class) in enumerate(variants):
+        for j, (l, b) in enumerate(cells):
+            row, updated = _load_row(plot_dct_fn(model, lowE_range, data_class, process, l, b), cache)
+            changed |= updated
+            if row is None:
+                continue
+            rows[(i, j)] = row
+            nEg = max(nEg, len(row['y']))
+            for key in par_keys:
+                res[key][i, j] = row[key]
+
+    res['x'] = np.nan * np.ones((nvar, ncell, nEg))
+    res['y'] = np.nan * np.ones((nvar, ncell, nEg))
+    for (i, j), row in rows.items():
+        n = len(row['y'])
+        res['x'][i, j, :n] = row['x'][:n]
+        res['y'][i, j, :n] = row['y']
+
+    if use_cache and changed:
+        dio.savedict(cache, cache_fn, silent=True)
+    return res
+
+
+def particle_spectra(pars, Es, factor=None):
+    '''
+        power law with cutoff N_0 * E**(-gamma) * exp(-E / E_cut) for all variants and cells
+    INPUT:
+        pars - dictionary of arrays with the shape (nvar, ncell)
+        Es - array, shape (nE,): energies (GeV)
+        factor - array, shape (nE,) or None: multiplicative factor, e.g. E^2 c / (4 pi)
+    OUTPUT:
+        array, shape (nvar, ncell, nE)
+    '''
+    N_0 = pars['N_0'][..., np.newaxis]
+    gamma = pars['gamma'][..., np.newaxis]
+    E_cut = pars['E_cut'][..., np.newaxis]
+    res = N_0 * Es**(-gamma) * np.exp(-Es / E_cut)
+    if factor is not None:
+        res *= factor
+    return res
+
+
+def stat_error(pars, Es):
+    '''
+        relative statistical error of the spectra from the errors of the parameters
+        (linear error propagation, correlations are neglected, missing errors are zero)
+    OUTPUT:
+        array, shape (nvar, ncell, nE)
+    '''
+    sgm = [np.nan_to_num(pars[key][..., np.newaxis]) for key in ['sgm_N_0', 'sgm_gamma', 'sgm_E_cut']]
+    N_0 = pars['N_0'][..., np.newaxis]
+    E_cut = pars['E_cut'][..., np.newaxis]
+    return np.sqrt((sgm[0] / N_0)**2 + (np.log(Es) * sgm[1])**2 + (Es * sgm[2] / E_cut**2)**2)
+
+
+def envelope(spectra):
+    '''
+    min and max over the variants (first axis), missing variants are ignored
+    '''
+    return np.nanmin(spectra, axis=0), np.nanmax(spectra, axis=0)
+
+
+def quantiles(spectra, qs=(16., 50., 84.)):
+    '''
+    quantiles (in percent) over the variants, output shape (nq, ncell, nE)
+    '''
+    return np.array([np.nanpercentile(spectra, q, axis=0) for q in qs])
+
+
+def stat_syst_band(spectra, rel_err, baseline=0):
+    '''
+        stat + syst band around the baseline variant:
+        the distance to the envelope and the statistical error of the baseline are added in quadrature
+    OUTPUT:
+        band_min, band_max - arrays, shape (ncell, nE)
+    '''
+    syst_min, syst_max = envelope(spectra)
+    base = spectra[baseline]
+    stat = base * rel_err[baseline]
+    band_max = base + np.sqrt((syst_max - base)**2 + stat**2)
+    band_min = base - np.sqrt((base - syst_min)**2 + stat**2)
+    return np.maximum(band_min, 0.), band_max
+
+
+def calc_envelopes(variants, cells, Es, process='IC', factor=None, baseline=0,
+                   qs=(16., 50., 84.), use_cache=True):
+    '''
+        evaluate the spectra of all variants and cells and calculate the envelopes
+    INPUT:
+        variants - list of (model, lowE_range, data_class), the baseline is variants[baseline]
+        cells - list of (l, b) centers of lat-lon cells (deg)
+        Es - array, shape (nE,): particle energies (GeV)
+        process - 'IC' or 'pi0'
+        factor - array, shape (nE,): by default E^2 c / (4 pi)
+    OUTPUT:
+        dictionary with the arrays
+            'spectra', 'stat' - shape (nvar, ncell, nE)
+            'min', 'max', 'band_min', 'band_max' - shape (ncell, nE)
+            'quantiles' - shape (nq, ncell, nE)
+            'gamma_x', 'gamma_y', 'gamma_min', 'gamma_max' - gamma-ray SEDs and their envelopes
+    '''
+    Es = np.asarray(Es, dtype=float)
+    if factor is None:
+        factor = Es**2 * speed_of_light / 4. / np.pi
+    key = dio.get_hash(str([variants, cells, list(Es), list(factor), process, baseline, qs]))
+    if use_cache and key in _results:
+        return _results[key]
+
+    pars = load_pars(variants, cells, process=process, use_cache=use_cache)
+    res = {'pars': pars}
+    res['spectra'] = particle_spectra(pars, Es, factor=factor)
+    res['stat'] = stat_error(pars, Es)
+    res['min'], res['max'] = envelope(res['spectra'])
+    res['band_min'], res['band_max'] = stat_syst_band(res['spectra'], res['stat'], baseline=baseline)
+    res['quantiles'] = quantiles(res['spectra'], qs=qs)
+    res['gamma_x'] = pars['x']
+    res['gamma_y'] = pars['y']
+    res['gamma_min'], res['gamma_max'] = envelope(pars['y'])
+
+    _results[key] = res
+    return res
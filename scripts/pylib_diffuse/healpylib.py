@@ -33,6 +33,7 @@ __all__ = ['step', 'pix2BL', 'BL2pix', 'func2fpix', 'data2fpix', 'heal', 'gaussB
 
 import numpy as np
 import math
+import os
 import healpy
 #import scipy
 #from scipy import optimize
@@ -49,6 +50,9 @@ from matplotlib import pyplot
 epsilon = 1.e-15
 log_eps = np.log(epsilon)
 
+# directory for the cached ordering permutations
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/cache/')
+
 #########################################################################
 #                                                                       #
 #           general functions                                           #
@@ -87,12 +91,12 @@ def get_root(nside, p, nside_root=None, nest=False):
     
     ratio = nside / nside_root
     if not nest:
-        p = healpy.ring2nest(nside, p)
+        p = ring2nest(nside, p)
     if isinstance(p, list):
         p = np.array(p)
     res = p / ratio**2
     if not nest:
-        res = healpy.nest2ring(nside_root, res)
+        res = nest2ring(nside_root, res)
     return res
     
 
@@ -104,10 +108,10 @@ def get_daughters(nside, p, nside_new=None, nest=False):
         return p
     ratio = int(nside_new/nside)
     if not nest:
-        p = healpy.ring2nest(nside, p)
+        p = ring2nest(nside, p)
     res = range(p * ratio**2, (p + 1) * ratio**2)
     if not nest:
-        return healpy.nest2ring(nside_new, res)
+        return nest2ring(nside_new, res)
     else:
         return res
 
@@ -124,15 +128,97 @@ def get_daughters_matrix(nside, p, nside_new=None, nest=False):
         return p
     p = np.array(p)
     if not nest:
-        p = healpy.ring2nest(nside, p)
+        p = ring2nest(nside, p)
     nd = int(nside_new/nside)**2
     res = nd * np.outer(np.array(p), np.ones(nd, dtype=int)) + np.arange(nd)
     if not nest:
-        res = np.array(healpy.nest2ring(nside_new, res))
+        res = np.array(nest2ring(nside_new, res))
     return res
 
 
+_orderings = {}
+ordering_max_nside = 1024                         # the permutations are cached up to this nside
+
+
+def ordering_inds(nside, transform='ring2nest', use_cache=True):
+    '''
+        permutation between the RING and the NESTED orderings, calculated once per nside
+    INPUT:
+        nside - healpix parameter
+        transform - 'ring2nest': healpy.ring2nest(nside, range(npix)), the nested indices of the ring pixels,
+                    'nest2ring': healpy.nest2ring(nside, range(npix))
+        use_cache - the permutation is saved in cache_dir and loaded in the next sessions
+    OUTPUT:
+        inds - int array, shape (npix,)
+    USAGE:
+        ring_map = nest_map[ordering_inds(nside, 'ring2nest')]
+        nest_cube = ring_cube[:, ordering_inds(nside, 'nest2ring')]      # cube.shape = (nE, npix)
+    '''
+    key = (nside, transform)
+    if key not in _orderings:
+        fn = cache_dir + 'ordering_%s_nside%i.npy' % (transform, nside)
+        if use_cache and os.path.isfile(fn):
+            _orderings[key] = np.array(np.load(fn), dtype=np.int64)
+        else:
+            func = {'ring2nest': healpy.ring2nest, 'nest2ring': healpy.nest2ring}[transform]
+            _orderings[key] = np.array(func(nside, np.arange(healpy.nside2npix(nside))), dtype=np.int64)
+            if use_cache:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_fn = fn + '.tmp%i.npy' % os.getpid()
+                np.save(tmp_fn, np.array(_orderings[key], dtype=np.int32))
+                os.rename(tmp_fn, fn)
+    return _orderings[key]
+
+
+def ring2nest(nside, p):
+    '''
+    healpy.ring2nest with the cached permutation for nside <= ordering_max_nside
+    '''
+    if nside > ordering_max_nside:
+        return healpy.ring2nest(nside, p)
+    return ordering_inds(nside, 'ring2nest')[p]
+
+
+def nest2ring(nside, p):
+    '''
+    healpy.nest2ring with the cached permutation for nside <= ordering_max_nside
+    '''
+    if nside > ordering_max_nside:
+        return healpy.nest2ring(nside, p)
+    return ordering_inds(nside, 'nest2ring')[p]
+
+
+def reorder(array, r2n=False, n2r=False, axis=0):
+    '''
+        change the ordering of a map or a data cube with one fancy-index operation
+    INPUT:
+        array - array_like, the pixels are along the axis
+        r2n - RING to NESTED
+        n2r - NESTED to RING
+        axis - pixel axis, e.g. 0 for (npix, nE) and -1 for (nE, npix) cubes
+    '''
+    array = np.asarray(array)
+    if r2n == n2r:
+        return array
+    nside = healpy.npix2nside(array.shape[axis])
+    inds = ordering_inds(nside, 'nest2ring' if r2n else 'ring2nest')
+    return np.take(array, inds, axis=axis)
+
+
 def map2map(array, transform):
+    '''
+    res[i] = array[transform(nside, i)], the ring2nest and nest2ring permutations are cached
+    '''
+    npix = len(array)
+    nside = healpy.npix2nside(npix)
+    if transform is healpy.ring2nest or transform is healpy.nest2ring:
+        inds = ordering_inds(nside, transform.__name__)
+    else:
+        inds = transform(nside, np.arange(npix))
+    return np.asarray(array)[inds]
+
+def map2map_old(array, transform):
     npix = len(array)
     nside = healpy.npix2nside(npix)
     inds = transform(nside, range(npix))
@@ -226,7 +226,7 @@ def hmap2umap(hpixmap, upixels, inmap_nest=False, is_mean=True):
 
         if k < inmap_order:
             if not inmap_nest:
-                inds = healpy.nest2ring(nside_new, inds)
+                inds = hlib.nest2ring(nside_new, inds)
             inds_daugh = hlib.get_daughters_matrix(nside_new, inds, nside_new=nside,
                                               nest=inmap_nest)
             
@@ -238,7 +238,7 @@ def hmap2umap(hpixmap, upixels, inmap_nest=False, is_mean=True):
             inds = hlib.get_root(nside_new, hpix_dict[k],
                                  nside_root=nside, nest=True)
             if not inmap_nest:
-                inds = healpy.nest2ring(nside, inds)
+                inds = hlib.nest2ring(nside, inds)
             res[start:finish] = 1. * hpixmap[inds]
 
         if not is_mean:
@@ -288,7 +288,139 @@ def merge_dicts(dict1, dict2):
         res[key] = dict1.get(key, 0.) + dict2.get(key, 0.)
     return res
 
+def hpix_sum(hpix, values):
+    """
+    sort the healpix indices and add the values of repeated indices
+    INPUT:
+        hpix - array of healpix indices
+        values - array (len(hpix),) or (len(hpix), nval)
+    OUTPUT:
+        hpix_u - sorted array of unique indices
+        values_u - sums of the values in hpix_u
+
+    """
+    hpix = np.asarray(hpix, dtype=np.int64)
+    values = np.asarray(values)
+    if np.any(hpix[1:] < hpix[:-1]):
+        order = np.argsort(hpix)
+        hpix = hpix[order]
+        values = values[order]
+    if len(hpix) == 0:
+        return hpix, values
+    starts = np.nonzero(np.concatenate([[True], hpix[1:] != hpix[:-1]]))[0]
+    return hpix[starts], np.add.reduceat(values, starts, axis=0)
+
+def hpix_upgrade(order0, hpix0, values0, order1, power=0):
+    """
+    upgrade values in nested healpix indices from order0 to order1 >= order0:
+    the daughters of hpix0 are (hpix0 << 2 * (order1 - order0)) + 0 ... 4**(order1 - order0) - 1
+    INPUT:
+        order0, order1 - orders of the input and the output
+        hpix0 - array of nested healpix indices at order0
+        values0 - array (len(hpix0),) or (len(hpix0), nval)
+        power - healpix power parameter in ud_grade:
+            power = 0 - intensity: the values are copied, sum(values * dOm) is conserved
+            power = -2 - counts: the values are divided by the number of daughters, sum(values) is conserved
+    OUTPUT:
+        hpix1 - nested healpix indices at order1 (sorted if hpix0 is sorted)
+        values1 - values at order1
+
+    """
+    dorder = order1 - order0
+    hpix0 = np.asarray(hpix0, dtype=np.int64)
+    nsub = 4**dorder
+    hpix1 = ((hpix0[:, np.newaxis] << 2 * dorder) + np.arange(nsub)).flatten()
+    values1 = np.repeat(np.asarray(values0, dtype=np.float64), nsub, axis=0)
+    return hpix1, values1 * 2.**(dorder * power)
+
+def hpix_degrade(order1, hpix1, values1, order0, power=0):
+    """
+    degrade values in nested healpix indices from order1 to order0 <= order1:
+    the parent of hpix1 is hpix1 >> 2 * (order1 - order0), the values of the daughters are added
+    INPUT:
+        order1, order0 - orders of the input and the output
+        hpix1 - array of nested healpix indices at order1
+        values1 - array (len(hpix1),) or (len(hpix1), nval)
+        power - healpix power parameter in ud_grade:
+            power = 0 - intensity: the sum over the daughters is divided by 4**(order1 - order0)
+                (missing daughters count as zero), sum(values * dOm) is conserved
+            power = -2 - counts: sum(values) is conserved
+    OUTPUT:
+        hpix0 - sorted unique nested healpix indices at order0
+        values0 - values at order0
+
+    """
+    dorder = order1 - order0
+    hpix0 = np.asarray(hpix1, dtype=np.int64) >> 2 * dorder
+    values0 = np.asarray(values1, dtype=np.float64) * 2.**(-dorder * (2 + power))
+    return hpix_sum(hpix0, values0)
+
+def hpix_udgrade(order_in, hpix, values, order_out, power=0):
+    """
+    upgrade or degrade values in nested healpix indices from order_in to order_out
+    (see hpix_upgrade and hpix_degrade)
+
+    """
+    if order_out >= order_in:
+        return hpix_upgrade(order_in, hpix, values, order_out, power=power)
+    return hpix_degrade(order_in, hpix, values, order_out, power=power)
+
+def _dict2arrays(map_dict):
+    hpix = map_dict.keys()
+    hpix.sort()
+    return np.array(hpix, dtype=np.int64), np.array([map_dict[pix] for pix in hpix], dtype=np.float64)
+
 def hmap_upgrade(order0, map0_dict, order1, map1_dict=None, power=0):
+    """
+    upgrade order0 map to order1 and merge with an order1 map (see hpix_upgrade)
+    NOTATIONS:
+        hind - healpix index
+        order = log2(nside) - order of the healpix map
+    INPUT:
+        order1 - order of the higher resolution map
+        map1_dict - dictionary: values in healpix indices at order1 {hind: value}
+        order0 - order of the lower resolution map
+        map0_dict - dictionary: values in healpix indices at order0 {hind: value}
+            default: None
+        power - healpix power parameter in ud_grade:
+            default: 0
+            power = 0 - density
+            power = -2 - counts
+    OUTPUT:
+        map1_dict_merged - dictionary {hind, value} healpix map at order1:
+            combination of upgraded map0 and map1 (sum for power = -2, average for power = 0)
+    
+    """
+    hpix0, values0 = _dict2arrays(map0_dict)
+    hpix1, values1 = hpix_upgrade(order0, hpix0, values0, order1, power=power)
+    return merge_dicts(make_dict(hpix1, values1), map1_dict)
+
+def hmap_degrade(order1, map1_dict, order0, map0_dict=None, power=0):
+    """
+    degrade order1 map to order0 and merge with an order0 map (see hpix_degrade)
+    NOTATIONS:
+        hind - healpix index
+        order = log2(nside) - order of the healpix map
+    INPUT:
+        order1 - order of the higher resolution map
+        map1_dict - dictionary: values in healpix indices at order1 {hind: value}
+        order0 - order of the lower resolution map
+        map0_dict - dictionary: values in healpix indices at order0 {hind: value}
+            default: None
+        power - healpix power parameter in ud_grade:
+            default: 0
+            power = 0 - density
+            power = -2 - counts
+    OUTPUT:
+        map0_dict_merged - dictionary {hind, value} healpix map at order0:
+            combination of degraded map1 and map0 (sum for power = -2, average for power = 0)
+    
+    """
+    hpix1, values1 = _dict2arrays(map1_dict)
+    hpix0, values0 = hpix_degrade(order1, hpix1, values1, order0, power=power)
+    return merge_dicts(make_dict(hpix0, values0), map0_dict)
+
+def hmap_upgrade_old(order0, map0_dict, order1, map1_dict=None, power=0):
     """
     upgrade order0 map to order1 and merge with an order1 map
     NOTATIONS:
@@ -332,7 +464,7 @@ def hmap_upgrade(order0, map0_dict, order1, map1_dict=None, power=0):
     return res
 
 
-def hmap_degrade(order1, map1_dict, order0, map0_dict=None, power=0):
+def hmap_degrade_old(order1, map1_dict, order0, map0_dict=None, power=0):
     """
     degrade order1 map to order0 and merge with an order0 map
     NOTATIONS:
@@ -374,7 +506,63 @@ def hmap_degrade(order1, map1_dict, order0, map0_dict=None, power=0):
     map10_dict = make_dict(root1_set, map10)
     return merge_dicts(map10_dict, map0_dict)
 
-def umap_udgrade(umap_in, order_out='min', hmap_out=False, out_time=False):
+def print_timing(timing, title='time'):
+    """
+    print the times of the stages in a timing dictionary {stage: seconds}
+    
+    """
+    print title + ': ' + ', '.join(['%s %.3g sec' % (key, timing[key]) for key in sorted(timing.keys())])
+
+def umap_udgrade(umap_in, order_out='min', hmap_out=False, out_time=False, timing=None):
+    '''
+    resample all orders of a umap to order_out and add the maps (see hpix_udgrade):
+    the pixels of every order are upgraded or degraded in one step by nested index arithmetic,
+    the contributions of all orders are added with hpix_sum
+    if umap_in.values() is None, then assume values = 1
+    INPUT:
+        umap_in - umap
+        order_out - output order, 'min' or 'max': min or max order of umap_in
+        out_time - print the timing dictionary
+        timing - dictionary, filled with the times of the stages (sec):
+            'udgrade' - resampling of the orders, 'merge' - sum of the orders, 'umap' - output umap
+    OUTPUT:
+        umap at order_out, is_mean as in umap_in
+    
+    '''
+    if timing is None:
+        timing = {}
+    t0 = time.time()
+    orders = umap_in.orders()
+    power = umap_in.hpower()
+    if order_out == 'min':
+        order_out = orders[0]
+    elif order_out == 'max':
+        order_out = orders[-1]
+    hpix_list = []
+    values_list = []
+    for order in orders:
+        hpix = np.asarray(umap_in.hpixels(order), dtype=np.int64)
+        if umap_in.values() is None:
+            values = np.ones(len(hpix))
+        else:
+            values = umap_in.values(order)
+        hpix, values = hpix_udgrade(order, hpix, values, order_out, power=power)
+        hpix_list.append(hpix)
+        values_list.append(values)
+    timing['udgrade'] = time.time() - t0
+
+    t0 = time.time()
+    hpix, values = hpix_sum(np.concatenate(hpix_list), np.concatenate(values_list))
+    timing['merge'] = time.time() - t0
+
+    t0 = time.time()
+    umap_out = umap(values=values, hpix_dict={order_out: hpix}, is_mean=umap_in.is_mean)
+    timing['umap'] = time.time() - t0
+    if out_time:
+        print_timing(timing, title='umap_udgrade')
+    return umap_out
+
+def umap_udgrade_old(umap_in, order_out='min', hmap_out=False, out_time=False):
     '''
     if umap_in.values() is None, then assume values = 1
     
@@ -406,8 +594,8 @@ def umap_udgrade(umap_in, order_out='min', hmap_out=False, out_time=False):
     if kdiv < len(orders) - 1:
         hmap_dict_d = hmap_dicts[orders[-1]]
         for k in range(len(orders) - 2, kdiv - 1, -1):
-            hmap_dict_d = hmap_degrade(orders[k + 1], hmap_dict_d, orders[k],
-                                     map0_dict=hmap_dicts[orders[k]], power=power)
+            hmap_dict_d = hmap_degrade_old(orders[k + 1], hmap_dict_d, orders[k],
+                                         map0_dict=hmap_dicts[orders[k]], power=power)
         hmap_dicts[orders[kdiv]] = hmap_dict_d
 
 
@@ -416,8 +604,8 @@ def umap_udgrade(umap_in, order_out='min', hmap_out=False, out_time=False):
     if kdiv > 0:
         hmap_dict_u = hmap_dicts[orders[0]]
         for k in range(1, kdiv + 1):
-            hmap_dict_u = hmap_upgrade(orders[k - 1], hmap_dict_u, orders[k],
-                                     map1_dict=hmap_dicts[orders[k]], power=power)
+            hmap_dict_u = hmap_upgrade_old(orders[k - 1], hmap_dict_u, orders[k],
+                                         map1_dict=hmap_dicts[orders[k]], power=power)
         hmap_dicts[orders[kdiv]] = hmap_dict_u
 
     if out_time:
@@ -442,10 +630,11 @@ def umap_udgrade(umap_in, order_out='min', hmap_out=False, out_time=False):
 
 
 
-def umap2hmap_new(umap, order_out='max', power=None, out_ordering='RING', out_time=False):
-    umap_d = umap_udgrade(umap, order_out=order_out, out_time=out_time)
-    if out_time:
-        t0 = time.time()
+def umap2hmap_new(umap, order_out='max', power=None, out_ordering='RING', out_time=False, timing=None):
+    if timing is None:
+        timing = {}
+    umap_d = umap_udgrade(umap, order_out=order_out, timing=timing)
+    t0 = time.time()
     order = umap_d.orders()[0]
     npix = healpy.nside2npix(2**order)
     vals = umap_d.values()
@@ -453,17 +642,14 @@ def umap2hmap_new(umap, order_out='max', power=None, out_ordering='RING', out_ti
     dims[0] = npix
     res = np.zeros(dims, dtype=vals.dtype)
     hpix = umap_d.hpixels(order)
-    if out_time:
-        print 'nest to ring time: %.3g sec' % (time.time() - t0)
-        t0 = time.time()
     if out_ordering == 'RING':
-        hpix = healpy.nest2ring(2**order, hpix)
-    if out_time:
-        print 'nest to ring time: %.3g sec' % (time.time() - t0)
-        t0 = time.time()
+        hpix = hlib.nest2ring(2**order, hpix)
+    timing['nest2ring'] = time.time() - t0
+    t0 = time.time()
     res[hpix] = vals
+    timing['hmap'] = time.time() - t0
     if out_time:
-        print 'final array time: %.3g sec' % (time.time() - t0)
+        print_timing(timing, title='umap2hmap')
     return res
 
 